@@ -1,5 +1,8 @@
+# cython: language_level=3
 cimport cython
 cimport libc.stdlib
+from libc.math cimport log, log1p, exp
+from cython.parallel cimport prange
 cimport numpy as np
 
 import numpy as np
@@ -8,6 +11,79 @@ import operator
 
 ctypedef np.float32_t DATA_TYPE
 
+ctypedef fused GROUP_TYPE:
+    np.int64_t
+    np.uint32_t
+
+ctypedef fused KEY_TYPE:
+    np.int64_t
+    np.uint32_t
+    np.float64_t
+
+
+cdef extern from *:
+    """
+    #ifdef _OPENMP
+    #define PYPROPHET_OPENMP 1
+    #else
+    #define PYPROPHET_OPENMP 0
+    #endif
+    """
+    int PYPROPHET_OPENMP
+
+
+cdef enum:
+    # groups up to this size are sorted by insertion sort before merging
+    INSERTION_SORT_SIZE = 16
+    # inputs below this size are always processed serially
+    PARALLEL_MIN_SIZE = 10000
+
+
+cdef int num_threads = 1
+
+
+def openmp_enabled():
+    """ True if the module was compiled with OpenMP support """
+    return PYPROPHET_OPENMP == 1
+
+
+def set_num_threads(int threads):
+    """ Sets the number of threads used by the kernels of this module. Without
+    OpenMP support, all kernels run serially. """
+    global num_threads
+    num_threads = max(1, threads)
+
+
+def get_num_threads():
+    """ Number of threads effectively used by the kernels of this module """
+    if not PYPROPHET_OPENMP:
+        return 1
+    return num_threads
+
+
+cdef int effective_threads(size_t n):
+    if not PYPROPHET_OPENMP or n < PARALLEL_MIN_SIZE:
+        return 1
+    return num_threads
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef np.int64_t[:] chunk_boundaries(KEY_TYPE[:] keys, size_t num_chunks):
+    """ Splits keys into num_chunks ranges of similar size, the boundaries are
+    moved forward to the start of the next run of equal keys (groups). """
+    cdef size_t n = keys.shape[0]
+    cdef size_t c, b
+    bounds = np.zeros((num_chunks + 1,), dtype=np.int64)
+    cdef np.int64_t[:] view = bounds
+    for c in range(1, num_chunks):
+        b = max(c * n // num_chunks, <size_t>view[c - 1])
+        while b > 0 and b < n and keys[b] == keys[b - 1]:
+            b += 1
+        view[c] = b
+    view[num_chunks] = n
+    return view
+
 
 @cython.boundscheck(False)
 @cython.wraparound(False)
@@ -55,7 +131,7 @@ def find_nearest_matches(DATA_TYPE[:] basis, DATA_TYPE[:] sample_points, use_sor
                 best_j = high
             else:
                 while low < high - 1:
-                    mid = (low + high) / 2
+                    mid = (low + high) // 2
                     if basis[mid] == sp_i:
                         best_j = mid
                     if basis[mid] < sp_i:
@@ -83,7 +159,7 @@ def find_nearest_matches(DATA_TYPE[:] basis, DATA_TYPE[:] sample_points, use_sor
                 best_j = high
             else:
                 while low < high - 1:
-                    mid = (low + high) / 2
+                    mid = (low + high) // 2
                     if basis[mid] == sp_i:
                         best_j = mid
                         break
@@ -107,7 +183,9 @@ def find_nearest_matches(DATA_TYPE[:] basis, DATA_TYPE[:] sample_points, use_sor
     return result
 
 
-cdef int find_sort_order(DATA_TYPE[:] basis):
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef int find_sort_order(DATA_TYPE[:] basis) noexcept nogil:
     # 0: unsorted
     # 1: ascending
     # 2: descending
@@ -132,116 +210,257 @@ cdef int find_sort_order(DATA_TYPE[:] basis):
         return -1
 
 
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef void count_positives_range(np.float64_t[:] values, size_t start, size_t end, np.int64_t[:] result) noexcept nogil:
+    """ start must be the beginning of a run of equal values """
+    cdef size_t n = values.shape[0]
+    cdef size_t i, run_start = start
+    for i in range(start, end):
+        if i > start and values[i] != values[i - 1]:
+            run_start = i
+        result[i] = n - run_start
+
+
 @cython.boundscheck(False)
 @cython.wraparound(False)
 def count_num_positives(np.float64_t[:] values):
     cdef size_t n = values.shape[0]
-    cdef np.float64_t[:] inp_view = values
-    cdef size_t i0, i1, c
     result = np.zeros_like(values, dtype=np.int64)
     cdef np.int64_t[:] res_view = result
-    i0 = i1 = 0
-    c = n
-    while i0 < n:
-        while i1 < n and inp_view[i0] == inp_view[i1]:
-            res_view[i1] = c
-            i1 += 1
-        c -= 1
-        i0 += 1
+    cdef int threads = effective_threads(n)
+    cdef np.int64_t[:] bounds
+    cdef Py_ssize_t c
+
+    if threads > 1:
+        bounds = chunk_boundaries(values, threads)
+        for c in prange(threads, nogil=True, num_threads=threads, schedule="static"):
+            count_positives_range(values, bounds[c], bounds[c + 1], res_view)
+    else:
+        with nogil:
+            count_positives_range(values, 0, n, res_view)
     return result
 
 
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef void top_ranked_range(np.int64_t[:] tg_ids, DATA_TYPE[:] scores, size_t start, size_t end, np.int64_t[:] flags) noexcept nogil:
+    """ flags the first peak with the highest score of all groups starting within [start, end) """
+    cdef size_t n = tg_ids.shape[0]
+    cdef size_t imin = start
+    cdef size_t imax, best
+    while imin < end:
+        imax = imin + 1
+        best = imin
+        while imax < n and tg_ids[imax] == tg_ids[imin]:
+            if scores[imax] > scores[best]:
+                best = imax
+            imax += 1
+        flags[best] = 1
+        imin = imax
+
+
 @cython.boundscheck(False)
 @cython.wraparound(False)
 def find_top_ranked(np.int64_t[:] tg_ids, DATA_TYPE[:] scores):
     cdef size_t n = scores.shape[0]
     flags = np.zeros((n,), dtype=np.int64)
     cdef np.int64_t[:] view = flags
-    cdef DATA_TYPE current_max = scores[0]
-    cdef size_t current_imax = 0
-    cdef size_t current_tg_id = tg_ids[0]
-    cdef size_t current_write_i = 0
-    cdef size_t i
-    cdef size_t id_
-    cdef DATA_TYPE sc
-    for i in range(tg_ids.shape[0]):
-        id_ = tg_ids[i]
-        sc = scores[i]
-        if id_ != current_tg_id:
-            current_tg_id = id_
-            view[current_imax] = 1
-            current_write_i += 1
-            current_max = sc
-            current_imax = i
-            continue
-        if sc > current_max:
-            current_max = sc
-            current_imax = i
-    view[current_imax] = 1
+    cdef int threads = effective_threads(n)
+    cdef np.int64_t[:] bounds
+    cdef Py_ssize_t c
+
+    if threads > 1:
+        bounds = chunk_boundaries(tg_ids, threads)
+        for c in prange(threads, nogil=True, num_threads=threads, schedule="static"):
+            top_ranked_range(tg_ids, scores, bounds[c], bounds[c + 1], view)
+    else:
+        with nogil:
+            top_ranked_range(tg_ids, scores, 0, n, view)
     return flags
 
 
-cdef partial_rank(DATA_TYPE[:] scores, size_t imin, size_t imax, np.uint32_t[:] ranks, np.uint32_t * ix):
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef void partial_rank(DATA_TYPE[:] scores, size_t imin, size_t imax, np.uint32_t[:] ranks, np.uint32_t * ix, np.uint32_t * buf) noexcept nogil:
     """ imax is exclusive, imax-imin is the size of a target group, so 32 bit int should
-    be sufficient"""
-    cdef np.uint32_t i, j, pos
-    for i in range(imax - imin):
+    be sufficient. 'ix' and 'buf' must hold at least imax-imin entries. Peaks are
+    sorted by descending score with a stable merge sort, equal scores are ranked
+    in input order. """
+    cdef size_t n = imax - imin
+    cdef size_t i, j, k, lo, mid, hi, width
+    cdef np.uint32_t tmp
+    cdef np.uint32_t * src = ix
+    cdef np.uint32_t * dst = buf
+    cdef np.uint32_t * swap
+
+    for i in range(n):
         ix[i] = i
-    for i in range(imax - imin - 1):
-        pos = i
-        for j in range(i + 1, imax - imin):
-            if scores[ix[j] + imin] > scores[ix[pos] + imin]:
-                pos = j
-        ix[i], ix[pos] = ix[pos], ix[i]
 
-    for j in range(imax - imin):
-        ranks[ix[j] + imin] = j + 1
+    # insertion sort of short runs
+    lo = 0
+    while lo < n:
+        hi = min(lo + INSERTION_SORT_SIZE, n)
+        for i in range(lo + 1, hi):
+            tmp = ix[i]
+            j = i
+            while j > lo and scores[tmp + imin] > scores[ix[j - 1] + imin]:
+                ix[j] = ix[j - 1]
+                j -= 1
+            ix[j] = tmp
+        lo = hi
+
+    # bottom-up merge of the runs, alternating between both buffers
+    width = INSERTION_SORT_SIZE
+    while width < n:
+        lo = 0
+        while lo < n:
+            mid = min(lo + width, n)
+            hi = min(lo + 2 * width, n)
+            i = lo
+            j = mid
+            k = lo
+            while i < mid and j < hi:
+                # take from the left run on ties to keep the sort stable
+                if scores[src[j] + imin] > scores[src[i] + imin]:
+                    dst[k] = src[j]
+                    j += 1
+                else:
+                    dst[k] = src[i]
+                    i += 1
+                k += 1
+            while i < mid:
+                dst[k] = src[i]
+                i += 1
+                k += 1
+            while j < hi:
+                dst[k] = src[j]
+                j += 1
+                k += 1
+            lo = hi
+        swap = src
+        src = dst
+        dst = swap
+        width *= 2
+
+    for j in range(n):
+        ranks[src[j] + imin] = j + 1
 
 
 @cython.boundscheck(False)
 @cython.wraparound(False)
-def rank(np.int64_t[:] tg_ids, DATA_TYPE[:] scores):
-    # we assume a transition group has always max 1000 entries:
-    cdef np.uint32_t * ix = <np.uint32_t * > libc.stdlib.malloc(1000 * sizeof(np.uint32_t))
+cdef size_t max_group_size(GROUP_TYPE[:] tg_ids) noexcept nogil:
     cdef size_t n = tg_ids.shape[0]
-    result = np.zeros((n,), dtype=np.uint32)
-    cdef np.uint32_t[:] ranks = result
     cdef size_t imin = 0
     cdef size_t imax
-    cdef np.int64_t g0
+    cdef size_t result = 0
     while imin < n:
         imax = imin + 1
-        g0 = tg_ids[imin]
-        while imax < n and tg_ids[imax] == g0:
+        while imax < n and tg_ids[imax] == tg_ids[imin]:
             imax += 1
-        partial_rank(scores, imin, imax, ranks, ix)
+        if imax - imin > result:
+            result = imax - imin
         imin = imax
-    libc.stdlib.free(ix)
     return result
 
 
 @cython.boundscheck(False)
 @cython.wraparound(False)
-def rank32(np.uint32_t[:] tg_ids, DATA_TYPE[:] scores):
-    # we assume a transition group has always max 1000 entries:
-    cdef np.uint32_t * ix = <np.uint32_t * > libc.stdlib.malloc(1000 * sizeof(np.uint32_t))
+cdef void rank_groups(GROUP_TYPE[:] tg_ids, DATA_TYPE[:] scores, size_t start, size_t end, np.uint32_t[:] ranks, np.uint32_t * ix, np.uint32_t * buf) noexcept nogil:
+    """ ranks all groups starting within [start, end) """
     cdef size_t n = tg_ids.shape[0]
-    result = np.zeros((n,), dtype=np.uint32)
-    cdef np.uint32_t[:] ranks = result
-    cdef size_t imin = 0
+    cdef size_t imin = start
     cdef size_t imax
-    cdef np.float32_t g0
-    while imin < n:
+    while imin < end:
         imax = imin + 1
-        g0 = tg_ids[imin]
-        while imax < n and tg_ids[imax] == g0:
+        while imax < n and tg_ids[imax] == tg_ids[imin]:
             imax += 1
-        partial_rank(scores, imin, imax, ranks, ix)
+        partial_rank(scores, imin, imax, ranks, ix, buf)
         imin = imax
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def rank(GROUP_TYPE[:] tg_ids, DATA_TYPE[:] scores):
+    """ Rank of each peak group within its transition group (consecutive equal
+    tg_ids) by descending score, starting with 1. Groups can have any size. """
+    cdef size_t n = tg_ids.shape[0]
+    result = np.zeros((n,), dtype=np.uint32)
+    cdef np.uint32_t[:] ranks = result
+    cdef int threads = effective_threads(n)
+    cdef size_t k
+    cdef np.uint32_t * ix
+    cdef np.int64_t[:] bounds
+    cdef Py_ssize_t c
+
+    with nogil:
+        k = max(max_group_size(tg_ids), 1)
+        # two buffers of the size of the largest group per thread
+        ix = <np.uint32_t * > libc.stdlib.malloc(2 * k * threads * sizeof(np.uint32_t))
+    if ix == NULL:
+        raise MemoryError()
+
+    if threads > 1:
+        bounds = chunk_boundaries(tg_ids, threads)
+        for c in prange(threads, nogil=True, num_threads=threads, schedule="static"):
+            rank_groups(tg_ids, scores, bounds[c], bounds[c + 1], ranks, ix + 2 * k * c, ix + 2 * k * c + k)
+    else:
+        with nogil:
+            rank_groups(tg_ids, scores, 0, n, ranks, ix, ix + k)
+
     libc.stdlib.free(ix)
     return result
 
 
+def rank32(np.uint32_t[:] tg_ids, DATA_TYPE[:] scores):
+    return rank(tg_ids, scores)
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef void _chromatogram_hypotheses(np.float64_t[:] inv_pg_pp_true, size_t imin, size_t imax, np.float64_t prior_chrom_null, np.float64_t prior_pg_true, np.float64_t[:] hypotheses, np.float64_t * h0) noexcept nogil:
+    """ imax is exclusive. The product of all other peaks being false is
+    computed in log space from prefix sums (stored in 'hypotheses') and a
+    running suffix sum, so each group costs O(k) without additional memory
+    and large groups do not underflow. """
+
+    cdef size_t i
+    cdef double log_af = 0.0
+    cdef double log_h0, log_max, sum_all
+
+    # prefix sums: all peaks before i are false
+    for i in range(imin, imax):
+        hypotheses[i] = log_af
+        log_af += log(inv_pg_pp_true[i])
+
+    # Compute the null hypothesis (e.g. all peaks are false)
+    log_h0 = log_af + log(prior_chrom_null)
+    log_max = log_h0
+
+    # Compute the alternative hypotheses (e.g. one peak is true and all other
+    # peaks are false), log_af is the suffix sum of all peaks after i
+    log_af = 0.0
+    i = imax
+    while i > imin:
+        i -= 1
+        hypotheses[i] = log1p(-inv_pg_pp_true[i]) + hypotheses[i] + log_af + log(prior_pg_true)
+        log_af += log(inv_pg_pp_true[i])
+        if hypotheses[i] > log_max:
+            log_max = hypotheses[i]
+
+    # Compute sum over all hypothesis
+    sum_all = exp(log_h0 - log_max)
+    for i in range(imin, imax):
+        hypotheses[i] = exp(hypotheses[i] - log_max)
+        sum_all += hypotheses[i]
+
+    # Divide by sum over all hypothesis (normalize)
+    for i in range(imin, imax):
+        hypotheses[i] = hypotheses[i] / sum_all
+    h0[0] = exp(log_h0 - log_max) / sum_all
+
+
 @cython.boundscheck(False)
 @cython.wraparound(False)
 def single_chromatogram_hypothesis_fast(np.float64_t[:] inv_pg_pp_true, np.float64_t prior_chrom_null, np.float64_t prior_pg_true):
@@ -249,52 +468,59 @@ def single_chromatogram_hypothesis_fast(np.float64_t[:] inv_pg_pp_true, np.float
     # inv_pg_pp_true contains the probabilities that the peaks are false
 
     cdef size_t n = inv_pg_pp_true.shape[0]
-    cdef np.float64_t final_val
-    cdef np.float64_t val
-    cdef np.float64_t sum_all = 0.0
     result = np.zeros((n+1,), dtype=np.float64)
     cdef np.float64_t[:] cresult = result
+    cdef np.float64_t h0
 
-    cdef int i
-    cdef int j
-    cdef double af = 1.0
+    _chromatogram_hypotheses(inv_pg_pp_true, 0, n, prior_chrom_null, prior_pg_true, cresult[1:], &h0)
+    cresult[0] = h0
 
-    # Compute the null hypothesis (e.g. all peaks are false)
-    i = 0
-    while i < n:
-        af *= inv_pg_pp_true[i]
-        i += 1
+    return result
 
-    cresult[0] = af * prior_chrom_null
 
-    # Compute the alternative hypotheses (e.g. one peak is true and all other
-    # peaks are false)
-    i = 0
-    while i < n:
-        val = inv_pg_pp_true[i]
-        j = 0
-        af = 1.0
-        # Compute the product of all peaks being false except i
-        while j < n:
-            if i != j:
-                af *= inv_pg_pp_true[j]
-            j += 1
-
-        final_val = <np.float64_t>( (1-val) * af) # value i is true
-
-        cresult[i+1] = final_val * prior_pg_true
-        i += 1
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef void chromatogram_hypotheses_range(np.int64_t[:] tg_ids, np.float64_t[:] inv_pg_pp_true, np.float64_t prior_chrom_null, size_t start, size_t end, np.float64_t[:] hypotheses, np.float64_t[:] hypotheses_h0) noexcept nogil:
+    """ computes the hypotheses of all groups starting within [start, end) """
+    cdef size_t n = tg_ids.shape[0]
+    cdef size_t imin = start
+    cdef size_t imax, i
+    cdef np.float64_t h0
+    while imin < end:
+        imax = imin + 1
+        while imax < n and tg_ids[imax] == tg_ids[imin]:
+            imax += 1
+        _chromatogram_hypotheses(inv_pg_pp_true, imin, imax, prior_chrom_null, (1.0 - prior_chrom_null) / (imax - imin), hypotheses, &h0)
+        for i in range(imin, imax):
+            hypotheses_h0[i] = h0
+        imin = imax
 
-    # Compute sum over all hypothesis
-    i = 0
-    while i < n+1:
-        sum_all += cresult[i]
-        i += 1
 
-    # Divide by sum over all hypothesis (normalize)
-    i = 0
-    while i < n+1:
-        cresult[i] = cresult[i] / sum_all
-        i += 1
+@cython.boundscheck(False)
+@cython.wraparound(False)
+def chromatogram_hypotheses(np.int64_t[:] tg_ids, np.float64_t[:] inv_pg_pp_true, np.float64_t prior_chrom_null):
+    """ Posterior probabilities of all chromatogram hypotheses for consecutive
+    groups of peaks with the same tg_id.
 
-    return result
+    Returns the probability that each peak is the true peak of its group and
+    the probability of the h0 (all peaks of the group are false). """
+
+    cdef size_t n = tg_ids.shape[0]
+    hypotheses = np.zeros((n,), dtype=np.float64)
+    hypotheses_h0 = np.zeros((n,), dtype=np.float64)
+    cdef np.float64_t[:] hyp_view = hypotheses
+    cdef np.float64_t[:] h0_view = hypotheses_h0
+    cdef int threads = effective_threads(n)
+    cdef np.int64_t[:] bounds
+    cdef Py_ssize_t c
+
+    if threads > 1:
+        bounds = chunk_boundaries(tg_ids, threads)
+        for c in prange(threads, nogil=True, num_threads=threads, schedule="static"):
+            chromatogram_hypotheses_range(tg_ids, inv_pg_pp_true, prior_chrom_null, bounds[c], bounds[c + 1], hyp_view, h0_view)
+    else:
+        with nogil:
+            chromatogram_hypotheses_range(tg_ids, inv_pg_pp_true, prior_chrom_null, 0, n, hyp_view, h0_view)
+
+    return hypotheses, hypotheses_h0
@@ -0,0 +1,155 @@
+import os
+import sqlite3
+import click
+import pandas as pd
+
+from collections import OrderedDict
+from shutil import copyfile
+
+
+class ArtifactStore(object):
+
+    """Score tables produced by the commands of a single (chained) invocation
+
+    Tables put into the store are kept in memory and are written to their OSW
+    file only once, when the invocation ends or when a command needs the file
+    on disk. Commands that can take a pending table as a data frame get it
+    with pending_table(); commands querying an OSW file use connect_pending(),
+    which provides the pending tables as TEMP tables of the connection, or
+    connect(), which writes the pending tables they query to the file first.
+    """
+
+    def __init__(self):
+        self.tables = OrderedDict()
+
+    def put(self, path, table, df, dtype=None):
+        self.tables[(os.path.abspath(path), table)] = (df, dtype)
+
+    def get(self, path, table):
+        entry = self.tables.get((os.path.abspath(path), table))
+        if entry is None:
+            return None
+        return entry[0]
+
+    def pending(self, path):
+        path = os.path.abspath(path)
+        return [(table, df, dtype) for (p, table), (df, dtype) in self.tables.items() if p == path]
+
+    def discard(self, path):
+        for table, df, dtype in self.pending(path):
+            del self.tables[(os.path.abspath(path), table)]
+
+    def flush(self, path=None, tables=None):
+        if path is None:
+            paths = list(OrderedDict.fromkeys(p for p, table in self.tables))
+        else:
+            paths = [os.path.abspath(path)]
+
+        for path in paths:
+            pending = [p for p in self.pending(path) if tables is None or p[0] in tables]
+            if len(pending) == 0:
+                continue
+
+            con = sqlite3.connect(path)
+            c = con.cursor()
+            for table, df, dtype in pending:
+                c.execute('DROP TABLE IF EXISTS %s;' % table)
+                df.to_sql(table, con, index=False, dtype=dtype)
+                del self.tables[(path, table)]
+            con.commit()
+            c.close()
+            con.close()
+            click.echo("Info: %s written." % path)
+
+
+def artifact_store():
+    # the store is created by the cli group; library calls write directly
+    ctx = click.get_current_context(silent=True)
+    if ctx is None:
+        return None
+    return ctx.find_object(ArtifactStore)
+
+
+def connect(path, tables=None):
+    """ Connect to an OSW file including the pending score tables of the
+    current invocation; 'tables' restricts the score tables written. """
+
+    flush_artifacts(path, tables)
+
+    return sqlite3.connect(path)
+
+
+def connect_pending(path, tables=None):
+    """ Connect to an OSW file without writing the pending score tables of the
+    current invocation; they are provided as TEMP tables, which take
+    precedence over the tables on disk. 'tables' restricts the score tables
+    provided. """
+
+    con = sqlite3.connect(path)
+
+    store = artifact_store()
+    if store is not None:
+        for table, df, dtype in store.pending(path):
+            if tables is None or table in tables:
+                insert_table(con, table, df, dtype, temp=True)
+
+    return con
+
+
+def pending_table(path, table):
+    """ Pending score table of the current invocation or None, if the table
+    is only present on disk. """
+
+    store = artifact_store()
+    if store is None:
+        return None
+    return store.get(path, table)
+
+
+def write_table(path, table, df, dtype=None):
+    """ Replace a table of an OSW file, deferred until the end of the current
+    invocation if an artifact store is present. """
+
+    store = artifact_store()
+    if store is not None:
+        store.put(path, table, df, dtype)
+        return
+
+    con = sqlite3.connect(path)
+    c = con.cursor()
+    c.execute('DROP TABLE IF EXISTS %s;' % table)
+    con.commit()
+    c.fetchall()
+
+    df.to_sql(table, con, index=False, dtype=dtype)
+    con.close()
+    click.echo("Info: %s written." % path)
+
+
+def insert_table(con, table, df, dtype=None, temp=False):
+    """ Append a data frame to a table of an open connection, which is created
+    if needed. Unlike DataFrame.to_sql, the transaction is not committed. """
+
+    create = 'CREATE TEMP TABLE IF NOT EXISTS' if temp else 'CREATE TABLE IF NOT EXISTS'
+    con.execute(pd.io.sql.get_schema(df, table, con=con, dtype=dtype).replace('CREATE TABLE', create, 1))
+    con.executemany('INSERT INTO %s%s (%s) VALUES (%s);' % ('temp.' if temp else '', table, ','.join(['"%s"' % column for column in df.columns]), ','.join(['?'] * len(df.columns))), df.astype(object).where(pd.notnull(df), None).itertuples(index=False, name=None))
+
+
+def flush_artifacts(path=None, tables=None):
+    """ Write the pending score tables (of 'path') to disk. """
+
+    store = artifact_store()
+    if store is not None:
+        store.flush(path, tables)
+
+
+def copy_osw(infile, outfile):
+    """ Copy an OSW file including its pending score tables. The pending
+    tables of a previous 'outfile' are superseded by the copy. """
+
+    store = artifact_store()
+    if store is not None:
+        store.flush(infile)
+        store.discard(outfile)
+
+    copyfile(infile, outfile)
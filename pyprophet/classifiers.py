@@ -26,6 +26,9 @@ class AbstractLearner(object):
     def set_parameters(self, param):
         raise NotImplementedError()
 
+    def set_threads(self, threads):
+        return self
+
     @classmethod
     def averaged_learner(clz, params):
         raise NotImplementedError()
@@ -89,8 +92,12 @@ class XGBLearner(AbstractLearner):
         self.xgb_params = xgb_params
         self.xgb_params_space = xgb_params_space
         self.xgb_params_tuned = xgb_params
+        self.set_threads(threads)
+
+    def set_threads(self, threads):
         self.threads = threads
         self.xgb_params['nthread'] = self.threads
+        return self
 
     def tune(self, decoy_peaks, target_peaks, use_main_score=True):
         def objective(params):
@@ -108,12 +115,15 @@ class XGBLearner(AbstractLearner):
                 'scale_pos_weight': "{:.3f}".format(params['scale_pos_weight']),
             }
             
-            clf = xgb.XGBClassifier(random_state=42, silent=1, objective='binary:logitraw', eval_metric='auc', **params)
+            clf = xgb.XGBClassifier(random_state=42, silent=1, objective='binary:logitraw', eval_metric='auc', n_jobs=max(1, self.threads // cv_jobs), **params)
 
-            score = cross_val_score(clf, X, y, scoring='roc_auc', n_jobs=self.threads, cv=KFold(n_splits=3, shuffle=True, random_state=np.random.RandomState(42))).mean()
+            score = cross_val_score(clf, X, y, scoring='roc_auc', n_jobs=cv_jobs, cv=KFold(n_splits=3, shuffle=True, random_state=np.random.RandomState(42))).mean()
             # click.echo("Info: AUC: {:.3f} hyperparameters: {}".format(score, params))
             return score
 
+        # the 3 cross-validation folds share the thread budget of this learner
+        cv_jobs = max(1, min(3, self.threads))
+
         click.echo("Info: Autotuning of XGB hyperparameters.")
 
         assert isinstance(decoy_peaks, Experiment)
@@ -1,6 +1,5 @@
 import pandas as pd
 import numpy as np
-import random
 import click
 import sys
 import os
@@ -32,6 +31,12 @@ def transform_threads(ctx, param, value):
     return(value)
 
 
+def transform_core_budget(ctx, param, value):
+    if value < 0:
+      raise click.ClickException('Wrong input values for %s. %s must be >= 0 (0: automatic).' % (param.name, param.name))
+    return(value)
+
+
 def transform_subsample_ratio(ctx, param, value):
     if value < 0 or value > 1:
       raise click.ClickException('Wrong input values for subsample_ratio. subsample_ratio must be within [0,1].')
@@ -59,7 +64,8 @@ def is_sqlite_file(filename):
 def check_sqlite_table(con, table):
     table_present = False
     c = con.cursor()
-    c.execute('SELECT count(name) FROM sqlite_master WHERE type="table" AND name="%s"' % table)
+    # TEMP tables (e.g. pending score tables) are included
+    c.execute('SELECT count(name) FROM (SELECT type, name FROM sqlite_master UNION SELECT type, name FROM sqlite_temp_master) WHERE type="table" AND name="%s"' % table)
     if c.fetchone()[0] == 1:
         table_present = True
     else:
@@ -69,6 +75,14 @@ def check_sqlite_table(con, table):
     return(table_present)
 
 
+def check_sqlite_column(con, table, column):
+    c = con.cursor()
+    c.execute('PRAGMA table_info(%s)' % table)
+    column_present = column in [row[1] for row in c.fetchall()]
+
+    return(column_present)
+
+
 def check_for_unique_blocks(tg_ids):
     seen = set()
     last_tg_id = None
@@ -155,7 +169,6 @@ def prepare_data_table(table, tg_id_name="transition_group_id",
 
     # collect needed data:
     empty_col = [0] * N
-    empty_none_col = [None] * N
 
     tg_ids = table[tg_id_name]
 
@@ -171,7 +184,7 @@ def prepare_data_table(table, tg_id_name="transition_group_id",
                 tg_num_id=tg_num_ids,
                 is_decoy=table[decoy_name].values.astype(bool),
                 is_top_peak=empty_col,
-                is_train=empty_none_col,
+                is_train=np.zeros(N, dtype=bool),
                 main_score=table[main_score_name].values,
                 )
 
@@ -205,6 +218,9 @@ class Experiment(object):
     @profile
     def __init__(self, df):
         self.df = df.copy()
+        # top target / top decoy peak groups by is_decoy, reset whenever the
+        # ranking or the columns of the experiment change
+        self._top_peaks = {}
 
     def log_summary(self):
         click.echo("Info: Summary of input data:")
@@ -216,10 +232,11 @@ class Experiment(object):
         return self.df.__getitem__(*args)
 
     def __setitem__(self, *args):
+        self._top_peaks.clear()
         return self.df.__setitem__(*args)
 
     def __setattr__(self, name, value):
-        if name not in ["df", ]:
+        if name not in ["df", "_top_peaks"]:
             raise click.ClickException("Use '[...]' syntax to set input file columns.")
         object.__setattr__(self, name, value)
 
@@ -230,6 +247,7 @@ class Experiment(object):
     def rank_by(self, score_col_name):
         flags = find_top_ranked(self.df.tg_num_id.values, self.df[score_col_name].values.astype(np.float32, copy=False))
         self.df.is_top_peak = flags
+        self._top_peaks.clear()
 
     def get_top_test_peaks(self):
         df = self.df
@@ -241,13 +259,17 @@ class Experiment(object):
     def get_target_peaks(self):
         return Experiment(self.df[self.df.is_decoy == False])
 
+    def _get_top_peaks(self, is_decoy):
+        if is_decoy not in self._top_peaks:
+            df = self.df
+            self._top_peaks[is_decoy] = Experiment(df[(df.is_decoy == is_decoy) & (df.is_top_peak == True)])
+        return self._top_peaks[is_decoy]
+
     def get_top_decoy_peaks(self):
-        ix_top = self.df.is_top_peak == True
-        return Experiment(self.df[(self.df.is_decoy == True) & ix_top])
+        return self._get_top_peaks(True)
 
     def get_top_target_peaks(self):
-        ix_top = self.df.is_top_peak == True
-        return Experiment(self.df[(self.df.is_decoy == False) & ix_top])
+        return self._get_top_peaks(False)
 
     def get_feature_matrix(self, use_main_score):
         min_col = 5 if use_main_score else 6
@@ -261,27 +283,41 @@ class Experiment(object):
         ids = self.df.tg_num_id.values
         scores = self.df.d_score.values
         peak_group_ranks = rank(ids, scores)
-        self.df["peak_group_rank"] = peak_group_ranks
+        self["peak_group_rank"] = peak_group_ranks
 
     @profile
-    def split_for_xval(self, fraction, is_test):
+    def split_for_xval(self, fraction, is_test, seed=None):
         df = self.df
-        decoy_ids = df[df.is_decoy == True].tg_id.unique()
-        target_ids = df[df.is_decoy == False].tg_id.unique()
+        tg_num_ids = df.tg_num_id.values
+
+        # per group lookup tables indexed by tg_num_id
+        num_groups = tg_num_ids.max() + 1
+        is_present = np.zeros(num_groups, dtype=bool)
+        is_present[tg_num_ids] = True
+        is_decoy = np.zeros(num_groups, dtype=bool)
+        is_decoy[tg_num_ids] = df.is_decoy.values
+
+        group_ids = np.flatnonzero(is_present)
+        decoy_ids = group_ids[is_decoy[group_ids]]
+        target_ids = group_ids[~is_decoy[group_ids]]
 
         if not is_test:
-            random.shuffle(decoy_ids)
-            random.shuffle(target_ids)
+            # forked fold workers share the global random state of numpy
+            random_state = np.random if seed is None else np.random.RandomState(seed)
+            decoy_ids = random_state.permutation(decoy_ids)
+            target_ids = random_state.permutation(target_ids)
         else:
-            decoy_ids = sorted(decoy_ids)
-            target_ids = sorted(target_ids)
-
-        decoy_ids = decoy_ids[:int(len(decoy_ids) * fraction) + 1]
-        target_ids = target_ids[:int(len(target_ids) * fraction) + 1]
-        learn_ids = np.concatenate((decoy_ids, target_ids))
-        ix_learn = df.tg_id.isin(learn_ids)
-        df.loc[ix_learn,'is_train'] = True
-        df.loc[~ix_learn,'is_train'] = False
+            # deterministic split in the order of the original group ids
+            tg_ids = np.empty(num_groups, dtype=object)
+            tg_ids[tg_num_ids] = df.tg_id.values
+            decoy_ids = decoy_ids[np.argsort(tg_ids[decoy_ids], kind="mergesort")]
+            target_ids = target_ids[np.argsort(tg_ids[target_ids], kind="mergesort")]
+
+        is_train = np.zeros(num_groups, dtype=bool)
+        is_train[decoy_ids[:int(len(decoy_ids) * fraction) + 1]] = True
+        is_train[target_ids[:int(len(target_ids) * fraction) + 1]] = True
+        df["is_train"] = is_train[tg_num_ids]
+        self._top_peaks.clear()
 
     def get_train_peaks(self):
         df = self.df[self.df.is_train == True]
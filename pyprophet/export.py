@@ -1,16 +1,16 @@
 import pandas as pd
 import numpy as np
-import sqlite3
 import click
 import os
 
 from .data_handling import check_sqlite_table
+from .artifacts import connect_pending
 from .report import plot_scores
 
 
 def export_tsv(infile, outfile, format, outcsv, transition_quantification, max_transition_pep, ipf, ipf_max_peptidoform_pep, max_rs_peakgroup_qvalue, peptide, max_global_peptide_qvalue, protein, max_global_protein_qvalue):
 
-    con = sqlite3.connect(infile)
+    con = connect_pending(infile)
 
     ipf_present = False
     if ipf:
@@ -431,7 +431,7 @@ GROUP BY PEPTIDE_ID;
 
 def export_score_plots(infile):
 
-    con = sqlite3.connect(infile)
+    con = connect_pending(infile)
 
     if check_sqlite_table(con, "SCORE_MS2"):
         outfile = infile.split(".osw")[0] + "_ms2_score_plots.pdf"
@@ -1,11 +1,11 @@
 import pandas as pd
-import sqlite3
 
 from .data_handling import check_sqlite_table
+from .artifacts import connect_pending
 from .report import plot_scores
 
 def export_compound_tsv(infile, outfile, format, outcsv, max_rs_peakgroup_qvalue):
-    con = sqlite3.connect(infile)
+    con = connect_pending(infile)
     data = pd.read_sql_query("""
                            SELECT
                                RUN.ID AS id_run,
@@ -68,7 +68,7 @@ def export_compound_tsv(infile, outfile, format, outcsv, max_rs_peakgroup_qvalue
 # ms1 and ms2 level 
 def export_compound_score_plots(infile):
 
-    con = sqlite3.connect(infile)
+    con = connect_pending(infile)
 
     if check_sqlite_table(con, "SCORE_MS2"):
         outfile = infile.split(".osw")[0] + "_ms2_score_plots.pdf"
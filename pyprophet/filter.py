@@ -3,6 +3,7 @@ import sqlite3
 import click
 
 from .data_handling import check_sqlite_table
+from .artifacts import connect
 
 
 # Filter a sqMass chromatogram file by given input labels
@@ -76,7 +77,7 @@ def get_ids_stmt(keep_ids):
 
 
 def filter_sqmass(sqmassfiles, infile, max_precursor_pep, max_peakgroup_pep, max_transition_pep):
-    con = sqlite3.connect(infile)
+    con = connect(infile)
 
     # process each sqmassfile independently
     for sqm_in in sqmassfiles:
@@ -1,13 +1,17 @@
 import pandas as pd
 import numpy as np
 import scipy as sp
-import sqlite3
 import sys
 import click
+import sqlite3
+import multiprocessing
 
+from scipy import sparse
+from scipy.special import expit
 from scipy.stats import rankdata
 from .data_handling import check_sqlite_table
-from shutil import copyfile
+from .artifacts import connect_pending, pending_table, copy_osw, write_table, flush_artifacts
+from .parallel import init_fold_worker
 
 def compute_model_fdr(data_in):
     data = np.asarray(data_in)
@@ -27,26 +31,59 @@ def compute_model_fdr(data_in):
     return fdr
 
 
-def read_pyp_peakgroup_precursor(path, ipf_max_peakgroup_pep, ipf_ms1_scoring, ipf_ms2_scoring):
-    click.echo("Info: Reading precursor-level data.")
-    # precursors are restricted according to ipf_max_peakgroup_pep to exclude very poor peak groups
+def feature_range_filter(column, feature_range):
+    # restrict a query to a partition (FEATURE_ID range) of the features
+    if feature_range is None:
+        return "", ()
+    return "AND %s BETWEEN ? AND ?" % column, tuple(feature_range)
+
+
+IPF_SCORE_TABLES = ["SCORE_MS1", "SCORE_MS2", "SCORE_TRANSITION"]
+
+
+def prepare_ipf_input(path, ipf_ms1_scoring, ipf_ms2_scoring):
+    # validates the score tables and creates the indices of the IPF queries
+    # once, before the (partitioned) precursor and transition-level reads;
+    # pending score tables of the invocation are read from memory and are
+    # not indexed on disk
     con = sqlite3.connect(path)
 
-    # only use MS2 precursors
-    if not ipf_ms1_scoring and ipf_ms2_scoring:
-        if not check_sqlite_table(con, "SCORE_MS2") or not check_sqlite_table(con, "SCORE_TRANSITION"):
-            raise click.ClickException("Apply scoring to MS2 and transition-level data before running IPF.")
+    if ipf_ms1_scoring:
+        score_tables = IPF_SCORE_TABLES
+        message = "Apply scoring to MS1, MS2 and transition-level data before running IPF."
+    else:
+        score_tables = ["SCORE_MS2", "SCORE_TRANSITION"]
+        message = "Apply scoring to MS2 and transition-level data before running IPF."
+
+    pending = [table for table in score_tables if pending_table(path, table) is not None]
+    if any(table not in pending and not check_sqlite_table(con, table) for table in score_tables):
+        raise click.ClickException(message)
 
-        con.executescript('''
+    con.executescript('''
+CREATE INDEX IF NOT EXISTS idx_transition_peptide_mapping_transition_id ON TRANSITION_PEPTIDE_MAPPING (TRANSITION_ID);
 CREATE INDEX IF NOT EXISTS idx_transition_id ON TRANSITION (ID);
 CREATE INDEX IF NOT EXISTS idx_precursor_precursor_id ON PRECURSOR (ID);
 CREATE INDEX IF NOT EXISTS idx_feature_precursor_id ON FEATURE (PRECURSOR_ID);
 CREATE INDEX IF NOT EXISTS idx_feature_feature_id ON FEATURE (ID);
-CREATE INDEX IF NOT EXISTS idx_score_ms2_feature_id ON SCORE_MS2 (FEATURE_ID);
-CREATE INDEX IF NOT EXISTS idx_score_transition_feature_id ON SCORE_TRANSITION (FEATURE_ID);
-CREATE INDEX IF NOT EXISTS idx_score_transition_transition_id ON SCORE_TRANSITION (TRANSITION_ID);
 ''')
 
+    for table, index in [("SCORE_MS1", "idx_score_ms1_feature_id ON SCORE_MS1 (FEATURE_ID)"),
+                         ("SCORE_MS2", "idx_score_ms2_feature_id ON SCORE_MS2 (FEATURE_ID)"),
+                         ("SCORE_TRANSITION", "idx_score_transition_feature_id ON SCORE_TRANSITION (FEATURE_ID)"),
+                         ("SCORE_TRANSITION", "idx_score_transition_transition_id ON SCORE_TRANSITION (TRANSITION_ID)")]:
+        if table in score_tables and table not in pending:
+            con.execute("CREATE INDEX IF NOT EXISTS %s;" % index)
+    con.close()
+
+
+def read_pyp_peakgroup_precursor(path, ipf_max_peakgroup_pep, ipf_ms1_scoring, ipf_ms2_scoring, feature_range=None):
+    click.echo("Info: Reading precursor-level data.")
+    # precursors are restricted according to ipf_max_peakgroup_pep to exclude very poor peak groups
+    con = connect_pending(path, ["SCORE_MS2"] + ["SCORE_MS1"] * ipf_ms1_scoring + ["SCORE_TRANSITION"] * ipf_ms2_scoring)
+    feature_filter, params = feature_range_filter("FEATURE.ID", feature_range)
+
+    # only use MS2 precursors
+    if not ipf_ms1_scoring and ipf_ms2_scoring:
         data = pd.read_sql_query('''
 SELECT FEATURE.ID AS FEATURE_ID,
        SCORE_MS2.PEP AS MS2_PEAKGROUP_PEP,
@@ -63,22 +100,12 @@ INNER JOIN
    WHERE TRANSITION.TYPE=''
      AND TRANSITION.DECOY=0) AS SCORE_TRANSITION ON FEATURE.ID = SCORE_TRANSITION.FEATURE_ID
 WHERE PRECURSOR.DECOY=0
-  AND SCORE_MS2.PEP < %s;
-''' % ipf_max_peakgroup_pep, con)
+  AND SCORE_MS2.PEP < %s
+  %s;
+''' % (ipf_max_peakgroup_pep, feature_filter), con, params=params)
 
     # only use MS1 precursors
     elif ipf_ms1_scoring and not ipf_ms2_scoring:
-        if not check_sqlite_table(con, "SCORE_MS1") or not check_sqlite_table(con, "SCORE_MS2") or not check_sqlite_table(con, "SCORE_TRANSITION"):
-            raise click.ClickException("Apply scoring to MS1, MS2 and transition-level data before running IPF.")
-
-        con.executescript('''
-CREATE INDEX IF NOT EXISTS idx_precursor_precursor_id ON PRECURSOR (ID);
-CREATE INDEX IF NOT EXISTS idx_feature_precursor_id ON FEATURE (PRECURSOR_ID);
-CREATE INDEX IF NOT EXISTS idx_feature_feature_id ON FEATURE (ID);
-CREATE INDEX IF NOT EXISTS idx_score_ms1_feature_id ON SCORE_MS1 (FEATURE_ID);
-CREATE INDEX IF NOT EXISTS idx_score_ms2_feature_id ON SCORE_MS2 (FEATURE_ID);
-''')
-
         data = pd.read_sql_query('''
 SELECT FEATURE.ID AS FEATURE_ID,
        SCORE_MS2.PEP AS MS2_PEAKGROUP_PEP,
@@ -89,25 +116,12 @@ INNER JOIN FEATURE ON PRECURSOR.ID = FEATURE.PRECURSOR_ID
 INNER JOIN SCORE_MS1 ON FEATURE.ID = SCORE_MS1.FEATURE_ID
 INNER JOIN SCORE_MS2 ON FEATURE.ID = SCORE_MS2.FEATURE_ID
 WHERE PRECURSOR.DECOY=0
-  AND SCORE_MS2.PEP < %s;
-''' % ipf_max_peakgroup_pep, con)
+  AND SCORE_MS2.PEP < %s
+  %s;
+''' % (ipf_max_peakgroup_pep, feature_filter), con, params=params)
 
     # use both MS1 and MS2 precursors
     elif ipf_ms1_scoring and ipf_ms2_scoring:
-        if not check_sqlite_table(con, "SCORE_MS1") or not check_sqlite_table(con, "SCORE_MS2") or not check_sqlite_table(con, "SCORE_TRANSITION"):
-            raise click.ClickException("Apply scoring to MS1, MS2 and transition-level data before running IPF.")
-
-        con.executescript('''
-CREATE INDEX IF NOT EXISTS idx_transition_id ON TRANSITION (ID);
-CREATE INDEX IF NOT EXISTS idx_precursor_precursor_id ON PRECURSOR (ID);
-CREATE INDEX IF NOT EXISTS idx_feature_precursor_id ON FEATURE (PRECURSOR_ID);
-CREATE INDEX IF NOT EXISTS idx_feature_feature_id ON FEATURE (ID);
-CREATE INDEX IF NOT EXISTS idx_score_ms1_feature_id ON SCORE_MS1 (FEATURE_ID);
-CREATE INDEX IF NOT EXISTS idx_score_ms2_feature_id ON SCORE_MS2 (FEATURE_ID);
-CREATE INDEX IF NOT EXISTS idx_score_transition_feature_id ON SCORE_TRANSITION (FEATURE_ID);
-CREATE INDEX IF NOT EXISTS idx_score_transition_transition_id ON SCORE_TRANSITION (TRANSITION_ID);
-''')
-
         data = pd.read_sql_query('''
 SELECT FEATURE.ID AS FEATURE_ID,
        SCORE_MS2.PEP AS MS2_PEAKGROUP_PEP,
@@ -125,21 +139,12 @@ INNER JOIN
    WHERE TRANSITION.TYPE=''
      AND TRANSITION.DECOY=0) AS SCORE_TRANSITION ON FEATURE.ID = SCORE_TRANSITION.FEATURE_ID
 WHERE PRECURSOR.DECOY=0
-  AND SCORE_MS2.PEP < %s;
-''' % ipf_max_peakgroup_pep, con)
+  AND SCORE_MS2.PEP < %s
+  %s;
+''' % (ipf_max_peakgroup_pep, feature_filter), con, params=params)
 
     # do not use any precursor information
     else:
-        if not check_sqlite_table(con, "SCORE_MS2") or not check_sqlite_table(con, "SCORE_TRANSITION"):
-            raise click.ClickException("Apply scoring to MS2  and transition-level data before running IPF.")
-
-        con.executescript('''
-CREATE INDEX IF NOT EXISTS idx_precursor_precursor_id ON PRECURSOR (ID);
-CREATE INDEX IF NOT EXISTS idx_feature_precursor_id ON FEATURE (PRECURSOR_ID);
-CREATE INDEX IF NOT EXISTS idx_feature_feature_id ON FEATURE (ID);
-CREATE INDEX IF NOT EXISTS idx_score_ms2_feature_id ON SCORE_MS2 (FEATURE_ID);
-''')
-
         data = pd.read_sql_query('''
 SELECT FEATURE.ID AS FEATURE_ID,
        SCORE_MS2.PEP AS MS2_PEAKGROUP_PEP,
@@ -149,8 +154,9 @@ FROM PRECURSOR
 INNER JOIN FEATURE ON PRECURSOR.ID = FEATURE.PRECURSOR_ID
 INNER JOIN SCORE_MS2 ON FEATURE.ID = SCORE_MS2.FEATURE_ID
 WHERE PRECURSOR.DECOY=0
-  AND SCORE_MS2.PEP < %s;
-''' % ipf_max_peakgroup_pep, con)
+  AND SCORE_MS2.PEP < %s
+  %s;
+''' % (ipf_max_peakgroup_pep, feature_filter), con, params=params)
 
     data.columns = [col.lower() for col in data.columns]
     con.close()
@@ -158,216 +164,329 @@ WHERE PRECURSOR.DECOY=0
     return data
 
 
-def read_pyp_transition(path, ipf_max_transition_pep, ipf_h0):
+def read_pyp_transition(path, ipf_max_transition_pep, ipf_h0, feature_ids):
     click.echo("Info: Reading peptidoform-level data.")
     # only the evidence is restricted to ipf_max_transition_pep, the peptidoform-space is complete
-    con = sqlite3.connect(path)
-
-    con.executescript('''
-CREATE INDEX IF NOT EXISTS idx_transition_peptide_mapping_transition_id ON TRANSITION_PEPTIDE_MAPPING (TRANSITION_ID);
-CREATE INDEX IF NOT EXISTS idx_transition_id ON TRANSITION (ID);
-CREATE INDEX IF NOT EXISTS idx_score_transition_feature_id ON SCORE_TRANSITION (FEATURE_ID);
-CREATE INDEX IF NOT EXISTS idx_score_transition_transition_id ON SCORE_TRANSITION (TRANSITION_ID);
-''')
-
-    # transition-level evidence
-    evidence = pd.read_sql_query('''
-SELECT FEATURE_ID,
-       TRANSITION_ID,
-       PEP
-FROM SCORE_TRANSITION
+    con = connect_pending(path, ["SCORE_TRANSITION"])
+
+    # only the features passing precursor-level inference are read
+    con.execute('CREATE TEMP TABLE IPF_FEATURE (FEATURE_ID INTEGER PRIMARY KEY);')
+    con.executemany('INSERT OR IGNORE INTO temp.IPF_FEATURE VALUES (?);', ((int(feature_id),) for feature_id in feature_ids))
+
+    # transition-level evidence and peptidoform mapping in a single scan;
+    # transitions without peptidoform mapping are evidence against all peptidoforms
+    evidence, bitmask, peptidoforms = [], [], []
+    for data in pd.read_sql_query('''
+SELECT SCORE_TRANSITION.FEATURE_ID AS FEATURE_ID,
+       SCORE_TRANSITION.TRANSITION_ID AS TRANSITION_ID,
+       SCORE_TRANSITION.PEP AS PEP,
+       TRANSITION_PEPTIDE_MAPPING.PEPTIDE_ID AS PEPTIDE_ID
+FROM temp.IPF_FEATURE
+INNER JOIN SCORE_TRANSITION ON IPF_FEATURE.FEATURE_ID = SCORE_TRANSITION.FEATURE_ID
 INNER JOIN TRANSITION ON SCORE_TRANSITION.TRANSITION_ID = TRANSITION.ID
-WHERE TRANSITION.TYPE!=''
-  AND TRANSITION.DECOY=0
-  AND PEP < %s;
- ''' % ipf_max_transition_pep, con)
-    evidence.columns = [col.lower() for col in evidence.columns]
-
-    # transition-level bitmask
-    bitmask = pd.read_sql_query('''
-SELECT DISTINCT TRANSITION.ID AS TRANSITION_ID,
-                PEPTIDE_ID,
-                1 AS BMASK
-FROM TRANSITION
-INNER JOIN TRANSITION_PEPTIDE_MAPPING ON TRANSITION.ID = TRANSITION_PEPTIDE_MAPPING.TRANSITION_ID
+LEFT JOIN TRANSITION_PEPTIDE_MAPPING ON TRANSITION.ID = TRANSITION_PEPTIDE_MAPPING.TRANSITION_ID
 WHERE TRANSITION.TYPE!=''
   AND TRANSITION.DECOY=0;
-''', con)
-    bitmask.columns = [col.lower() for col in bitmask.columns]
+''', con, chunksize=1000000):
+        # reduce the chunks while reading to bound the memory
+        data.columns = [col.lower() for col in data.columns]
+        evidence.append(data.loc[data['pep'] < ipf_max_transition_pep, ['feature_id','transition_id','pep']].drop_duplicates(['feature_id','transition_id']))
 
-    # potential peptidoforms per feature
-    num_peptidoforms = pd.read_sql_query('''
-SELECT FEATURE_ID,
-       COUNT(DISTINCT PEPTIDE_ID) AS NUM_PEPTIDOFORMS
-FROM SCORE_TRANSITION
-INNER JOIN TRANSITION ON SCORE_TRANSITION.TRANSITION_ID = TRANSITION.ID
-INNER JOIN TRANSITION_PEPTIDE_MAPPING ON TRANSITION.ID = TRANSITION_PEPTIDE_MAPPING.TRANSITION_ID
-WHERE TRANSITION.TYPE!=''
-  AND TRANSITION.DECOY=0
-GROUP BY FEATURE_ID
-ORDER BY FEATURE_ID;
-''', con)
-    num_peptidoforms.columns = [col.lower() for col in num_peptidoforms.columns]
+        mapped = data.dropna(subset=['peptide_id']).astype({'peptide_id': np.int64})
+        bitmask.append(mapped[['transition_id','peptide_id']].drop_duplicates())
+        peptidoforms.append(mapped[['feature_id','peptide_id']].drop_duplicates())
+
+    con.close()
+
+    evidence = pd.concat(evidence, ignore_index=True).drop_duplicates(['feature_id','transition_id']).reset_index(drop=True)
+
+    # transition-level bitmask (of the transitions of the features)
+    bitmask = pd.concat(bitmask, ignore_index=True).drop_duplicates().assign(bmask=1).reset_index(drop=True)
 
     # peptidoform space per feature
-    peptidoforms = pd.read_sql_query('''
-SELECT DISTINCT FEATURE_ID,
-                PEPTIDE_ID
-FROM SCORE_TRANSITION
-INNER JOIN TRANSITION ON SCORE_TRANSITION.TRANSITION_ID = TRANSITION.ID
-INNER JOIN TRANSITION_PEPTIDE_MAPPING ON TRANSITION.ID = TRANSITION_PEPTIDE_MAPPING.TRANSITION_ID
-WHERE TRANSITION.TYPE!=''
-  AND TRANSITION.DECOY=0
-ORDER BY FEATURE_ID;
-''', con)
-    peptidoforms.columns = [col.lower() for col in peptidoforms.columns]
+    peptidoforms = pd.concat(peptidoforms, ignore_index=True).drop_duplicates().sort_values('feature_id', kind='mergesort').reset_index(drop=True)
 
-    con.close()
+    # potential peptidoforms per feature
+    peptidoforms['num_peptidoforms'] = peptidoforms.groupby('feature_id')['peptide_id'].transform('size')
 
     # add h0 (peptide_id: -1) to peptidoform-space if necessary
     if ipf_h0:
-        peptidoforms = pd.concat([peptidoforms, pd.DataFrame({'feature_id': peptidoforms['feature_id'].unique(), 'peptide_id': -1})])
+        h0 = peptidoforms[['feature_id','num_peptidoforms']].drop_duplicates('feature_id').assign(peptide_id=-1)
+        peptidoforms = pd.concat([peptidoforms, h0[['feature_id','peptide_id','num_peptidoforms']]], ignore_index=True)
 
-    # generate transition-peptidoform table
-    trans_pf = pd.merge(evidence, peptidoforms, how='outer', on='feature_id')
+    # the transition-peptidoform table (evidence x peptidoforms) is not
+    # generated, the likelihoods are computed from sparse matrices
+    return evidence, bitmask, peptidoforms
 
-    # apply bitmask
-    trans_pf_bm = pd.merge(trans_pf, bitmask, how='left', on=['transition_id','peptide_id']).fillna(0)
 
-    # append number of peptidoforms
-    data = pd.merge(trans_pf_bm, num_peptidoforms, how='inner', on='feature_id')
+def posterior_probabilities(feature_id, hypothesis, log_likelihood, prior):
+    # the hypotheses of a feature are contiguous and sorted
+    features = np.asarray(feature_id)
+    feature_start = np.r_[True, features[1:] != features[:-1]][:len(features)]
+    feature_starts = np.flatnonzero(feature_start)
+    feature_index = np.cumsum(feature_start) - 1
 
-    return data
+    with np.errstate(divide='ignore', invalid='ignore'):
+        log_likelihood_prior = log_likelihood + np.log(prior)
 
+        # compute likelihood sum per feature
+        likelihood_prior = np.exp(log_likelihood_prior)
+        likelihood_sum = np.bincount(feature_index, weights=np.where(np.isnan(likelihood_prior), 0, likelihood_prior))[feature_index]
 
-def prepare_precursor_bm(data):
-    # MS1-level precursors
-    ms1_precursor_data = data[['feature_id','ms2_peakgroup_pep','ms1_precursor_pep']].dropna(axis=0, how='any')
-    ms1_bm_data = pd.concat([pd.DataFrame({'feature_id': ms1_precursor_data['feature_id'], 'prior': 1-ms1_precursor_data['ms2_peakgroup_pep'], 'evidence': 1-ms1_precursor_data['ms1_precursor_pep'], 'hypothesis': True}), pd.DataFrame({'feature_id': ms1_precursor_data['feature_id'], 'prior': ms1_precursor_data['ms2_peakgroup_pep'], 'evidence': ms1_precursor_data['ms1_precursor_pep'], 'hypothesis': False})])
+        # compute posterior hypothesis probability, scaled by the maximum per feature
+        log_max = np.fmax.reduceat(log_likelihood_prior, feature_starts) if len(features) > 0 else np.empty(0)
+        scaled = np.exp(log_likelihood_prior - log_max[feature_index])
+        posterior = scaled / np.bincount(feature_index, weights=np.where(np.isnan(scaled), 0, scaled))[feature_index]
 
-    # MS2-level precursors
-    ms2_precursor_data = data[['feature_id','ms2_peakgroup_pep','ms2_precursor_pep']].dropna(axis=0, how='any')
-    ms2_bm_data = pd.concat([pd.DataFrame({'feature_id': ms2_precursor_data['feature_id'], 'prior': 1-ms2_precursor_data['ms2_peakgroup_pep'], 'evidence': 1-ms2_precursor_data['ms2_precursor_pep'], 'hypothesis': True}), pd.DataFrame({'feature_id': ms2_precursor_data['feature_id'], 'prior': ms2_precursor_data['ms2_peakgroup_pep'], 'evidence': ms2_precursor_data['ms2_precursor_pep'], 'hypothesis': False})])
+    pp_data = pd.DataFrame({'feature_id': feature_id,
+                            'hypothesis': hypothesis,
+                            'likelihood_prior': likelihood_prior,
+                            'likelihood_sum': likelihood_sum,
+                            'posterior': posterior})
 
-    # missing precursor data
-    missing_precursor_data = data[['feature_id','ms2_peakgroup_pep']].dropna(axis=0, how='any').drop_duplicates()
-    missing_bm_data = pd.concat([pd.DataFrame({'feature_id': missing_precursor_data['feature_id'], 'prior': 1-missing_precursor_data['ms2_peakgroup_pep'], 'evidence': 0, 'hypothesis': True}), pd.DataFrame({'feature_id': missing_precursor_data['feature_id'], 'prior': missing_precursor_data['ms2_peakgroup_pep'], 'evidence': 1, 'hypothesis': False})])
+    return pp_data.fillna(value = 0)
 
-    # combine precursor data
-    precursor_bm_data = pd.concat([ms1_bm_data, ms2_bm_data])
-    # append missing precursors if no MS1/MS2 evidence is available
-    precursor_bm_data = pd.concat([precursor_bm_data, missing_bm_data.loc[~missing_bm_data['feature_id'].isin(precursor_bm_data['feature_id'])]])
 
-    return(precursor_bm_data)
+def transition_log_likelihoods(evidence, bitmask, peptidoforms):
+    # the evidence of a transition is 1-pep for the peptidoforms of its bitmask
+    # and pep for all other peptidoforms of the feature. the log-likelihood of
+    # a feature and peptidoform is thus the sum of log(pep) over the feature's
+    # transitions plus log(1-pep)-log(pep) of the transitions mapping to the
+    # peptidoform, computed as sparse product (feature x transition) @
+    # (transition x peptidoform)
+    features = pd.Index(pd.unique(peptidoforms['feature_id']))
+    evidence = evidence[evidence['feature_id'].isin(features)]
+    transitions = pd.Index(pd.unique(pd.concat([evidence['transition_id'], bitmask['transition_id']])))
+    peptides = pd.Index(pd.unique(pd.concat([bitmask['peptide_id'], peptidoforms['peptide_id']])))
 
+    evidence_features = features.get_indexer(evidence['feature_id'])
+    evidence_transitions = transitions.get_indexer(evidence['transition_id'])
 
-def prepare_transition_bm(data):
-    # peptide_id = -1 indicates h0, i.e. the peak group is wrong!
-    # initialize priors
-    data.loc[data.peptide_id != -1, 'prior'] = (1-data.loc[data.peptide_id != -1, 'precursor_peakgroup_pep']) / data.loc[data.peptide_id != -1, 'num_peptidoforms'] # potential peptidoforms
-    data.loc[data.peptide_id == -1, 'prior'] = data.loc[data.peptide_id == -1, 'precursor_peakgroup_pep'] # h0
+    bitmask_matrix = sparse.csr_matrix((np.ones(len(bitmask.index)), (transitions.get_indexer(bitmask['transition_id']), peptides.get_indexer(bitmask['peptide_id']))), shape=(len(transitions), len(peptides)))
+    bitmask_matrix.sum_duplicates()
+    bitmask_matrix.data[:] = 1
 
-    # set evidence
-    data.loc[data.bmask == 1, 'evidence'] = (1-data.loc[data.bmask == 1, 'pep']) # we have evidence FOR this peptidoform or h0
-    data.loc[data.bmask == 0, 'evidence'] = data.loc[data.bmask == 0, 'pep'] # we have evidence AGAINST this peptidoform or h0
+    rows = features.get_indexer(peptidoforms['feature_id'])
+    cols = peptides.get_indexer(peptidoforms['peptide_id'])
 
-    data = data[['feature_id','num_peptidoforms','prior','evidence','peptide_id']]
-    data = data.rename(columns=lambda x: x.replace('peptide_id', 'hypothesis'))
+    def feature_sum(values):
+        return np.bincount(evidence_features, weights=values, minlength=len(features))[rows]
 
-    return data
+    def peptidoform_sum(values):
+        if len(rows) == 0:
+            # sparse fancy indexing does not return a dense result if empty
+            return np.zeros(0)
+        evidence_matrix = sparse.csr_matrix((values, (evidence_features, evidence_transitions)), shape=(len(features), len(transitions)))
+        return np.asarray((evidence_matrix * bitmask_matrix)[rows, cols]).ravel()
 
+    pep = evidence['pep'].values.astype(float)
+    with np.errstate(divide='ignore'):
+        log_pep = np.where(pep > 0, np.log(pep), 0)
+        log_inv_pep = np.where(pep < 1, np.log1p(-pep), 0)
 
-def apply_bm(data):
-    # compute likelihood * prior per feature & hypothesis
-    # all priors are identical but pandas DF multiplication requires aggregation, so we use min()
-    pp_data = (data.groupby(['feature_id',"hypothesis"])["evidence"].prod() * data.groupby(['feature_id',"hypothesis"])["prior"].min()).reset_index()
-    pp_data.columns = ['feature_id','hypothesis','likelihood_prior']
+    log_likelihood = feature_sum(log_pep) + peptidoform_sum(log_inv_pep - log_pep)
 
-    # compute likelihood sum per feature
-    pp_data['likelihood_sum'] = pp_data.groupby('feature_id')['likelihood_prior'].transform(np.sum)
+    # evidence of 0: pep = 0 against or pep = 1 for a peptidoform
+    zero = (feature_sum((pep == 0).astype(float)) - peptidoform_sum((pep == 0).astype(float)) > 0) | (peptidoform_sum((pep == 1).astype(float)) > 0)
+    # features without transition-level evidence have no support for any peptidoform
+    zero |= feature_sum(np.ones(len(pep))) == 0
+    log_likelihood[zero] = -np.inf
 
-    # compute posterior hypothesis probability
-    pp_data['posterior'] = pp_data['likelihood_prior'] / pp_data['likelihood_sum']
+    return log_likelihood
 
-    return pp_data.fillna(value = 0)
 
+def precursor_evidence(feature_codes, pep, num_features):
+    # number of distinct precursor PEPs per feature and the sums of their log
+    # evidence for the true (1-pep) and false (pep) hypotheses; the (feature,
+    # pep) pairs are deduplicated as complex numbers
+    distinct = ~pd.Series(feature_codes + 1j * pep).duplicated().values
+    feature_codes, pep = feature_codes[distinct], pep[distinct]
 
-def precursor_inference(data, ipf_ms1_scoring, ipf_ms2_scoring, ipf_max_precursor_pep, ipf_max_precursor_peakgroup_pep):
-    # prepare MS1-level precursor data
-    if ipf_ms1_scoring:
-        ms1_precursor_data = data[data['ms1_precursor_pep'] < ipf_max_precursor_pep][['feature_id','ms1_precursor_pep']].drop_duplicates()
-    else:
-        ms1_precursor_data = data[['feature_id']].drop_duplicates()
-        ms1_precursor_data['ms1_precursor_pep'] = np.nan
+    with np.errstate(divide='ignore'):
+        count = np.bincount(feature_codes, minlength=num_features)
+        log_true = np.bincount(feature_codes, weights=np.log(1 - pep), minlength=num_features)
+        log_false = np.bincount(feature_codes, weights=np.log(pep), minlength=num_features)
 
-    # prepare MS2-level precursor data
-    if ipf_ms2_scoring:
-        ms2_precursor_data = data[data['ms2_precursor_pep'] < ipf_max_precursor_pep][['feature_id','ms2_precursor_pep']].drop_duplicates()
-    else:
-        ms2_precursor_data = data[['feature_id']].drop_duplicates()
-        ms2_precursor_data['ms2_precursor_pep'] = np.nan
+    return count, log_true, log_false
 
-    # prepare MS2-level peak group data
-    ms2_pg_data = data[['feature_id','ms2_peakgroup_pep']].drop_duplicates()
 
-    if ipf_ms1_scoring or ipf_ms2_scoring:
-        # merge MS1- & MS2-level precursor and peak group data
-        precursor_data = ms2_precursor_data.merge(ms1_precursor_data, on=['feature_id'], how='outer').merge(ms2_pg_data, on=['feature_id'], how='outer')
+def precursor_inference(data, ipf_ms1_scoring, ipf_ms2_scoring, ipf_max_precursor_pep, ipf_max_precursor_peakgroup_pep):
+    # the precursor-level model has two hypotheses per feature and is computed
+    # in closed form on arrays indexed by feature
+    feature_codes, feature_ids = pd.factorize(data['feature_id'], sort=True)
 
-        # prepare precursor-level Bayesian model
-        click.echo("Info: Preparing precursor-level data.")
-        precursor_data_bm = prepare_precursor_bm(precursor_data)
+    # MS2-level peak group data
+    peakgroup_pep = np.empty(len(feature_ids))
+    peakgroup_pep[feature_codes] = data['ms2_peakgroup_pep'].values
 
-        # compute posterior precursor probability
+    if ipf_ms1_scoring or ipf_ms2_scoring:
+        # prepare MS1- & MS2-level precursor data
+        click.echo("Info: Preparing precursor-level data.")
+        evidence = []
+        for precursor_scoring, column in [(ipf_ms1_scoring, 'ms1_precursor_pep'), (ipf_ms2_scoring, 'ms2_precursor_pep')]:
+            pep = data[column].values.astype(float)
+            if precursor_scoring:
+                with np.errstate(invalid='ignore'):
+                    valid = pep < ipf_max_precursor_pep
+            else:
+                valid = np.zeros(len(pep), dtype=bool)
+            evidence.append(precursor_evidence(feature_codes[valid], pep[valid], len(feature_ids)))
+        (ms1_count, ms1_log_true, ms1_log_false), (ms2_count, ms2_log_true, ms2_log_false) = evidence
+
+        # compute posterior precursor probability; the evidence is combined for
+        # all pairs of MS1 and MS2 precursor PEPs of a feature
         click.echo("Info: Conducting precursor-level inference.")
-        prec_pp_data = apply_bm(precursor_data_bm)
-        prec_pp_data['precursor_peakgroup_pep'] = 1 - prec_pp_data['posterior']
-
-        inferred_precursors = prec_pp_data[prec_pp_data['hypothesis']][['feature_id','precursor_peakgroup_pep']]
+        ms1_weight = np.maximum(ms2_count, 1)
+        ms2_weight = np.maximum(ms1_count, 1)
+        # peak groups without precursor-level evidence cannot be confirmed
+        log_true = np.where((ms1_count == 0) & (ms2_count == 0), -np.inf, ms1_weight * ms1_log_true + ms2_weight * ms2_log_true)
+        log_false = ms1_weight * ms1_log_false + ms2_weight * ms2_log_false
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            log_odds = np.log(1 - peakgroup_pep) + log_true - np.log(peakgroup_pep) - log_false
+        precursor_peakgroup_pep = 1 - expit(log_odds)
     else:
         # no precursor-level data on MS1 and/or MS2 should be used; use peak group-level data
         click.echo("Info: Skipping precursor-level inference.")
-        inferred_precursors = ms2_pg_data.rename(columns=lambda x: x.replace('ms2_peakgroup_pep', 'precursor_peakgroup_pep'))
+        precursor_peakgroup_pep = peakgroup_pep
+
+    inferred_precursors = pd.DataFrame({'feature_id': feature_ids, 'precursor_peakgroup_pep': precursor_peakgroup_pep})
+
+    with np.errstate(invalid='ignore'):
+        return inferred_precursors[inferred_precursors['precursor_peakgroup_pep'].values < ipf_max_precursor_peakgroup_pep]
+
+
+def peptidoform_classes(bitmask):
+    # peptidoforms with identical transition bitmasks cannot be distinguished by
+    # the transition-level evidence and form an equivalence class
+    transition_codes, transition_ids = pd.factorize(bitmask['transition_id'])
+    peptide_codes, peptide_ids = pd.factorize(bitmask['peptide_id'])
+
+    matrix = sparse.csc_matrix((np.ones(len(bitmask.index)), (transition_codes, peptide_codes)), shape=(len(transition_ids), len(peptide_ids)))
+    matrix.sum_duplicates()
+    keys = [matrix.indices[matrix.indptr[j]:matrix.indptr[j + 1]].tobytes() for j in range(matrix.shape[1])]
+
+    return pd.Series(pd.factorize(keys)[0], index=peptide_ids)
+
+
+def prune_hypotheses(data, class_ids, ipf_max_pruned_posterior):
+    # the least probable peptidoform classes of each feature are pruned while
+    # their total posterior m stays below ipf_max_pruned_posterior; the
+    # remaining posteriors p are renormalized and change by p * m / (1 - m).
+    # returns the pruned data, the number of pruned and candidate hypotheses
+    # and the maximum change
+    candidates = (data['hypothesis'] != -1).values
+    classes = data[candidates][['feature_id']].assign(class_id=class_ids[candidates], posterior=data['posterior'].values[candidates])
+    classes = classes.groupby(['feature_id','class_id'], sort=False)['posterior'].sum().reset_index().sort_values(['feature_id','posterior'], kind='mergesort')
+    classes['pruned'] = classes.groupby('feature_id')['posterior'].cumsum() < ipf_max_pruned_posterior
 
-    inferred_precursors = inferred_precursors[(inferred_precursors['precursor_peakgroup_pep'] < ipf_max_precursor_peakgroup_pep)]
+    pruned = data[['feature_id']].assign(class_id=class_ids).merge(classes[classes['pruned']][['feature_id','class_id']].assign(pruned=True), how='left', on=['feature_id','class_id'])['pruned'].notnull().values & candidates
+    features = pd.factorize(data['feature_id'])[0]
+    mass = np.bincount(features, weights=np.where(pruned, data['posterior'], 0))[features]
 
-    return inferred_precursors
+    posterior = data['posterior'].values / (1 - mass)
+    change = (posterior - data['posterior'].values)[candidates & ~pruned]
 
+    return data.assign(posterior=posterior)[~pruned].reset_index(drop=True), int(pruned.sum()), int(candidates.sum()), float(np.nanmax(change, initial=0))
 
-def peptidoform_inference(transition_table, precursor_data, ipf_grouped_fdr):
-    transition_table = pd.merge(transition_table, precursor_data, on='feature_id')
+
+def peptidoform_inference(transition_data, precursor_data, ipf_max_pruned_posterior):
+    evidence, bitmask, peptidoforms = transition_data
+    peptidoforms = pd.merge(peptidoforms, precursor_data, on='feature_id').sort_values(['feature_id','peptide_id']).reset_index(drop=True)
 
     # compute transition posterior probabilities
     click.echo("Info: Preparing peptidoform-level data.")
-    transition_data_bm = prepare_transition_bm(transition_table)
+    # peptide_id = -1 indicates h0, i.e. the peak group is wrong!
+    prior = np.where(peptidoforms['peptide_id'] != -1, (1-peptidoforms['precursor_peakgroup_pep']) / peptidoforms['num_peptidoforms'], peptidoforms['precursor_peakgroup_pep'])
+
+    log_likelihood = transition_log_likelihoods(evidence, bitmask, peptidoforms)
 
     # compute posterior peptidoform probability
     click.echo("Info: Conducting peptidoform-level inference.")
-    pf_pp_data = apply_bm(transition_data_bm)
-    pf_pp_data['pep'] = 1 - pf_pp_data['posterior']
-
-    # compute model-based FDR
-    if ipf_grouped_fdr:
-        pf_pp_data['qvalue'] = pd.merge(pf_pp_data, transition_data_bm[['feature_id', 'num_peptidoforms']].drop_duplicates(), on=['feature_id'], how='inner').groupby('num_peptidoforms')['pep'].transform(compute_model_fdr)
-    else:
-        pf_pp_data['qvalue'] = compute_model_fdr(pf_pp_data['pep'])
+    pf_pp_data = posterior_probabilities(peptidoforms['feature_id'].values, peptidoforms['peptide_id'].values, log_likelihood, prior)
 
     # merge precursor-level data with UIS data
-    result = pf_pp_data.merge(precursor_data[['feature_id','precursor_peakgroup_pep']].drop_duplicates(), on=['feature_id'], how='inner')
+    pf_pp_data['precursor_peakgroup_pep'] = peptidoforms['precursor_peakgroup_pep'].values
+    pf_pp_data['num_peptidoforms'] = peptidoforms['num_peptidoforms'].values
 
-    return result
+    # peptidoforms with identical bitmasks are pruned together; h0 (and any
+    # peptidoform without transitions) has an empty bitmask
+    num_pruned, num_candidates, max_change = 0, 0, 0.0
+    if ipf_max_pruned_posterior > 0:
+        class_ids = peptidoform_classes(bitmask).reindex(peptidoforms['peptide_id'].values).fillna(-1).astype(np.int64).values
+        pf_pp_data, num_pruned, num_candidates, max_change = prune_hypotheses(pf_pp_data, class_ids, ipf_max_pruned_posterior)
 
+    pf_pp_data['pep'] = 1 - pf_pp_data['posterior']
 
-def infer_peptidoforms(infile, outfile, ipf_ms1_scoring, ipf_ms2_scoring, ipf_h0, ipf_grouped_fdr, ipf_max_precursor_pep, ipf_max_peakgroup_pep, ipf_max_precursor_peakgroup_pep, ipf_max_transition_pep):
-    click.echo("Info: Starting IPF (Inference of PeptidoForms).")
+    return pf_pp_data, num_pruned, num_candidates, max_change
 
+
+def infer_partition(infile, feature_range, ipf_ms1_scoring, ipf_ms2_scoring, ipf_h0, ipf_max_precursor_pep, ipf_max_peakgroup_pep, ipf_max_precursor_peakgroup_pep, ipf_max_transition_pep, ipf_max_pruned_posterior):
     # precursor level
-    precursor_table = read_pyp_peakgroup_precursor(infile, ipf_max_peakgroup_pep, ipf_ms1_scoring, ipf_ms2_scoring)
+    precursor_table = read_pyp_peakgroup_precursor(infile, ipf_max_peakgroup_pep, ipf_ms1_scoring, ipf_ms2_scoring, feature_range)
     precursor_data = precursor_inference(precursor_table, ipf_ms1_scoring, ipf_ms2_scoring, ipf_max_precursor_pep, ipf_max_precursor_peakgroup_pep)
 
     # peptidoform level
-    peptidoform_table = read_pyp_transition(infile, ipf_max_transition_pep, ipf_h0)
-    peptidoform_data = peptidoform_inference(peptidoform_table, precursor_data, ipf_grouped_fdr)
+    transition_data = read_pyp_transition(infile, ipf_max_transition_pep, ipf_h0, precursor_data['feature_id'].values)
+    peptidoform_data, num_pruned, num_candidates, max_change = peptidoform_inference(transition_data, precursor_data, ipf_max_pruned_posterior)
+
+    return peptidoform_data[['feature_id','hypothesis','precursor_peakgroup_pep','pep','num_peptidoforms']], num_pruned, num_candidates, max_change
+
+
+def feature_partitions(infile, partition_size, threads):
+    # FEATURE_ID ranges of (at most) partition_size features each
+    con = sqlite3.connect(infile)
+    feature_ids = pd.read_sql_query("SELECT ID FROM FEATURE ORDER BY ID;", con)['ID'].values
+    con.close()
+
+    if partition_size == 0:
+        partition_size = max(1, int(np.ceil(len(feature_ids) / float(threads))))
+
+    return [(int(feature_ids[i]), int(feature_ids[min(i + partition_size, len(feature_ids)) - 1])) for i in range(0, len(feature_ids), partition_size)]
+
+
+def infer_peptidoforms(infile, outfile, ipf_ms1_scoring, ipf_ms2_scoring, ipf_h0, ipf_grouped_fdr, ipf_max_precursor_pep, ipf_max_peakgroup_pep, ipf_max_precursor_peakgroup_pep, ipf_max_transition_pep, ipf_max_pruned_posterior, partition_size, threads):
+    click.echo("Info: Starting IPF (Inference of PeptidoForms).")
+
+    # a single read takes the pending score tables of the invocation from
+    # memory; partitions (and their worker processes) query them on disk
+    partitioned = partition_size > 0 or threads > 1
+    if partitioned:
+        flush_artifacts(infile, IPF_SCORE_TABLES)
+
+    prepare_ipf_input(infile, ipf_ms1_scoring, ipf_ms2_scoring)
+
+    if not partitioned:
+        results = [infer_partition(infile, None, ipf_ms1_scoring, ipf_ms2_scoring, ipf_h0, ipf_max_precursor_pep, ipf_max_peakgroup_pep, ipf_max_precursor_peakgroup_pep, ipf_max_transition_pep, ipf_max_pruned_posterior)]
+    else:
+        # features are independent in the Bayesian model, the partitions are
+        # read and inferred separately
+        partitions = feature_partitions(infile, partition_size, threads) or [None]
+        click.echo("Info: Processing %s partitions of features." % len(partitions))
+
+        args = [(infile, partition, ipf_ms1_scoring, ipf_ms2_scoring, ipf_h0, ipf_max_precursor_pep, ipf_max_peakgroup_pep, ipf_max_precursor_peakgroup_pep, ipf_max_transition_pep, ipf_max_pruned_posterior) for partition in partitions]
+
+        if threads == 1 or len(args) < 2:
+            results = [infer_partition(*a) for a in args]
+        else:
+            pool = multiprocessing.Pool(processes=min(threads, len(args)), initializer=init_fold_worker, initargs=(1, ))
+            try:
+                results = pool.starmap(infer_partition, args)
+            finally:
+                pool.close()
+                pool.join()
+
+    # the partitions report their pruning, summarized over all partitions
+    partition_data, num_pruned, num_candidates, max_change = zip(*results)
+    peptidoform_data = pd.concat(partition_data, ignore_index=True)
+    if ipf_max_pruned_posterior > 0:
+        click.echo("Info: Pruned %s of %s peptidoform hypotheses (maximum PEP change: %.2e)." % (sum(num_pruned), sum(num_candidates), max(max_change)))
+
+    # compute model-based FDR over all partitions
+    if ipf_grouped_fdr:
+        peptidoform_data['qvalue'] = peptidoform_data.groupby('num_peptidoforms')['pep'].transform(compute_model_fdr)
+    else:
+        peptidoform_data['qvalue'] = compute_model_fdr(peptidoform_data['pep'])
 
     # finalize results and write to table
     click.echo("Info: Storing results.")
@@ -375,9 +494,6 @@ def infer_peptidoforms(infile, outfile, ipf_ms1_scoring, ipf_ms2_scoring, ipf_h0
     peptidoform_data.columns = ['FEATURE_ID','PEPTIDE_ID','PRECURSOR_PEAKGROUP_PEP','QVALUE','PEP']
 
     if infile != outfile:
-        copyfile(infile, outfile)
-
-    con = sqlite3.connect(outfile)
+        copy_osw(infile, outfile)
 
-    peptidoform_data.to_sql("SCORE_IPF", con, index=False, if_exists='replace')
-    con.close()
+    write_table(outfile, "SCORE_IPF", peptidoform_data)
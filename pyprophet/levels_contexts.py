@@ -4,16 +4,21 @@ import click
 import pandas as pd
 import numpy as np
 import sqlite3
+import multiprocessing
 
 from .stats import error_statistics, lookup_values_from_error_table, final_err_table, summary_err_table
+from .optimized import chromatogram_hypotheses
 from .report import save_report
+from .parallel import init_fold_worker
+from .protein_groups import protein_groups
 from shutil import copyfile
-from .data_handling import check_sqlite_table
+from .data_handling import check_sqlite_table, check_sqlite_column
+from .artifacts import connect, pending_table, copy_osw, write_table, flush_artifacts
 
 
-def statistics_report(data, outfile, context, analyte, parametric, pfdr, pi0_lambda, pi0_method, pi0_smooth_df, pi0_smooth_log_pi0, lfdr_truncate, lfdr_monotone, lfdr_transformation, lfdr_adj, lfdr_eps):
+def statistics_report(data, outfile, context, analyte, parametric, pfdr, pi0_lambda, pi0_method, pi0_smooth_df, pi0_smooth_log_pi0, lfdr_truncate, lfdr_monotone, lfdr_transformation, lfdr_adj, lfdr_eps, lfdr_density, report=True):
 
-    error_stat, pi0 = error_statistics(data[data.decoy==0]['score'], data[data.decoy==1]['score'], parametric, pfdr, pi0_lambda, pi0_method, pi0_smooth_df, pi0_smooth_log_pi0, True, lfdr_truncate, lfdr_monotone, lfdr_transformation, lfdr_adj, lfdr_eps)
+    error_stat, pi0 = error_statistics(data[data.decoy==0]['score'], data[data.decoy==1]['score'], parametric, pfdr, pi0_lambda, pi0_method, pi0_smooth_df, pi0_smooth_log_pi0, True, lfdr_truncate, lfdr_monotone, lfdr_transformation, lfdr_adj, lfdr_eps, lfdr_density)
 
     stat_table = final_err_table(error_stat)
     summary_table = summary_err_table(error_stat)
@@ -33,171 +38,363 @@ def statistics_report(data, outfile, context, analyte, parametric, pfdr, pi0_lam
         outfile = outfile + "_" + str(data['run_id'].unique()[0])
 
     # export PDF report
-    save_report(outfile + "_" + context + "_" + analyte + ".pdf", outfile + ": " + context + " " + analyte + "-level error-rate control", data[data.decoy==1]["score"], data[data.decoy==0]["score"], stat_table["cutoff"], stat_table["svalue"], stat_table["qvalue"], data[data.decoy==0]["p_value"], pi0)
+    if report:
+        save_report(outfile + "_" + context + "_" + analyte + ".pdf", outfile + ": " + context + " " + analyte + "-level error-rate control", data[data.decoy==1]["score"], data[data.decoy==0]["score"], stat_table["cutoff"], stat_table["svalue"], stat_table["qvalue"], data[data.decoy==0]["p_value"], pi0)
 
     return(data)
 
 
-def infer_proteins(infile, outfile, context, parametric, pfdr, pi0_lambda, pi0_method, pi0_smooth_df, pi0_smooth_log_pi0, lfdr_truncate, lfdr_monotone, lfdr_transformation, lfdr_adj, lfdr_eps):
+def run_specific_statistics(data, outfile, analyte, parametric, pfdr, pi0_lambda, pi0_method, pi0_smooth_df, pi0_smooth_log_pi0, lfdr_truncate, lfdr_monotone, lfdr_transformation, lfdr_adj, lfdr_eps, lfdr_density, threads, run_reports):
+    # the runs are independent and are distributed over a process pool
+    args = [(run, outfile, 'run-specific', analyte, parametric, pfdr, pi0_lambda, pi0_method, pi0_smooth_df, pi0_smooth_log_pi0, lfdr_truncate, lfdr_monotone, lfdr_transformation, lfdr_adj, lfdr_eps, lfdr_density, run_reports) for run_id, run in data.groupby('run_id')]
 
-    con = sqlite3.connect(infile)
+    if threads == 1 or len(args) < 2:
+        results = [statistics_report(*a) for a in args]
+    else:
+        pool = multiprocessing.Pool(processes=min(threads, len(args)), initializer=init_fold_worker, initargs=(1, ))
+        try:
+            results = pool.starmap(statistics_report, args)
+        finally:
+            pool.close()
+            pool.join()
+
+    # same row order as the input, as of data.groupby('run_id').apply()
+    return pd.concat(results).reindex(data.index).reset_index(drop=True)
+
+
+def store_context_table(outfile, table, df, contexts):
+    # the table holds the results of all contexts, only 'contexts' are replaced
+    pending = pending_table(outfile, table)
+    if pending is not None:
+        df = pd.concat([pending[~pending.CONTEXT.isin(contexts)], df], ignore_index=True)
+    else:
+        con = sqlite3.connect(outfile)
+        if check_sqlite_table(con, table):
+            df = pd.concat([pd.read_sql_query('SELECT * FROM %s WHERE CONTEXT NOT IN (%s)' % (table, ','.join(['"%s"' % context for context in contexts])), con), df], ignore_index=True)
+        con.close()
 
-    if not check_sqlite_table(con, "SCORE_MS2"):
-        raise click.ClickException("Apply scoring to MS2-level data before running protein-level scoring.")
+    write_table(outfile, table, df, dtype={"RUN_ID": "INTEGER"})
 
-    if context in ['global','experiment-wide','run-specific']:
+
+def infer_contexts(data, outfile, context, analyte, parametric, pfdr, pi0_lambda, pi0_method, pi0_smooth_df, pi0_smooth_log_pi0, lfdr_truncate, lfdr_monotone, lfdr_transformation, lfdr_adj, lfdr_eps, lfdr_density, threads, run_reports):
+    # 'data' holds the top scoring peak group of each analyte and run, the
+    # contexts are derived from this table without querying the file again
+    if context == 'all':
+        contexts = ['run-specific', 'experiment-wide', 'global']
+    else:
+        contexts = [context]
+
+    tables = []
+    for context in contexts:
         if context == 'global':
-            run_id = 'NULL'
-            group_id = 'PROTEIN.ID'
+            context_data = data.loc[data.groupby(analyte + '_id')['score'].idxmax()]
+            context_data = context_data.assign(run_id=np.nan)
         else:
-            run_id = 'RUN_ID'
-            group_id = 'RUN_ID || "_" || PROTEIN.ID'
+            context_data = data
 
-        con.executescript('''
-CREATE INDEX IF NOT EXISTS idx_peptide_protein_mapping_protein_id ON PEPTIDE_PROTEIN_MAPPING (PROTEIN_ID);
-CREATE INDEX IF NOT EXISTS idx_peptide_protein_mapping_peptide_id ON PEPTIDE_PROTEIN_MAPPING (PEPTIDE_ID);
+        context_data = context_data.sort_values('score', ascending=False, kind='mergesort').reset_index(drop=True)
+        context_data = context_data.assign(context=context)
+
+        if context == 'run-specific':
+            tables.append(run_specific_statistics(context_data, outfile, analyte, parametric, pfdr, pi0_lambda, pi0_method, pi0_smooth_df, pi0_smooth_log_pi0, lfdr_truncate, lfdr_monotone, lfdr_transformation, lfdr_adj, lfdr_eps, lfdr_density, threads, run_reports))
+        else:
+            tables.append(statistics_report(context_data, outfile, context, analyte, parametric, pfdr, pi0_lambda, pi0_method, pi0_smooth_df, pi0_smooth_log_pi0, lfdr_truncate, lfdr_monotone, lfdr_transformation, lfdr_adj, lfdr_eps, lfdr_density))
+
+    df = pd.concat(tables, ignore_index=True)[['context','run_id',analyte + '_id','score','p_value','q_value','pep']]
+    df.columns = ['CONTEXT','RUN_ID',analyte.upper() + '_ID','SCORE','PVALUE','QVALUE','PEP']
+
+    return df, contexts
+
+
+def top_peakgroup_filter(con):
+    # only the top-ranking peak group contributes to MAX(SCORE); reduced files
+    # contain the top-ranking peak groups only and have no RANK column
+    if check_sqlite_column(con, "SCORE_MS2", "RANK"):
+        return "WHERE RANK = 1"
+    return ""
+
+
+def library_checksum(con):
+    # cheap content checksum of the peptide-protein mapping of the library
+    return "%d:%r:%r:%r" % con.execute('SELECT COUNT(*), TOTAL(PEPTIDE_ID), TOTAL(PROTEIN_ID), TOTAL(PEPTIDE_ID * PROTEIN_ID) FROM PEPTIDE_PROTEIN_MAPPING').fetchone()
+
+
+def cache_proteotypic_peptides(con):
+    """ Create the PYPROPHET_PROTEOTYPIC table mapping proteotypic peptides to
+    their protein, unless it is present and the library is unchanged. """
+
+    checksum = library_checksum(con)
+
+    if check_sqlite_table(con, "PYPROPHET_PROTEOTYPIC") and check_sqlite_table(con, "PYPROPHET_CHECKSUM"):
+        cached = con.execute('SELECT CHECKSUM FROM PYPROPHET_CHECKSUM WHERE TABLE_NAME = "PYPROPHET_PROTEOTYPIC"').fetchone()
+        if cached is not None and cached[0] == checksum:
+            return
+
+    click.echo("Info: Caching proteotypic peptides.")
+    con.executescript('''
+DROP TABLE IF EXISTS PYPROPHET_PROTEOTYPIC;
+CREATE TABLE PYPROPHET_PROTEOTYPIC AS
+SELECT PEPTIDE_ID,
+       MIN(PROTEIN_ID) AS PROTEIN_ID
+FROM PEPTIDE_PROTEIN_MAPPING
+GROUP BY PEPTIDE_ID
+HAVING COUNT(*) == 1;
+CREATE INDEX idx_pyprophet_proteotypic_peptide_id ON PYPROPHET_PROTEOTYPIC (PEPTIDE_ID);
+CREATE TABLE IF NOT EXISTS PYPROPHET_CHECKSUM (TABLE_NAME TEXT PRIMARY KEY, CHECKSUM TEXT);
+''')
+    con.execute('INSERT OR REPLACE INTO PYPROPHET_CHECKSUM VALUES ("PYPROPHET_PROTEOTYPIC", ?)', (checksum,))
+    con.commit()
+
+
+def read_protein_scores(con):
+
+    cache_proteotypic_peptides(con)
+
+    con.executescript('''
 CREATE INDEX IF NOT EXISTS idx_peptide_peptide_id ON PEPTIDE (ID);
-CREATE INDEX IF NOT EXISTS idx_precursor_peptide_mapping_peptide_id ON PRECURSOR_PEPTIDE_MAPPING (PEPTIDE_ID);
 CREATE INDEX IF NOT EXISTS idx_precursor_peptide_mapping_precursor_id ON PRECURSOR_PEPTIDE_MAPPING (PRECURSOR_ID);
 CREATE INDEX IF NOT EXISTS idx_precursor_precursor_id ON PRECURSOR (ID);
-CREATE INDEX IF NOT EXISTS idx_feature_precursor_id ON FEATURE (PRECURSOR_ID);
+CREATE INDEX IF NOT EXISTS idx_protein_protein_id ON PROTEIN (ID);
 CREATE INDEX IF NOT EXISTS idx_feature_feature_id ON FEATURE (ID);
-CREATE INDEX IF NOT EXISTS idx_score_ms2_feature_id ON SCORE_MS2 (FEATURE_ID);
 ''')
 
-        data = pd.read_sql_query('''
-SELECT %s AS RUN_ID,
-       %s AS GROUP_ID,
+    # aggregate the top peak groups to peptides first and map these to
+    # proteins by their proteotypic peptides afterwards
+    data = pd.read_sql_query('''
+SELECT RUN_ID,
        PROTEIN.ID AS PROTEIN_ID,
-       PRECURSOR.DECOY AS DECOY,
-       SCORE,
-       "%s" AS CONTEXT
-FROM PROTEIN
-INNER JOIN
-  (SELECT PEPTIDE_PROTEIN_MAPPING.PEPTIDE_ID AS PEPTIDE_ID,
-          PROTEIN_ID
+       PEPTIDE_SCORE.DECOY AS DECOY,
+       MAX(SCORE) AS SCORE
+FROM
+  (SELECT RUN_ID,
+          PRECURSOR_PEPTIDE_MAPPING.PEPTIDE_ID AS PEPTIDE_ID,
+          PRECURSOR.DECOY AS DECOY,
+          MAX(SCORE) AS SCORE
    FROM
-     (SELECT PEPTIDE_ID,
-             COUNT(*) AS NUM_PROTEINS
-      FROM PEPTIDE_PROTEIN_MAPPING
-      GROUP BY PEPTIDE_ID) AS PROTEINS_PER_PEPTIDE
-   INNER JOIN PEPTIDE_PROTEIN_MAPPING ON PROTEINS_PER_PEPTIDE.PEPTIDE_ID = PEPTIDE_PROTEIN_MAPPING.PEPTIDE_ID
-   WHERE NUM_PROTEINS == 1) AS PEPTIDE_PROTEIN_MAPPING ON PROTEIN.ID = PEPTIDE_PROTEIN_MAPPING.PROTEIN_ID
-INNER JOIN PEPTIDE ON PEPTIDE_PROTEIN_MAPPING.PEPTIDE_ID = PEPTIDE.ID
-INNER JOIN PRECURSOR_PEPTIDE_MAPPING ON PEPTIDE.ID = PRECURSOR_PEPTIDE_MAPPING.PEPTIDE_ID
-INNER JOIN PRECURSOR ON PRECURSOR_PEPTIDE_MAPPING.PRECURSOR_ID = PRECURSOR.ID
-INNER JOIN FEATURE ON PRECURSOR.ID = FEATURE.PRECURSOR_ID
-INNER JOIN SCORE_MS2 ON FEATURE.ID = SCORE_MS2.FEATURE_ID
-GROUP BY GROUP_ID
-HAVING MAX(SCORE)
-ORDER BY SCORE DESC
-''' % (run_id, group_id, context), con)
-    else:
-        raise click.ClickException("Unspecified context selected.")
+     (SELECT FEATURE_ID,
+             SCORE
+      FROM SCORE_MS2 %s) AS SCORE_MS2
+   INNER JOIN FEATURE ON SCORE_MS2.FEATURE_ID = FEATURE.ID
+   INNER JOIN PRECURSOR ON FEATURE.PRECURSOR_ID = PRECURSOR.ID
+   INNER JOIN PRECURSOR_PEPTIDE_MAPPING ON PRECURSOR.ID = PRECURSOR_PEPTIDE_MAPPING.PRECURSOR_ID
+   GROUP BY RUN_ID, PRECURSOR_PEPTIDE_MAPPING.PEPTIDE_ID, PRECURSOR.DECOY) AS PEPTIDE_SCORE
+INNER JOIN PEPTIDE ON PEPTIDE_SCORE.PEPTIDE_ID = PEPTIDE.ID
+INNER JOIN PYPROPHET_PROTEOTYPIC ON PEPTIDE.ID = PYPROPHET_PROTEOTYPIC.PEPTIDE_ID
+INNER JOIN PROTEIN ON PYPROPHET_PROTEOTYPIC.PROTEIN_ID = PROTEIN.ID
+GROUP BY RUN_ID, PROTEIN.ID, PEPTIDE_SCORE.DECOY
+''' % top_peakgroup_filter(con), con)
+
+    data.columns = [col.lower() for col in data.columns]
+
+    return data
+
+
+def read_peptide_scores(con):
+
+    con.executescript('''
+CREATE INDEX IF NOT EXISTS idx_peptide_peptide_id ON PEPTIDE (ID);
+CREATE INDEX IF NOT EXISTS idx_precursor_peptide_mapping_precursor_id ON PRECURSOR_PEPTIDE_MAPPING (PRECURSOR_ID);
+CREATE INDEX IF NOT EXISTS idx_precursor_precursor_id ON PRECURSOR (ID);
+CREATE INDEX IF NOT EXISTS idx_feature_feature_id ON FEATURE (ID);
+''')
+
+    data = pd.read_sql_query('''
+SELECT RUN_ID,
+       PEPTIDE.ID AS PEPTIDE_ID,
+       PRECURSOR.DECOY AS DECOY,
+       MAX(SCORE) AS SCORE
+FROM
+  (SELECT FEATURE_ID,
+          SCORE
+   FROM SCORE_MS2 %s) AS SCORE_MS2
+INNER JOIN FEATURE ON SCORE_MS2.FEATURE_ID = FEATURE.ID
+INNER JOIN PRECURSOR ON FEATURE.PRECURSOR_ID = PRECURSOR.ID
+INNER JOIN PRECURSOR_PEPTIDE_MAPPING ON PRECURSOR.ID = PRECURSOR_PEPTIDE_MAPPING.PRECURSOR_ID
+INNER JOIN PEPTIDE ON PRECURSOR_PEPTIDE_MAPPING.PEPTIDE_ID = PEPTIDE.ID
+GROUP BY RUN_ID, PEPTIDE.ID, PRECURSOR.DECOY
+''' % top_peakgroup_filter(con), con)
 
     data.columns = [col.lower() for col in data.columns]
+
+    return data
+
+
+def read_protein_group_scores(con, grouping):
+
+    mapping = pd.read_sql_query('''
+SELECT PEPTIDE_ID,
+       PROTEIN_ID
+FROM PEPTIDE_PROTEIN_MAPPING
+INNER JOIN PROTEIN ON PEPTIDE_PROTEIN_MAPPING.PROTEIN_ID = PROTEIN.ID
+''', con)
+    mapping.columns = [col.lower() for col in mapping.columns]
+
+    peptides, members = protein_groups(mapping, grouping)
+    click.echo("Info: Grouped %s proteins into %s protein groups." % (len(members.index), members['group_id'].nunique()))
+
+    # shared peptides contribute to a group if all their proteins are members
+    data = pd.merge(read_peptide_scores(con), peptides, on='peptide_id')
+    data = data.groupby(['run_id','group_id','decoy'])['score'].max().reset_index()
+    data = data.rename(columns={'group_id': 'protein_id'})
+
+    return data, members
+
+
+def infer_proteins(infile, outfile, context, grouping, parametric, pfdr, pi0_lambda, pi0_method, pi0_smooth_df, pi0_smooth_log_pi0, lfdr_truncate, lfdr_monotone, lfdr_transformation, lfdr_adj, lfdr_eps, lfdr_density, threads, run_reports):
+
+    if context not in ['global','experiment-wide','run-specific','all']:
+        raise click.ClickException("Unspecified context selected.")
+
+    if grouping not in ['proteotypic','indistinguishable','components']:
+        raise click.ClickException("Unspecified protein grouping selected.")
+
+    con = connect(infile, ["SCORE_MS2"])
+
+    if not check_sqlite_table(con, "SCORE_MS2"):
+        raise click.ClickException("Apply scoring to MS2-level data before running protein-level scoring.")
+
+    if grouping == 'proteotypic':
+        data = read_protein_scores(con)
+        members = None
+    else:
+        data, members = read_protein_group_scores(con, grouping)
     con.close()
 
-    if context == 'run-specific':
-        data = data.groupby('run_id').apply(statistics_report, outfile, context, "protein", parametric, pfdr, pi0_lambda, pi0_method, pi0_smooth_df, pi0_smooth_log_pi0, lfdr_truncate, lfdr_monotone, lfdr_transformation, lfdr_adj, lfdr_eps).reset_index()
+    df, contexts = infer_contexts(data, outfile, context, "protein", parametric, pfdr, pi0_lambda, pi0_method, pi0_smooth_df, pi0_smooth_log_pi0, lfdr_truncate, lfdr_monotone, lfdr_transformation, lfdr_adj, lfdr_eps, lfdr_density, threads, run_reports)
 
-    elif context in ['global', 'experiment-wide']:
-        data = statistics_report(data, outfile, context, "protein", parametric, pfdr, pi0_lambda, pi0_method, pi0_smooth_df, pi0_smooth_log_pi0, lfdr_truncate, lfdr_monotone, lfdr_transformation, lfdr_adj, lfdr_eps)
+    # the error rates of a protein group apply to each of its members
+    if members is not None:
+        members.columns = ['GROUP_ID','PROTEIN_ID']
+        df = pd.merge(df.rename(columns={'PROTEIN_ID': 'GROUP_ID'}), members, on='GROUP_ID')[['CONTEXT','RUN_ID','PROTEIN_ID','SCORE','PVALUE','QVALUE','PEP']]
 
     # store data in table
     if infile != outfile:
-        copyfile(infile, outfile)
+        copy_osw(infile, outfile)
 
-    con = sqlite3.connect(outfile)
+    store_context_table(outfile, "SCORE_PROTEIN", df, contexts)
 
-    c = con.cursor()
-    c.execute('SELECT count(name) FROM sqlite_master WHERE type="table" AND name="SCORE_PROTEIN"')
-    if c.fetchone()[0] == 1:
-        c.execute('DELETE FROM SCORE_PROTEIN WHERE CONTEXT =="%s"' % context)
-    c.fetchall()
 
-    df = data[['context','run_id','protein_id','score','p_value','q_value','pep']]
-    df.columns = ['CONTEXT','RUN_ID','PROTEIN_ID','SCORE','PVALUE','QVALUE','PEP']
-    table = "SCORE_PROTEIN"
-    df.to_sql(table, con, index=False, dtype={"RUN_ID": "INTEGER"}, if_exists='append')
+def infer_peptides(infile, outfile, context, parametric, pfdr, pi0_lambda, pi0_method, pi0_smooth_df, pi0_smooth_log_pi0, lfdr_truncate, lfdr_monotone, lfdr_transformation, lfdr_adj, lfdr_eps, lfdr_density, threads, run_reports):
+
+    if context not in ['global','experiment-wide','run-specific','all']:
+        raise click.ClickException("Unspecified context selected.")
 
+    con = connect(infile, ["SCORE_MS2"])
+
+    if not check_sqlite_table(con, "SCORE_MS2"):
+        raise click.ClickException("Apply scoring to MS2-level data before running peptide-level scoring.")
+
+    data = read_peptide_scores(con)
     con.close()
 
+    df, contexts = infer_contexts(data, outfile, context, "peptide", parametric, pfdr, pi0_lambda, pi0_method, pi0_smooth_df, pi0_smooth_log_pi0, lfdr_truncate, lfdr_monotone, lfdr_transformation, lfdr_adj, lfdr_eps, lfdr_density, threads, run_reports)
 
-def infer_peptides(infile, outfile, context, parametric, pfdr, pi0_lambda, pi0_method, pi0_smooth_df, pi0_smooth_log_pi0, lfdr_truncate, lfdr_monotone, lfdr_transformation, lfdr_adj, lfdr_eps):
+    # store data in table
+    if infile != outfile:
+        copy_osw(infile, outfile)
 
-    con = sqlite3.connect(infile)
+    store_context_table(outfile, "SCORE_PEPTIDE", df, contexts)
 
-    if not check_sqlite_table(con, "SCORE_MS2"):
-        raise click.ClickException("Apply scoring to MS2-level data before running peptide-level scoring.")
 
-    if context in ['global','experiment-wide','run-specific']:
-        if context == 'global':
-            run_id = 'NULL'
-            group_id = 'PEPTIDE.ID'
-        else:
-            run_id = 'RUN_ID'
-            group_id = 'RUN_ID || "_" || PEPTIDE.ID'
+def rescore_osw(infile, outfile, level, parametric, pfdr, pi0_lambda, pi0_method, pi0_smooth_df, pi0_smooth_log_pi0, lfdr_truncate, lfdr_monotone, lfdr_transformation, lfdr_adj, lfdr_eps, lfdr_density, tric_chromprob, lookup_interpolate, threads):
+
+    if level in ['ms2', 'ms1ms2']:
+        table = "SCORE_MS2"
+    elif level == 'ms1':
+        table = "SCORE_MS1"
+    elif level == 'transition':
+        table = "SCORE_TRANSITION"
+    else:
+        raise click.ClickException("Unspecified data level selected.")
+
+    con = connect(infile, [table])
 
+    if not check_sqlite_table(con, table):
+        raise click.ClickException("Rescoring requires prior %s-level scoring. Please run 'pyprophet score --level=%s' on this file first." % (level, level))
+
+    if level == 'transition':
+        con.executescript('''
+CREATE INDEX IF NOT EXISTS idx_transition_id ON TRANSITION (ID);
+''')
+
+        data = pd.read_sql_query('''
+SELECT FEATURE_ID,
+       TRANSITION_ID,
+       TRANSITION.DECOY AS DECOY,
+       SCORE,
+       RANK
+FROM SCORE_TRANSITION
+INNER JOIN TRANSITION ON SCORE_TRANSITION.TRANSITION_ID = TRANSITION.ID
+ORDER BY SCORE_TRANSITION.ROWID;
+''', con)
+    else:
         con.executescript('''
-CREATE INDEX IF NOT EXISTS idx_peptide_peptide_id ON PEPTIDE (ID);
-CREATE INDEX IF NOT EXISTS idx_precursor_peptide_mapping_peptide_id ON PRECURSOR_PEPTIDE_MAPPING (PEPTIDE_ID);
-CREATE INDEX IF NOT EXISTS idx_precursor_peptide_mapping_precursor_id ON PRECURSOR_PEPTIDE_MAPPING (PRECURSOR_ID);
 CREATE INDEX IF NOT EXISTS idx_precursor_precursor_id ON PRECURSOR (ID);
-CREATE INDEX IF NOT EXISTS idx_feature_precursor_id ON FEATURE (PRECURSOR_ID);
 CREATE INDEX IF NOT EXISTS idx_feature_feature_id ON FEATURE (ID);
-CREATE INDEX IF NOT EXISTS idx_score_ms2_feature_id ON SCORE_MS2 (FEATURE_ID);
 ''')
 
         data = pd.read_sql_query('''
-SELECT %s AS RUN_ID,
-       %s AS GROUP_ID,
-       PEPTIDE.ID AS PEPTIDE_ID,
-       PRECURSOR.DECOY,
+SELECT FEATURE_ID,
+       RUN_ID || '_' || PRECURSOR_ID AS GROUP_ID,
+       PRECURSOR.DECOY AS DECOY,
        SCORE,
-       "%s" AS CONTEXT
-FROM PEPTIDE
-INNER JOIN PRECURSOR_PEPTIDE_MAPPING ON PEPTIDE.ID = PRECURSOR_PEPTIDE_MAPPING.PEPTIDE_ID
-INNER JOIN PRECURSOR ON PRECURSOR_PEPTIDE_MAPPING.PRECURSOR_ID = PRECURSOR.ID
-INNER JOIN FEATURE ON PRECURSOR.ID = FEATURE.PRECURSOR_ID
-INNER JOIN SCORE_MS2 ON FEATURE.ID = SCORE_MS2.FEATURE_ID
-GROUP BY GROUP_ID
-HAVING MAX(SCORE)
-ORDER BY SCORE DESC
-''' % (run_id, group_id, context), con)
-    else:
-        raise click.ClickException("Unspecified context selected.")
+       RANK
+FROM %s
+INNER JOIN FEATURE ON %s.FEATURE_ID = FEATURE.ID
+INNER JOIN PRECURSOR ON FEATURE.PRECURSOR_ID = PRECURSOR.ID
+ORDER BY %s.ROWID;
+''' % (table, table, table), con)
 
-    data.columns = [col.lower() for col in data.columns]
     con.close()
 
-    if context == 'run-specific':
-        data = data.groupby('run_id').apply(statistics_report, outfile, context, "peptide", parametric, pfdr, pi0_lambda, pi0_method, pi0_smooth_df, pi0_smooth_log_pi0, lfdr_truncate, lfdr_monotone, lfdr_transformation, lfdr_adj, lfdr_eps).reset_index()
+    data.columns = [col.lower() for col in data.columns]
+    click.echo("Info: Rescoring %s peak groups from stored %s scores." % (len(data), table))
 
-    elif context in ['global', 'experiment-wide']:
-        data = statistics_report(data, outfile, context, "peptide", parametric, pfdr, pi0_lambda, pi0_method, pi0_smooth_df, pi0_smooth_log_pi0, lfdr_truncate, lfdr_monotone, lfdr_transformation, lfdr_adj, lfdr_eps)
+    top_targets = data[(data['rank'] == 1) & (data.decoy == 0)]['score']
+    top_decoys = data[(data['rank'] == 1) & (data.decoy == 1)]['score']
 
-    # store data in table
-    if infile != outfile:
-        copyfile(infile, outfile)
-    
-    con = sqlite3.connect(outfile)
+    error_stat, pi0 = error_statistics(top_targets, top_decoys, parametric, pfdr, pi0_lambda, pi0_method, pi0_smooth_df, pi0_smooth_log_pi0, True, lfdr_truncate, lfdr_monotone, lfdr_transformation, lfdr_adj, lfdr_eps, lfdr_density)
 
-    c = con.cursor()
-    c.execute('SELECT count(name) FROM sqlite_master WHERE type="table" AND name="SCORE_PEPTIDE"')
-    if c.fetchone()[0] == 1:
-        c.execute('DELETE FROM SCORE_PEPTIDE WHERE CONTEXT =="%s"' % context)
-    c.fetchall()
+    stat_table = final_err_table(error_stat)
+    summary_table = summary_err_table(error_stat)
 
-    df = data[['context','run_id','peptide_id','score','p_value','q_value','pep']]
-    df.columns = ['CONTEXT','RUN_ID','PEPTIDE_ID','SCORE','PVALUE','QVALUE','PEP']
-    table = "SCORE_PEPTIDE"
-    df.to_sql(table, con, index=False, dtype={"RUN_ID": "INTEGER"}, if_exists='append')
+    # print summary table
+    click.echo("=" * 80)
+    click.echo(summary_table)
+    click.echo("=" * 80)
 
-    con.close()
+    p_values, s_values, peps, q_values = lookup_values_from_error_table(data['score'].values, error_stat, lookup_interpolate, threads)
+    data['p_value'] = p_values
+    data['q_value'] = q_values
+    data['pep'] = peps
+
+    # store data in table
+    if infile != outfile:
+        copy_osw(infile, outfile)
+
+    if level == 'transition':
+        df = data[['feature_id','transition_id','score','rank','p_value','q_value','pep']]
+        df.columns = ['FEATURE_ID','TRANSITION_ID','SCORE','RANK','PVALUE','QVALUE','PEP']
+    elif tric_chromprob:
+        # the peak groups of a chromatogram are stored consecutively
+        tg_num_ids = (data.group_id != data.group_id.shift()).cumsum().values.astype(np.int64)
+        data['h_score'], data['h0_score'] = chromatogram_hypotheses(tg_num_ids, data['pep'].values, pi0['pi0'])
+        df = data[['feature_id','score','h_score','h0_score','rank','p_value','q_value','pep']]
+        df.columns = ['FEATURE_ID','SCORE','HSCORE','H0SCORE','RANK','PVALUE','QVALUE','PEP']
+    else:
+        df = data[['feature_id','score','rank','p_value','q_value','pep']]
+        df.columns = ['FEATURE_ID','SCORE','RANK','PVALUE','QVALUE','PEP']
+    write_table(outfile, table, df)
+
+    # export PDF report
+    report_path = os.path.splitext(outfile)[0] + "_" + level + "_report.pdf"
+    save_report(report_path, outfile, top_decoys, top_targets, stat_table["cutoff"], stat_table["svalue"], stat_table["qvalue"], data[(data['rank'] == 1) & (data.decoy == 0)]["p_value"], pi0)
+    click.echo("Info: %s written." % report_path)
 
 
 def subsample_osw(infile, outfile, subsample_ratio, test):
+    flush_artifacts()
+
     conn = sqlite3.connect(infile)
     ms1_present = check_sqlite_table(conn, "FEATURE_MS1")
     ms2_present = check_sqlite_table(conn, "FEATURE_MS2")
@@ -347,6 +544,8 @@ DETACH DATABASE sdb;
 
 
 def reduce_osw(infile, outfile):
+    flush_artifacts()
+
     conn = sqlite3.connect(infile)
     if not check_sqlite_table(conn, "SCORE_MS2"):
         raise click.ClickException("Apply scoring to MS2 data before reducing file for multi-run scoring.")
@@ -401,6 +600,8 @@ WHERE ID IN
 
 
 def merge_osw(infiles, outfile, templatefile, same_run):
+    flush_artifacts()
+
     conn = sqlite3.connect(infiles[0])
     reduced = check_sqlite_table(conn, "SCORE_MS2")
     conn.close()
@@ -611,6 +812,8 @@ CREATE TABLE FEATURE(ID INT PRIMARY KEY NOT NULL,
 
 
 def backpropagate_oswr(infile, outfile, apply_scores):
+    flush_artifacts()
+
     # store data in table
     if infile != outfile:
         copyfile(infile, outfile)
@@ -3,13 +3,14 @@ import numpy as np
 import click
 import sys
 
-from .runner import PyProphetLearner, PyProphetWeightApplier
+from .runner import PyProphetLearner, PyProphetWeightApplier, PyProphetErrorModelApplier, PyProphetMultiLevelLearner
 from .ipf import infer_peptidoforms
-from .levels_contexts import infer_peptides, infer_proteins, subsample_osw, reduce_osw, merge_osw, backpropagate_oswr
+from .levels_contexts import infer_peptides, infer_proteins, rescore_osw, subsample_osw, reduce_osw, merge_osw, backpropagate_oswr
 from .export import export_tsv, export_score_plots
 from .export_compound import export_compound_tsv, export_compound_score_plots 
 from .filter import filter_sqmass
-from .data_handling import (transform_pi0_lambda, transform_threads, transform_subsample_ratio)
+from .artifacts import ArtifactStore
+from .data_handling import (transform_pi0_lambda, transform_threads, transform_core_budget, transform_subsample_ratio, is_sqlite_file)
 from functools import update_wrapper
 import sqlite3
 
@@ -24,13 +25,19 @@ except NameError:
 
 @click.group(chain=True)
 @click.version_option()
-def cli():
+@click.pass_context
+def cli(ctx):
     """
     PyProphet: Semi-supervised learning and scoring of OpenSWATH results.
 
     Visit http://openswath.org for usage instructions and help.
     """
 
+    # score tables are handed over in memory between chained commands and
+    # written to disk once at the end of the invocation
+    ctx.obj = ArtifactStore()
+    ctx.call_on_close(ctx.obj.flush)
+
 # PyProphet semi-supervised learning and scoring
 @cli.command()
 # # File handling
@@ -41,6 +48,9 @@ def cli():
 @click.option('--xgb_autotune/--no-xgb_autotune', default=False, show_default=True, help='XGBoost: Autotune hyperparameters.')
 
 @click.option('--apply_weights', type=click.Path(exists=True), help='Apply PyProphet score weights file instead of semi-supervised learning.')
+@click.option('--save_error_model/--no-save_error_model', default=False, show_default=True, help='Store the final classifier together with its error model (d-score normalization and table of cutoffs with p-values, q-values and PEP) in the OSW output file.')
+@click.option('--apply_error_model/--no-apply_error_model', default=False, show_default=True, help='Apply the classifier and error model stored with --save_error_model in the --apply_weights file run by run, without estimating error statistics on the input data.')
+@click.option('--rescore/--no-rescore', default=False, show_default=True, help='Only recompute p-values, q-values and PEP of a previously scored OSW file from the stored discriminant scores, e.g. with different statistics options. Features are not read and no classifier is learned.')
 @click.option('--xeval_fraction', default=0.5, show_default=True, type=float, help='Data fraction used for cross-validation of semi-supervised learning step.')
 @click.option('--xeval_num_iter', default=10, show_default=True, type=int, help='Number of iterations for cross-validation of semi-supervised learning step.')
 @click.option('--ss_initial_fdr', default=0.15, show_default=True, type=float, help='Initial FDR cutoff for best scoring targets.')
@@ -60,8 +70,10 @@ def cli():
 @click.option('--lfdr_transformation', default='probit', show_default=True, type=click.Choice(['probit', 'logit']), help='Either a "probit" or "logit" transformation is applied to the p-values so that a local FDR estimate can be formed that does not involve edge effects of the [0,1] interval in which the p-values lie.')
 @click.option('--lfdr_adj', default=1.5, show_default=True, type=float, help='Numeric value that is applied as a multiple of the smoothing bandwidth used in the density estimation.')
 @click.option('--lfdr_eps', default=np.power(10.0,-8), show_default=True, type=float, help='Numeric value that is threshold for the tails of the empirical p-value distribution.')
+@click.option('--lfdr_density', default='spline', show_default=True, type=click.Choice(['spline', 'binned']), help='Density estimation for local FDR: R-compatible smoothing spline of the kernel density or linearly binned FFT kernel density with linear interpolation (faster for large data sets).')
+@click.option('--lookup_interpolate/--no-lookup_interpolate', default=False, show_default=True, help='Linearly interpolate p-values, s-values, q-values and PEP between the cutoffs of the error table instead of using the nearest cutoff.')
 # OpenSWATH options
-@click.option('--level', default='ms2', show_default=True, type=click.Choice(['ms1', 'ms2', 'ms1ms2', 'transition']), help='Either "ms1", "ms2", "ms1ms2" or "transition"; the data level selected for scoring. "ms1ms2 integrates both MS1- and MS2-level scores and can be used instead of "ms2"-level results."')
+@click.option('--level', default='ms2', show_default=True, type=click.Choice(['ms1', 'ms2', 'ms1ms2', 'transition', 'all']), help='Either "ms1", "ms2", "ms1ms2", "transition" or "all"; the data level selected for scoring. "ms1ms2 integrates both MS1- and MS2-level scores and can be used instead of "ms2"-level results." "all" learns and applies the "ms1", "ms2" and "transition"-level classifiers of an OSW file in one invocation.')
 # IPF options
 @click.option('--ipf_max_peakgroup_rank', default=1, show_default=True, type=int, help='Assess transitions only for candidate peak groups until maximum peak group rank.')
 @click.option('--ipf_max_peakgroup_pep', default=0.7, show_default=True, type=float, help='Assess transitions only for candidate peak groups until maximum posterior error probability.')
@@ -71,8 +83,10 @@ def cli():
 @click.option('--tric_chromprob/--no-tric_chromprob', default=False, show_default=True, help='Whether chromatogram probabilities for TRIC should be computed.')
 # Processing
 @click.option('--threads', default=1, show_default=True, type=int, help='Number of threads used for semi-supervised learning. -1 means all available CPUs.', callback=transform_threads)
+@click.option('--fold_threads', default=0, show_default=True, type=int, help='Number of processes used for parallel semi-supervised learning folds. 0 splits the --threads budget automatically.', callback=transform_core_budget)
+@click.option('--classifier_threads', default=0, show_default=True, type=int, help='Number of threads used by each classifier (XGBoost, BLAS). 0 splits the --threads budget automatically.', callback=transform_core_budget)
 @click.option('--test/--no-test', default=False, show_default=True, help='Run in test mode with fixed seed.')
-def score(infile, outfile, classifier, xgb_autotune, apply_weights, xeval_fraction, xeval_num_iter, ss_initial_fdr, ss_iteration_fdr, ss_num_iter, ss_main_score, group_id, parametric, pfdr, pi0_lambda, pi0_method, pi0_smooth_df, pi0_smooth_log_pi0, lfdr_truncate, lfdr_monotone, lfdr_transformation, lfdr_adj, lfdr_eps, level, ipf_max_peakgroup_rank, ipf_max_peakgroup_pep, ipf_max_transition_isotope_overlap, ipf_min_transition_sn, tric_chromprob, threads, test):
+def score(infile, outfile, classifier, xgb_autotune, apply_weights, save_error_model, apply_error_model, rescore, xeval_fraction, xeval_num_iter, ss_initial_fdr, ss_iteration_fdr, ss_num_iter, ss_main_score, group_id, parametric, pfdr, pi0_lambda, pi0_method, pi0_smooth_df, pi0_smooth_log_pi0, lfdr_truncate, lfdr_monotone, lfdr_transformation, lfdr_adj, lfdr_eps, lfdr_density, level, ipf_max_peakgroup_rank, ipf_max_peakgroup_pep, ipf_max_transition_isotope_overlap, ipf_min_transition_sn, tric_chromprob, lookup_interpolate, threads, fold_threads, classifier_threads, test):
     """
     Conduct semi-supervised learning and error-rate estimation for MS1, MS2 and transition-level data. 
     """
@@ -89,10 +103,29 @@ def score(infile, outfile, classifier, xgb_autotune, apply_weights, xeval_fracti
 
     xgb_params_space = {'eta': hp.uniform('eta', 0.0, 0.3), 'gamma': hp.uniform('gamma', 0.0, 0.5), 'max_depth': hp.quniform('max_depth', 2, 8, 1), 'min_child_weight': hp.quniform('min_child_weight', 1, 5, 1), 'subsample': 1, 'colsample_bytree': 1, 'colsample_bylevel': 1, 'colsample_bynode': 1, 'lambda': hp.uniform('lambda', 0.0, 1.0), 'alpha': hp.uniform('alpha', 0.0, 1.0), 'scale_pos_weight': 1.0, 'silent': 1, 'objective': 'binary:logitraw', 'nthread': 1, 'eval_metric': 'auc'}
 
-    if not apply_weights:
-        PyProphetLearner(infile, outfile, classifier, xgb_hyperparams, xgb_params, xgb_params_space, xeval_fraction, xeval_num_iter, ss_initial_fdr, ss_iteration_fdr, ss_num_iter, ss_main_score, group_id, parametric, pfdr, pi0_lambda, pi0_method, pi0_smooth_df, pi0_smooth_log_pi0, lfdr_truncate, lfdr_monotone, lfdr_transformation, lfdr_adj, lfdr_eps, level, ipf_max_peakgroup_rank, ipf_max_peakgroup_pep, ipf_max_transition_isotope_overlap, ipf_min_transition_sn, tric_chromprob, threads, test).run()
+    if save_error_model and not is_sqlite_file(infile):
+        raise click.ClickException("Error models can only be stored in OSW files.")
+
+    if level == 'all':
+        if apply_weights or apply_error_model or rescore:
+            raise click.ClickException("Scoring of all levels is only supported for semi-supervised learning.")
+
+        def learner(level, con, ms2_scores):
+            return PyProphetLearner(outfile, outfile, classifier, xgb_hyperparams, xgb_params, xgb_params_space, xeval_fraction, xeval_num_iter, ss_initial_fdr, ss_iteration_fdr, ss_num_iter, ss_main_score, group_id, parametric, pfdr, pi0_lambda, pi0_method, pi0_smooth_df, pi0_smooth_log_pi0, lfdr_truncate, lfdr_monotone, lfdr_transformation, lfdr_adj, lfdr_eps, lfdr_density, level, ipf_max_peakgroup_rank, ipf_max_peakgroup_pep, ipf_max_transition_isotope_overlap, ipf_min_transition_sn, tric_chromprob, lookup_interpolate, save_error_model, threads, fold_threads, classifier_threads, test, con=con, ms2_scores=ms2_scores)
+
+        PyProphetMultiLevelLearner(infile, outfile, learner).run()
+    elif apply_error_model:
+        if not apply_weights:
+            raise click.ClickException("Specify the file containing the error model with --apply_weights.")
+        PyProphetErrorModelApplier(infile, outfile, classifier, xgb_hyperparams, xgb_params, xgb_params_space, xeval_fraction, xeval_num_iter, ss_initial_fdr, ss_iteration_fdr, ss_num_iter, ss_main_score, group_id, parametric, pfdr, pi0_lambda, pi0_method, pi0_smooth_df, pi0_smooth_log_pi0, lfdr_truncate, lfdr_monotone, lfdr_transformation, lfdr_adj, lfdr_eps, lfdr_density, level, ipf_max_peakgroup_rank, ipf_max_peakgroup_pep, ipf_max_transition_isotope_overlap, ipf_min_transition_sn, tric_chromprob, lookup_interpolate, save_error_model, threads, fold_threads, classifier_threads, test, apply_weights).run()
+    elif rescore:
+        if not is_sqlite_file(infile):
+            raise click.ClickException("Rescoring is only supported for OSW files.")
+        rescore_osw(infile, outfile, level, parametric, pfdr, pi0_lambda, pi0_method, pi0_smooth_df, pi0_smooth_log_pi0, lfdr_truncate, lfdr_monotone, lfdr_transformation, lfdr_adj, lfdr_eps, lfdr_density, tric_chromprob, lookup_interpolate, threads)
+    elif not apply_weights:
+        PyProphetLearner(infile, outfile, classifier, xgb_hyperparams, xgb_params, xgb_params_space, xeval_fraction, xeval_num_iter, ss_initial_fdr, ss_iteration_fdr, ss_num_iter, ss_main_score, group_id, parametric, pfdr, pi0_lambda, pi0_method, pi0_smooth_df, pi0_smooth_log_pi0, lfdr_truncate, lfdr_monotone, lfdr_transformation, lfdr_adj, lfdr_eps, lfdr_density, level, ipf_max_peakgroup_rank, ipf_max_peakgroup_pep, ipf_max_transition_isotope_overlap, ipf_min_transition_sn, tric_chromprob, lookup_interpolate, save_error_model, threads, fold_threads, classifier_threads, test).run()
     else:
-        PyProphetWeightApplier(infile, outfile, classifier, xgb_hyperparams, xgb_params, xgb_params_space, xeval_fraction, xeval_num_iter, ss_initial_fdr, ss_iteration_fdr, ss_num_iter, ss_main_score, group_id, parametric, pfdr, pi0_lambda, pi0_method, pi0_smooth_df, pi0_smooth_log_pi0, lfdr_truncate, lfdr_monotone, lfdr_transformation, lfdr_adj, lfdr_eps, level, ipf_max_peakgroup_rank, ipf_max_peakgroup_pep, ipf_max_transition_isotope_overlap, ipf_min_transition_sn, tric_chromprob, threads, test, apply_weights).run()
+        PyProphetWeightApplier(infile, outfile, classifier, xgb_hyperparams, xgb_params, xgb_params_space, xeval_fraction, xeval_num_iter, ss_initial_fdr, ss_iteration_fdr, ss_num_iter, ss_main_score, group_id, parametric, pfdr, pi0_lambda, pi0_method, pi0_smooth_df, pi0_smooth_log_pi0, lfdr_truncate, lfdr_monotone, lfdr_transformation, lfdr_adj, lfdr_eps, lfdr_density, level, ipf_max_peakgroup_rank, ipf_max_peakgroup_pep, ipf_max_transition_isotope_overlap, ipf_min_transition_sn, tric_chromprob, lookup_interpolate, save_error_model, threads, fold_threads, classifier_threads, test, apply_weights).run()
 
 
 # IPF
@@ -109,7 +142,11 @@ def score(infile, outfile, classifier, xgb_autotune, apply_weights, xeval_fracti
 @click.option('--ipf_max_peakgroup_pep', default=0.7, show_default=True, type=float, help='Maximum PEP to consider scored peak groups in IPF.')
 @click.option('--ipf_max_precursor_peakgroup_pep', default=0.4, show_default=True, type=float, help='Maximum BHM layer 1 integrated precursor peakgroup PEP to consider in IPF.')
 @click.option('--ipf_max_transition_pep', default=0.6, show_default=True, type=float, help='Maximum PEP to consider scored transitions in IPF.')
-def ipf(infile, outfile, ipf_ms1_scoring, ipf_ms2_scoring, ipf_h0, ipf_grouped_fdr, ipf_max_precursor_pep, ipf_max_peakgroup_pep, ipf_max_precursor_peakgroup_pep, ipf_max_transition_pep):
+@click.option('--ipf_max_pruned_posterior', default=0.0, show_default=True, type=click.FloatRange(0, 1, max_open=True), help='Maximum total posterior probability of the least probable peptidoform hypotheses pruned per peak group. The PEPs of the remaining hypotheses change by less than x/(1-x). 0 disables pruning.')
+# Processing
+@click.option('--partition_size', default=0, show_default=True, type=click.IntRange(min=0), help='Number of features read and inferred per partition. 0 means all features at once (or one partition per process).')
+@click.option('--threads', default=1, show_default=True, type=int, help='Number of processes used to infer the partitions in parallel. -1 means all available CPUs.', callback=transform_threads)
+def ipf(infile, outfile, ipf_ms1_scoring, ipf_ms2_scoring, ipf_h0, ipf_grouped_fdr, ipf_max_precursor_pep, ipf_max_peakgroup_pep, ipf_max_precursor_peakgroup_pep, ipf_max_transition_pep, ipf_max_pruned_posterior, partition_size, threads):
     """
     Infer peptidoforms after scoring of MS1, MS2 and transition-level data.
     """
@@ -119,7 +156,7 @@ def ipf(infile, outfile, ipf_ms1_scoring, ipf_ms2_scoring, ipf_h0, ipf_grouped_f
     else:
         outfile = outfile
 
-    infer_peptidoforms(infile, outfile, ipf_ms1_scoring, ipf_ms2_scoring, ipf_h0, ipf_grouped_fdr, ipf_max_precursor_pep, ipf_max_peakgroup_pep, ipf_max_precursor_peakgroup_pep, ipf_max_transition_pep)
+    infer_peptidoforms(infile, outfile, ipf_ms1_scoring, ipf_ms2_scoring, ipf_h0, ipf_grouped_fdr, ipf_max_precursor_pep, ipf_max_peakgroup_pep, ipf_max_precursor_peakgroup_pep, ipf_max_transition_pep, ipf_max_pruned_posterior, partition_size, threads)
 
 
 # Peptide-level inference
@@ -128,7 +165,7 @@ def ipf(infile, outfile, ipf_ms1_scoring, ipf_ms2_scoring, ipf_h0, ipf_grouped_f
 @click.option('--in', 'infile', required=True, type=click.Path(exists=True), help='PyProphet input file.')
 @click.option('--out', 'outfile', type=click.Path(exists=False), help='PyProphet output file.')
 # Context
-@click.option('--context', default='run-specific', show_default=True, type=click.Choice(['run-specific', 'experiment-wide', 'global']), help='Context to estimate protein-level FDR control.')
+@click.option('--context', default='run-specific', show_default=True, type=click.Choice(['run-specific', 'experiment-wide', 'global', 'all']), help='Context to estimate protein-level FDR control. "all" estimates the three contexts from a single pass over the data.')
 # Statistics
 @click.option('--parametric/--no-parametric', default=False, show_default=True, help='Do parametric estimation of p-values.')
 @click.option('--pfdr/--no-pfdr', default=False, show_default=True, help='Compute positive false discovery rate (pFDR) instead of FDR.')
@@ -141,7 +178,11 @@ def ipf(infile, outfile, ipf_ms1_scoring, ipf_ms2_scoring, ipf_h0, ipf_grouped_f
 @click.option('--lfdr_transformation', default='probit', show_default=True, type=click.Choice(['probit', 'logit']), help='Either a "probit" or "logit" transformation is applied to the p-values so that a local FDR estimate can be formed that does not involve edge effects of the [0,1] interval in which the p-values lie.')
 @click.option('--lfdr_adj', default=1.5, show_default=True, type=float, help='Numeric value that is applied as a multiple of the smoothing bandwidth used in the density estimation.')
 @click.option('--lfdr_eps', default=np.power(10.0,-8), show_default=True, type=float, help='Numeric value that is threshold for the tails of the empirical p-value distribution.')
-def peptide(infile, outfile, context, parametric, pfdr, pi0_lambda, pi0_method, pi0_smooth_df, pi0_smooth_log_pi0, lfdr_truncate, lfdr_monotone, lfdr_transformation, lfdr_adj, lfdr_eps):
+@click.option('--lfdr_density', default='spline', show_default=True, type=click.Choice(['spline', 'binned']), help='Density estimation for local FDR: R-compatible smoothing spline of the kernel density or linearly binned FFT kernel density with linear interpolation (faster for large data sets).')
+# Processing
+@click.option('--threads', default=1, show_default=True, type=int, help='Number of processes used for the run-specific context, which estimates the error statistics of the runs in parallel. -1 means all available CPUs.', callback=transform_threads)
+@click.option('--run_reports/--no-run_reports', default=True, show_default=True, help='Write the PDF report of each run for the run-specific context. Skipping the reports considerably reduces the run time of experiments with many runs.')
+def peptide(infile, outfile, context, parametric, pfdr, pi0_lambda, pi0_method, pi0_smooth_df, pi0_smooth_log_pi0, lfdr_truncate, lfdr_monotone, lfdr_transformation, lfdr_adj, lfdr_eps, lfdr_density, threads, run_reports):
     """
     Infer peptides and conduct error-rate estimation in different contexts.
     """
@@ -151,7 +192,7 @@ def peptide(infile, outfile, context, parametric, pfdr, pi0_lambda, pi0_method,
     else:
         outfile = outfile
 
-    infer_peptides(infile, outfile, context, parametric, pfdr, pi0_lambda, pi0_method, pi0_smooth_df, pi0_smooth_log_pi0, lfdr_truncate, lfdr_monotone, lfdr_transformation, lfdr_adj, lfdr_eps)
+    infer_peptides(infile, outfile, context, parametric, pfdr, pi0_lambda, pi0_method, pi0_smooth_df, pi0_smooth_log_pi0, lfdr_truncate, lfdr_monotone, lfdr_transformation, lfdr_adj, lfdr_eps, lfdr_density, threads, run_reports)
 
 
 # Protein-level inference
@@ -160,7 +201,9 @@ def peptide(infile, outfile, context, parametric, pfdr, pi0_lambda, pi0_method,
 @click.option('--in', 'infile', required=True, type=click.Path(exists=True), help='PyProphet input file.')
 @click.option('--out', 'outfile', type=click.Path(exists=False), help='PyProphet output file.')
 # Context
-@click.option('--context', default='run-specific', show_default=True, type=click.Choice(['run-specific', 'experiment-wide', 'global']), help='Context to estimate protein-level FDR control.')
+@click.option('--context', default='run-specific', show_default=True, type=click.Choice(['run-specific', 'experiment-wide', 'global', 'all']), help='Context to estimate protein-level FDR control. "all" estimates the three contexts from a single pass over the data.')
+# Protein grouping
+@click.option('--grouping', default='proteotypic', show_default=True, type=click.Choice(['proteotypic', 'indistinguishable', 'components']), help='Peptide evidence of proteins: "proteotypic" uses peptides unique to a single protein, "indistinguishable" groups proteins with identical peptide sets and uses the peptides unique to a group, "components" groups proteins connected by shared peptides and uses all peptides.')
 # Statistics
 @click.option('--parametric/--no-parametric', default=False, show_default=True, help='Do parametric estimation of p-values.')
 @click.option('--pfdr/--no-pfdr', default=False, show_default=True, help='Compute positive false discovery rate (pFDR) instead of FDR.')
@@ -173,7 +216,11 @@ def peptide(infile, outfile, context, parametric, pfdr, pi0_lambda, pi0_method,
 @click.option('--lfdr_transformation', default='probit', show_default=True, type=click.Choice(['probit', 'logit']), help='Either a "probit" or "logit" transformation is applied to the p-values so that a local FDR estimate can be formed that does not involve edge effects of the [0,1] interval in which the p-values lie.')
 @click.option('--lfdr_adj', default=1.5, show_default=True, type=float, help='Numeric value that is applied as a multiple of the smoothing bandwidth used in the density estimation.')
 @click.option('--lfdr_eps', default=np.power(10.0,-8), show_default=True, type=float, help='Numeric value that is threshold for the tails of the empirical p-value distribution.')
-def protein(infile, outfile, context, parametric, pfdr, pi0_lambda, pi0_method, pi0_smooth_df, pi0_smooth_log_pi0, lfdr_truncate, lfdr_monotone, lfdr_transformation, lfdr_adj, lfdr_eps):
+@click.option('--lfdr_density', default='spline', show_default=True, type=click.Choice(['spline', 'binned']), help='Density estimation for local FDR: R-compatible smoothing spline of the kernel density or linearly binned FFT kernel density with linear interpolation (faster for large data sets).')
+# Processing
+@click.option('--threads', default=1, show_default=True, type=int, help='Number of processes used for the run-specific context, which estimates the error statistics of the runs in parallel. -1 means all available CPUs.', callback=transform_threads)
+@click.option('--run_reports/--no-run_reports', default=True, show_default=True, help='Write the PDF report of each run for the run-specific context. Skipping the reports considerably reduces the run time of experiments with many runs.')
+def protein(infile, outfile, context, grouping, parametric, pfdr, pi0_lambda, pi0_method, pi0_smooth_df, pi0_smooth_log_pi0, lfdr_truncate, lfdr_monotone, lfdr_transformation, lfdr_adj, lfdr_eps, lfdr_density, threads, run_reports):
     """
     Infer proteins and conduct error-rate estimation in different contexts.
     """
@@ -183,7 +230,7 @@ def protein(infile, outfile, context, parametric, pfdr, pi0_lambda, pi0_method,
     else:
         outfile = outfile
 
-    infer_proteins(infile, outfile, context, parametric, pfdr, pi0_lambda, pi0_method, pi0_smooth_df, pi0_smooth_log_pi0, lfdr_truncate, lfdr_monotone, lfdr_transformation, lfdr_adj, lfdr_eps)
+    infer_proteins(infile, outfile, context, grouping, parametric, pfdr, pi0_lambda, pi0_method, pi0_smooth_df, pi0_smooth_log_pi0, lfdr_truncate, lfdr_monotone, lfdr_transformation, lfdr_adj, lfdr_eps, lfdr_density, threads, run_reports)
 
 
 # Subsample OpenSWATH file to minimum for integrated scoring
@@ -0,0 +1,91 @@
+from collections import namedtuple
+from contextlib import contextmanager
+
+from .optimized import set_num_threads
+
+try:
+    from threadpoolctl import threadpool_limits
+except ImportError:
+    threadpool_limits = None
+
+
+# number of peak groups that can be handled efficiently by a single XGBoost thread
+XGB_ROWS_PER_THREAD = 250000
+
+CoreBudget = namedtuple("CoreBudget", "fold_processes classifier_threads")
+
+
+def split_core_budget(threads, classifier, num_rows, num_folds, fold_threads=0, classifier_threads=0):
+    """ Split a total core budget between fold-level worker processes and
+    classifier-level (XGBoost / BLAS) threads
+
+    The semi-supervised learning folds are independent and are distributed
+    over a process pool. Within each process, the classifier may use several
+    threads. Using 'threads' for both would oversubscribe the machine with
+    threads * threads workers. Explicitly specified values for 'fold_threads'
+    or 'classifier_threads' (> 0) take precedence over the automatic split.
+
+        Args:
+            threads(int): total number of cores that may be used
+            classifier(str): either "LDA" or "XGBoost"
+            num_rows(int): number of peak groups in the experiment
+            num_folds(int): number of semi-supervised learning folds
+            fold_threads(int): number of fold processes, 0 for automatic
+            classifier_threads(int): number of threads per classifier, 0 for automatic
+
+        Returns:
+            CoreBudget(fold_processes, classifier_threads)
+    """
+
+    threads = max(1, threads)
+    num_folds = max(1, num_folds)
+
+    if fold_threads > 0 and classifier_threads > 0:
+        return CoreBudget(fold_threads, classifier_threads)
+
+    if fold_threads > 0:
+        return CoreBudget(fold_threads, max(1, threads // fold_threads))
+
+    if classifier_threads > 0:
+        return CoreBudget(max(1, min(num_folds, threads // classifier_threads)), classifier_threads)
+
+    if classifier == "XGBoost":
+        # XGBoost scales with the number of threads on large data sets, while
+        # each additional fold process holds a copy of the data
+        inner = max(1, min(threads, -(-num_rows // XGB_ROWS_PER_THREAD)))
+    else:
+        # LDA only benefits from BLAS threads on very wide feature matrices,
+        # the folds are parallelized instead
+        inner = 1
+
+    outer = max(1, min(num_folds, threads // inner))
+    inner = max(1, threads // outer)
+
+    return CoreBudget(outer, inner)
+
+
+def limit_blas_threads(threads):
+    """ Limit the number of threads of the BLAS/OpenMP libraries in the current
+    process. The limit is applied immediately (e.g. as initializer of a worker
+    process) and restored when used as context manager. Without the optional
+    threadpoolctl package, this is a no-op.
+    """
+
+    if threadpool_limits is None:
+        return _no_limits()
+
+    return threadpool_limits(limits=threads)
+
+
+@contextmanager
+def _no_limits():
+    yield
+
+
+def init_fold_worker(classifier_threads):
+    """ Initializer of fold worker processes: limits the BLAS threads to the
+    classifier budget. The OpenMP kernels in _optimized run serially, as the
+    OpenMP runtime of the forking process is not fork-safe. """
+
+    set_num_threads(1)
+    limit_blas_threads(classifier_threads)
@@ -0,0 +1,67 @@
+import numpy as np
+import pandas as pd
+
+from scipy import sparse
+from scipy.sparse.csgraph import connected_components
+
+
+def mapping_matrix(mapping):
+    # binary peptide x protein incidence matrix of the bipartite mapping graph
+    peptide_codes, peptide_ids = pd.factorize(mapping['peptide_id'])
+    protein_codes, protein_ids = pd.factorize(mapping['protein_id'])
+
+    matrix = sparse.csr_matrix((np.ones(len(mapping.index), dtype=np.int8), (peptide_codes, protein_codes)), shape=(len(peptide_ids), len(protein_ids)))
+    matrix.sum_duplicates()
+    matrix.data[:] = 1
+
+    return matrix, np.asarray(peptide_ids), np.asarray(protein_ids)
+
+
+def indistinguishable_proteins(matrix):
+    # proteins with identical peptide sets share the same sorted column indices
+    columns = matrix.tocsc()
+    columns.sort_indices()
+    keys = [columns.indices[columns.indptr[j]:columns.indptr[j + 1]].tobytes() for j in range(columns.shape[1])]
+
+    return pd.factorize(keys)[0]
+
+
+def connected_proteins(matrix):
+    # components of the bipartite graph, peptides first and proteins second
+    num_peptides, num_proteins = matrix.shape
+    graph = sparse.bmat([[None, matrix], [matrix.T, None]], format='csr')
+    num_components, labels = connected_components(graph, directed=False)
+
+    return pd.factorize(labels[num_peptides:])[0]
+
+
+def protein_groups(mapping, grouping):
+    """ Group the proteins of a peptide-protein mapping.
+
+    'indistinguishable' groups proteins identified by the same set of peptides,
+    'components' groups proteins connected by shared peptides. Returns the
+    peptides that map to a single group and the members of each group. Groups
+    are identified by the smallest protein ID of their members.
+    """
+
+    matrix, peptide_ids, protein_ids = mapping_matrix(mapping)
+
+    if grouping == 'indistinguishable':
+        protein_groups = indistinguishable_proteins(matrix)
+    elif grouping == 'components':
+        protein_groups = connected_proteins(matrix)
+    else:
+        raise ValueError("Unknown protein grouping: %s" % grouping)
+
+    group_ids = pd.Series(protein_ids).groupby(protein_groups).min().values
+
+    # group range over the proteins of each peptide
+    peptide_groups = protein_groups[matrix.indices]
+    group_min = np.minimum.reduceat(peptide_groups, matrix.indptr[:-1])
+    group_max = np.maximum.reduceat(peptide_groups, matrix.indptr[:-1])
+    unique = group_min == group_max
+
+    peptides = pd.DataFrame({'peptide_id': peptide_ids[unique], 'group_id': group_ids[group_min[unique]]})
+    members = pd.DataFrame({'group_id': group_ids[protein_groups], 'protein_id': protein_ids})
+
+    return peptides, members
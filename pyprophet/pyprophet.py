@@ -14,6 +14,8 @@ from .stats import (lookup_values_from_error_table, error_statistics,
 from .data_handling import (prepare_data_table, Experiment)
 from .classifiers import (LDALearner, XGBLearner)
 from .semi_supervised import (AbstractSemiSupervisedLearner, StandardSemiSupervisedLearner)
+from .parallel import (split_core_budget, limit_blas_threads, init_fold_worker)
+from .optimized import set_num_threads
 from collections import namedtuple
 from contextlib import contextmanager
 
@@ -58,6 +60,15 @@ def unwrap_self_for_multiprocessing(arg):
     return getattr(inst, method_name)(*args)
 
 
+def fold_arguments(learner, experiment, num_folds):
+    """ Arguments of unwrap_self_for_multiprocessing for 'num_folds' folds
+    learned in worker processes. Forked workers inherit the random state of
+    numpy, each fold gets its own seed drawn in the parent instead. """
+
+    seeds = np.random.randint(0, 2 ** 31 - 1, size=num_folds)
+    return [(learner, "learn_randomized", (experiment, int(seed))) for seed in seeds]
+
+
 @profile
 def calculate_params_for_d_score(classifier, experiment):
     score = classifier.score(experiment, True)
@@ -71,7 +82,7 @@ def calculate_params_for_d_score(classifier, experiment):
 
 class Scorer(object):
 
-    def __init__(self, classifier, score_columns, experiment, group_id, parametric, pfdr, pi0_lambda, pi0_method, pi0_smooth_df, pi0_smooth_log_pi0, lfdr_truncate, lfdr_monotone, lfdr_transformation, lfdr_adj, lfdr_eps, tric_chromprob):
+    def __init__(self, classifier, score_columns, experiment, group_id, parametric, pfdr, pi0_lambda, pi0_method, pi0_smooth_df, pi0_smooth_log_pi0, lfdr_truncate, lfdr_monotone, lfdr_transformation, lfdr_adj, lfdr_eps, lfdr_density, tric_chromprob, lookup_interpolate, threads):
 
         self.classifier = classifier
         self.score_columns = score_columns
@@ -92,7 +103,10 @@ class Scorer(object):
         self.lfdr_transformation = lfdr_transformation
         self.lfdr_adj = lfdr_adj
         self.lfdr_eps = lfdr_eps
+        self.lfdr_density = lfdr_density
         self.tric_chromprob = tric_chromprob
+        self.lookup_interpolate = lookup_interpolate
+        self.threads = threads
 
         target_scores = experiment.get_top_target_peaks()["d_score"]
         decoy_scores = experiment.get_top_decoy_peaks()["d_score"]
@@ -110,7 +124,8 @@ class Scorer(object):
                                                      self.lfdr_monotone,
                                                      self.lfdr_transformation,
                                                      self.lfdr_adj,
-                                                     self.lfdr_eps)
+                                                     self.lfdr_eps,
+                                                     self.lfdr_density)
 
         self.number_target_pg = len(experiment.df[experiment.df.is_decoy.eq(False)])
         self.number_target_peaks = len(experiment.get_top_target_peaks().df)
@@ -127,7 +142,9 @@ class Scorer(object):
         texp["d_score"] = (score - self.mu) / self.nu
 
         p_values, s_values, peps, q_values = lookup_values_from_error_table(texp["d_score"].values,
-                                                                    self.error_stat)
+                                                                    self.error_stat,
+                                                                    self.lookup_interpolate,
+                                                                    self.threads)
 
         texp["pep"] = peps
         texp["q_value"] = q_values
@@ -158,14 +175,15 @@ class Scorer(object):
         return final_err_table(self.error_stat), summary_err_table(self.error_stat)
 
     def minimal_error_stat(self):
-        minimal_err_stat = ErrorStatistics(self.error_stat.df.loc[:, ["svalue", "qvalue", "pvalue", "pep", "cutoff"]],
-                                           self.error_stat.num_null, self.error_stat.num_total)
-        return minimal_err_stat
+        return self.error_stat.loc[:, ["cutoff", "pvalue", "svalue", "qvalue", "pep"]]
 
     def __getstate__(self):
         """when pickling"""
-        data = vars(self)
+        data = dict(vars(self))
         data["error_stat"] = self.minimal_error_stat()
+        # the score distributions of the learning data are not needed to apply the scorer
+        for name in ["dvals", "target_scores", "decoy_scores"]:
+            data.pop(name, None)
         return data
 
     def __setstate__(self, data):
@@ -178,7 +196,7 @@ class HolyGostQuery(object):
         See below how PyProphet parameterises this class.
     """
 
-    def __init__(self, semi_supervised_learner, classifier, ss_num_iter, group_id, parametric, pfdr, pi0_lambda, pi0_method, pi0_smooth_df, pi0_smooth_log_pi0, lfdr_truncate, lfdr_monotone, lfdr_transformation, lfdr_adj, lfdr_eps, tric_chromprob, threads, test):
+    def __init__(self, semi_supervised_learner, classifier, ss_num_iter, group_id, parametric, pfdr, pi0_lambda, pi0_method, pi0_smooth_df, pi0_smooth_log_pi0, lfdr_truncate, lfdr_monotone, lfdr_transformation, lfdr_adj, lfdr_eps, lfdr_density, tric_chromprob, lookup_interpolate, threads, fold_threads, classifier_threads, test):
         assert isinstance(semi_supervised_learner,
                           AbstractSemiSupervisedLearner)
         self.semi_supervised_learner = semi_supervised_learner
@@ -196,10 +214,17 @@ class HolyGostQuery(object):
         self.lfdr_transformation = lfdr_transformation
         self.lfdr_adj = lfdr_adj
         self.lfdr_eps = lfdr_eps
+        self.lfdr_density = lfdr_density
         self.tric_chromprob = tric_chromprob
+        self.lookup_interpolate = lookup_interpolate
         self.threads = threads
+        self.fold_threads = fold_threads
+        self.classifier_threads = classifier_threads
         self.test = test
 
+        # threads of the ranking and statistics kernels in this process
+        set_num_threads(self.threads)
+
     def _setup_experiment(self, table):
         prepared_table, score_columns = prepare_data_table(table, tg_id_name=self.group_id)
         experiment = Experiment(prepared_table)
@@ -276,28 +301,36 @@ class HolyGostQuery(object):
 
         neval = self.ss_num_iter
 
+        budget = split_core_budget(self.threads, self.classifier, experiment.df.shape[0], neval, self.fold_threads, self.classifier_threads)
+        learner.inner_learner.set_threads(budget.classifier_threads)
+
         click.echo("Info: Semi-supervised learning of weights:")
-        click.echo("Info: Start learning on %d folds using %d processes." % (neval, self.threads))
-
-        if self.threads == 1:
-            for k in range(neval):
-                (ttt_scores, ttd_scores, w) = learner.learn_randomized(experiment)
-                ttt.append(ttt_scores)
-                ttd.append(ttd_scores)
-                ws.append(w)
+        click.echo("Info: Start learning on %d folds using %d processes with %d classifier threads each." % (neval, budget.fold_processes, budget.classifier_threads))
+
+        if budget.fold_processes == 1:
+            with limit_blas_threads(budget.classifier_threads):
+                for k in range(neval):
+                    (ttt_scores, ttd_scores, w) = learner.learn_randomized(experiment)
+                    ttt.append(ttt_scores)
+                    ttd.append(ttd_scores)
+                    ws.append(w)
         else:
-            pool = multiprocessing.Pool(processes=self.threads)
-            while neval:
-                remaining = max(0, neval - self.threads)
-                todo = neval - remaining
-                neval -= todo
-                args = ((learner, "learn_randomized", (experiment, )), ) * todo
-                res = pool.map(unwrap_self_for_multiprocessing, args)
-                ttt_scores = [r[0] for r in res]
-                ttd_scores = [r[1] for r in res]
-                ttt.extend(ttt_scores)
-                ttd.extend(ttd_scores)
-                ws.extend([r[2] for r in res])
+            pool = multiprocessing.Pool(processes=budget.fold_processes, initializer=init_fold_worker, initargs=(budget.classifier_threads, ))
+            try:
+                while neval:
+                    remaining = max(0, neval - budget.fold_processes)
+                    todo = neval - remaining
+                    neval -= todo
+                    args = fold_arguments(learner, experiment, todo)
+                    res = pool.map(unwrap_self_for_multiprocessing, args)
+                    ttt_scores = [r[0] for r in res]
+                    ttd_scores = [r[1] for r in res]
+                    ttt.extend(ttt_scores)
+                    ttd.extend(ttd_scores)
+                    ws.extend([r[2] for r in res])
+            finally:
+                pool.close()
+                pool.join()
         click.echo("Info: Finished learning.")
 
         if self.classifier == "LDA":
@@ -310,7 +343,8 @@ class HolyGostQuery(object):
 
             experiment.set_and_rerank("classifier_score", integrated_scores)
 
-            # Learn final model
+            # Learn final model using the full core budget
+            learner.inner_learner.set_threads(self.threads)
             model = learner.learn_final(experiment)
             final_classifier = learner.set_learner(model)
 
@@ -330,7 +364,7 @@ class HolyGostQuery(object):
             for key, value in reversed(sorted(mapped.items(), key=operator.itemgetter(1))):
                 click.echo("Info: Importance of %s: %s" % (key, value))
 
-        scorer = Scorer(final_classifier, score_columns, experiment, self.group_id, self.parametric, self.pfdr, self.pi0_lambda, self.pi0_method, self.pi0_smooth_df, self.pi0_smooth_log_pi0, self.lfdr_truncate, self.lfdr_monotone, self.lfdr_transformation, self.lfdr_adj, self.lfdr_eps, self.tric_chromprob)
+        scorer = Scorer(final_classifier, score_columns, experiment, self.group_id, self.parametric, self.pfdr, self.pi0_lambda, self.pi0_method, self.pi0_smooth_df, self.pi0_smooth_log_pi0, self.lfdr_truncate, self.lfdr_monotone, self.lfdr_transformation, self.lfdr_adj, self.lfdr_eps, self.lfdr_density, self.tric_chromprob, self.lookup_interpolate, self.threads)
 
         scored_table = scorer.score(table)
 
@@ -343,10 +377,10 @@ class HolyGostQuery(object):
 
 
 @profile
-def PyProphet(classifier, xgb_hyperparams, xgb_params, xgb_params_space, xeval_fraction, xeval_num_iter, ss_initial_fdr, ss_iteration_fdr, ss_num_iter, group_id, parametric, pfdr, pi0_lambda, pi0_method, pi0_smooth_df, pi0_smooth_log_pi0, lfdr_truncate, lfdr_monotone, lfdr_transformation, lfdr_adj, lfdr_eps, tric_chromprob, threads, test):
+def PyProphet(classifier, xgb_hyperparams, xgb_params, xgb_params_space, xeval_fraction, xeval_num_iter, ss_initial_fdr, ss_iteration_fdr, ss_num_iter, group_id, parametric, pfdr, pi0_lambda, pi0_method, pi0_smooth_df, pi0_smooth_log_pi0, lfdr_truncate, lfdr_monotone, lfdr_transformation, lfdr_adj, lfdr_eps, lfdr_density, tric_chromprob, lookup_interpolate, threads, fold_threads, classifier_threads, test):
     if classifier == "LDA":
-        return HolyGostQuery(StandardSemiSupervisedLearner(LDALearner(), xeval_fraction, xeval_num_iter, ss_initial_fdr, ss_iteration_fdr, parametric, pfdr, pi0_lambda, pi0_method, pi0_smooth_df, pi0_smooth_log_pi0, test), classifier, ss_num_iter, group_id, parametric, pfdr, pi0_lambda, pi0_method, pi0_smooth_df, pi0_smooth_log_pi0, lfdr_truncate, lfdr_monotone, lfdr_transformation, lfdr_adj, lfdr_eps, tric_chromprob, threads, test)
+        return HolyGostQuery(StandardSemiSupervisedLearner(LDALearner(), xeval_fraction, xeval_num_iter, ss_initial_fdr, ss_iteration_fdr, parametric, pfdr, pi0_lambda, pi0_method, pi0_smooth_df, pi0_smooth_log_pi0, test), classifier, ss_num_iter, group_id, parametric, pfdr, pi0_lambda, pi0_method, pi0_smooth_df, pi0_smooth_log_pi0, lfdr_truncate, lfdr_monotone, lfdr_transformation, lfdr_adj, lfdr_eps, lfdr_density, tric_chromprob, lookup_interpolate, threads, fold_threads, classifier_threads, test)
     elif classifier == "XGBoost":
-        return HolyGostQuery(StandardSemiSupervisedLearner(XGBLearner(xgb_hyperparams, xgb_params, xgb_params_space, threads), xeval_fraction, xeval_num_iter, ss_initial_fdr, ss_iteration_fdr, parametric, pfdr, pi0_lambda, pi0_method, pi0_smooth_df, pi0_smooth_log_pi0, test), classifier, ss_num_iter, group_id, parametric, pfdr, pi0_lambda, pi0_method, pi0_smooth_df, pi0_smooth_log_pi0, lfdr_truncate, lfdr_monotone, lfdr_transformation, lfdr_adj, lfdr_eps, tric_chromprob, threads, test)
+        return HolyGostQuery(StandardSemiSupervisedLearner(XGBLearner(xgb_hyperparams, xgb_params, xgb_params_space, threads), xeval_fraction, xeval_num_iter, ss_initial_fdr, ss_iteration_fdr, parametric, pfdr, pi0_lambda, pi0_method, pi0_smooth_df, pi0_smooth_log_pi0, test), classifier, ss_num_iter, group_id, parametric, pfdr, pi0_lambda, pi0_method, pi0_smooth_df, pi0_smooth_log_pi0, lfdr_truncate, lfdr_monotone, lfdr_transformation, lfdr_adj, lfdr_eps, lfdr_density, tric_chromprob, lookup_interpolate, threads, fold_threads, classifier_threads, test)
     else:
         raise click.ClickException("Classifier not supported.")
@@ -12,6 +12,8 @@ import pickle
 from .pyprophet import PyProphet
 from .report import save_report
 from .data_handling import is_sqlite_file, check_sqlite_table
+from .optimized import set_num_threads
+from .artifacts import connect, copy_osw, write_table, insert_table, flush_artifacts
 from shutil import copyfile
 
 try:
@@ -21,33 +23,35 @@ except NameError:
         return fun
 
 
-class PyProphetRunner(object):
+def read_tsv(infile):
+    table = pd.read_csv(infile, "\t")
+    return(table)
 
-    __metaclass__ = abc.ABCMeta
 
-    """Base class for workflow of command line tool
-    """
+def read_osw(infile, level, ipf_max_peakgroup_rank, ipf_max_peakgroup_pep, ipf_max_transition_isotope_overlap, ipf_min_transition_sn, classifier, ss_main_score, run_id=None, con=None, ms2_scores=None):
+    # restrict to the peak groups of a single run
+    if run_id is None:
+        run_filter, params = '', []
+    else:
+        run_filter, params = 'WHERE RUN_ID = ?', [run_id]
 
-    def __init__(self, infile, outfile, classifier, xgb_hyperparams, xgb_params, xgb_params_space, xeval_fraction, xeval_num_iter, ss_initial_fdr, ss_iteration_fdr, ss_num_iter, ss_main_score, group_id, parametric, pfdr, pi0_lambda, pi0_method, pi0_smooth_df, pi0_smooth_log_pi0, lfdr_truncate, lfdr_monotone, lfdr_transformation, lfdr_adj, lfdr_eps, level, ipf_max_peakgroup_rank, ipf_max_peakgroup_pep, ipf_max_transition_isotope_overlap, ipf_min_transition_sn, tric_chromprob, threads, test):
-        def read_tsv(infile):
-            table = pd.read_csv(infile, "\t")
-            return(table)
+    # a connection shared by several levels is kept open by the caller
+    shared = con is not None
+    if not shared:
+        con = connect(infile, ["SCORE_MS2"])
 
-        def read_osw(infile, level, ipf_max_peakgroup_rank, ipf_max_peakgroup_pep, ipf_max_transition_isotope_overlap, ipf_min_transition_sn):
-            con = sqlite3.connect(infile)
+    if level == "ms2" or level == "ms1ms2":
+        if not check_sqlite_table(con, "FEATURE_MS2"):
+            raise click.ClickException("MS2-level feature table not present in file.")
 
-            if level == "ms2" or level == "ms1ms2":
-                if not check_sqlite_table(con, "FEATURE_MS2"):
-                    raise click.ClickException("MS2-level feature table not present in file.")
-
-                con.executescript('''
+        con.executescript('''
 CREATE INDEX IF NOT EXISTS idx_precursor_precursor_id ON PRECURSOR (ID);
 CREATE INDEX IF NOT EXISTS idx_feature_precursor_id ON FEATURE (PRECURSOR_ID);
 CREATE INDEX IF NOT EXISTS idx_feature_feature_id ON FEATURE (ID);
 CREATE INDEX IF NOT EXISTS idx_feature_ms2_feature_id ON FEATURE_MS2 (FEATURE_ID);
 ''')
 
-                table = pd.read_sql_query('''
+        table = pd.read_sql_query('''
 SELECT *,
        RUN_ID || '_' || PRECURSOR_ID AS GROUP_ID
 FROM FEATURE_MS2
@@ -56,7 +60,7 @@ INNER JOIN
           ID,
           PRECURSOR_ID,
           EXP_RT
-   FROM FEATURE) AS FEATURE ON FEATURE_ID = FEATURE.ID
+   FROM FEATURE %s) AS FEATURE ON FEATURE_ID = FEATURE.ID
 INNER JOIN
   (SELECT ID,
           CHARGE AS PRECURSOR_CHARGE,
@@ -72,19 +76,19 @@ INNER JOIN
 ORDER BY RUN_ID,
          PRECURSOR.ID ASC,
          FEATURE.EXP_RT ASC;
-''', con)
-            elif level == "ms1":
-                if not check_sqlite_table(con, "FEATURE_MS1"):
-                    raise click.ClickException("MS1-level feature table not present in file.")
+''' % run_filter, con, params=params)
+    elif level == "ms1":
+        if not check_sqlite_table(con, "FEATURE_MS1"):
+            raise click.ClickException("MS1-level feature table not present in file.")
 
-                con.executescript('''
+        con.executescript('''
 CREATE INDEX IF NOT EXISTS idx_precursor_precursor_id ON PRECURSOR (ID);
 CREATE INDEX IF NOT EXISTS idx_feature_precursor_id ON FEATURE (PRECURSOR_ID);
 CREATE INDEX IF NOT EXISTS idx_feature_feature_id ON FEATURE (ID);
 CREATE INDEX IF NOT EXISTS idx_feature_ms1_feature_id ON FEATURE_MS1 (FEATURE_ID);
 ''')
 
-                table = pd.read_sql_query('''
+        table = pd.read_sql_query('''
 SELECT *,
        RUN_ID || '_' || PRECURSOR_ID AS GROUP_ID
 FROM FEATURE_MS1
@@ -93,7 +97,7 @@ INNER JOIN
           ID,
           PRECURSOR_ID,
           EXP_RT
-   FROM FEATURE) AS FEATURE ON FEATURE_ID = FEATURE.ID
+   FROM FEATURE %s) AS FEATURE ON FEATURE_ID = FEATURE.ID
 INNER JOIN
   (SELECT ID,
           CHARGE AS PRECURSOR_CHARGE,
@@ -102,14 +106,20 @@ INNER JOIN
 ORDER BY RUN_ID,
          PRECURSOR.ID ASC,
          FEATURE.EXP_RT ASC;
-''', con)
-            elif level == "transition":
-                if not check_sqlite_table(con, "SCORE_MS2"):
-                    raise click.ClickException("Transition-level scoring for IPF requires prior MS2 or MS1MS2-level scoring. Please run 'pyprophet score --level=ms2' or 'pyprophet score --level=ms1ms2' on this file first.")
-                if not check_sqlite_table(con, "FEATURE_TRANSITION"):
-                    raise click.ClickException("Transition-level feature table not present in file.")
-
-                con.executescript('''
+''' % run_filter, con, params=params)
+    elif level == "transition":
+        if ms2_scores is None and not check_sqlite_table(con, "SCORE_MS2"):
+            raise click.ClickException("Transition-level scoring for IPF requires prior MS2 or MS1MS2-level scoring. Please run 'pyprophet score --level=ms2' or 'pyprophet score --level=ms1ms2' on this file first.")
+        if not check_sqlite_table(con, "FEATURE_TRANSITION"):
+            raise click.ClickException("Transition-level feature table not present in file.")
+
+        if ms2_scores is not None:
+            # MS2 scores of the current invocation select the peak groups
+            selected = ms2_scores.loc[(ms2_scores.RANK <= ipf_max_peakgroup_rank) & (ms2_scores.PEP <= ipf_max_peakgroup_pep), ['FEATURE_ID', 'RANK', 'PEP']]
+            con.execute('CREATE TEMP TABLE SCORE_MS2 (FEATURE_ID INTEGER PRIMARY KEY, RANK INTEGER, PEP REAL);')
+            con.executemany('INSERT INTO temp.SCORE_MS2 VALUES (?, ?, ?);', selected.astype(object).itertuples(index=False, name=None))
+
+        con.executescript('''
 CREATE INDEX IF NOT EXISTS idx_transition_id ON TRANSITION (ID);
 CREATE INDEX IF NOT EXISTS idx_score_ms2_feature_id ON SCORE_MS2 (FEATURE_ID);
 CREATE INDEX IF NOT EXISTS idx_precursor_precursor_id ON PRECURSOR (ID);
@@ -119,7 +129,7 @@ CREATE INDEX IF NOT EXISTS idx_feature_transition_feature_id ON FEATURE_TRANSITI
 CREATE INDEX IF NOT EXISTS idx_feature_transition_transition_id ON FEATURE_TRANSITION (TRANSITION_ID);
 ''')
 
-                table = pd.read_sql_query('''
+        table = pd.read_sql_query('''
 SELECT TRANSITION.DECOY AS DECOY,
        FEATURE_TRANSITION.*,
        PRECURSOR.CHARGE AS PRECURSOR_CHARGE,
@@ -131,7 +141,7 @@ INNER JOIN
           ID,
           PRECURSOR_ID,
           EXP_RT
-   FROM FEATURE) AS FEATURE ON FEATURE_TRANSITION.FEATURE_ID = FEATURE.ID
+   FROM FEATURE %s) AS FEATURE ON FEATURE_TRANSITION.FEATURE_ID = FEATURE.ID
 INNER JOIN PRECURSOR ON FEATURE.PRECURSOR_ID = PRECURSOR.ID
 INNER JOIN SCORE_MS2 ON FEATURE.ID = SCORE_MS2.FEATURE_ID
 INNER JOIN
@@ -148,60 +158,63 @@ ORDER BY RUN_ID,
          PRECURSOR.ID,
          FEATURE.EXP_RT,
          TRANSITION.ID;
-''' % (ipf_max_peakgroup_rank, ipf_max_peakgroup_pep, ipf_max_transition_isotope_overlap, ipf_min_transition_sn), con)
-            else:
-                raise click.ClickException("Unspecified data level selected.")
-
-            # Append MS1 scores to MS2 table if selected
-            if level == "ms1ms2":
-                if not check_sqlite_table(con, "FEATURE_MS1"):
-                    raise click.ClickException("MS1-level feature table not present in file.")
-                ms1_table = pd.read_sql_query('SELECT * FROM FEATURE_MS1;', con)
-
-                ms1_scores = [c for c in ms1_table.columns if c.startswith("VAR_")]
-                ms1_table = ms1_table[['FEATURE_ID'] + ms1_scores]
-                ms1_table.columns = ['FEATURE_ID'] + ["VAR_MS1_" + s.split("VAR_")[1] for s in ms1_scores]
-
-                table = pd.merge(table, ms1_table, how='left', on='FEATURE_ID')
-
-            # Format table
-            table.columns = [col.lower() for col in table.columns]
-
-            # Mark main score column
-            if ss_main_score.lower() in table.columns:
-                table = table.rename(index=str, columns={ss_main_score.lower(): "main_"+ss_main_score.lower()})
-            elif ss_main_score.lower() == "swath_pretrained":
-                # Add a pretrained main score corresponding to the original implementation in OpenSWATH
-                # This is optimized for 32-windows SCIEX TripleTOF 5600 data
-                table['main_var_pretrained'] = -( -0.19011762 * table['var_library_corr']
-                                                +  2.47298914 * table['var_library_rmsd']
-                                                +  5.63906731 * table['var_norm_rt_score']
-                                                + -0.62640133 * table['var_isotope_correlation_score']
-                                                +  0.36006925 * table['var_isotope_overlap_score']
-                                                +  0.08814003 * table['var_massdev_score']
-                                                +  0.13978311 * table['var_xcorr_coelution']
-                                                + -1.16475032 * table['var_xcorr_shape']
-                                                + -0.19267813 * table['var_yseries_score']
-                                                + -0.61712054 * table['var_log_sn_score'])
-            else:
-                raise click.ClickException("Main score column not present in data.")
+''' % (run_filter, ipf_max_peakgroup_rank, ipf_max_peakgroup_pep, ipf_max_transition_isotope_overlap, ipf_min_transition_sn), con, params=params)
+
+        if ms2_scores is not None:
+            con.execute('DROP TABLE temp.SCORE_MS2;')
+    else:
+        raise click.ClickException("Unspecified data level selected.")
+
+    # Append MS1 scores to MS2 table if selected
+    if level == "ms1ms2":
+        if not check_sqlite_table(con, "FEATURE_MS1"):
+            raise click.ClickException("MS1-level feature table not present in file.")
+        ms1_table = pd.read_sql_query('SELECT FEATURE_MS1.* FROM FEATURE_MS1 INNER JOIN FEATURE ON FEATURE_MS1.FEATURE_ID = FEATURE.ID %s;' % run_filter, con, params=params)
+
+        ms1_scores = [c for c in ms1_table.columns if c.startswith("VAR_")]
+        ms1_table = ms1_table[['FEATURE_ID'] + ms1_scores]
+        ms1_table.columns = ['FEATURE_ID'] + ["VAR_MS1_" + s.split("VAR_")[1] for s in ms1_scores]
+
+        table = pd.merge(table, ms1_table, how='left', on='FEATURE_ID')
+
+    # Format table
+    table.columns = [col.lower() for col in table.columns]
+
+    # Mark main score column
+    if ss_main_score.lower() in table.columns:
+        table = table.rename(index=str, columns={ss_main_score.lower(): "main_"+ss_main_score.lower()})
+    elif ss_main_score.lower() == "swath_pretrained":
+        # Add a pretrained main score corresponding to the original implementation in OpenSWATH
+        # This is optimized for 32-windows SCIEX TripleTOF 5600 data
+        table['main_var_pretrained'] = -( -0.19011762 * table['var_library_corr']
+                                        +  2.47298914 * table['var_library_rmsd']
+                                        +  5.63906731 * table['var_norm_rt_score']
+                                        + -0.62640133 * table['var_isotope_correlation_score']
+                                        +  0.36006925 * table['var_isotope_overlap_score']
+                                        +  0.08814003 * table['var_massdev_score']
+                                        +  0.13978311 * table['var_xcorr_coelution']
+                                        + -1.16475032 * table['var_xcorr_shape']
+                                        + -0.19267813 * table['var_yseries_score']
+                                        + -0.61712054 * table['var_log_sn_score'])
+    else:
+        raise click.ClickException("Main score column not present in data.")
+
+    # Enable transition count & precursor / product charge scores for XGBoost-based classifier
+    if classifier == 'XGBoost':
+        click.echo("Info: Enable number of transitions & precursor / product charge scores for XGBoost-based classifier")
+        table = table.rename(index=str, columns={'precursor_charge': 'var_precursor_charge', 'product_charge': 'var_product_charge', 'transition_count': 'var_transition_count'})
+
+    if not shared:
+        con.close()
+    return(table)
 
-            # Enable transition count & precursor / product charge scores for XGBoost-based classifier
-            if classifier == 'XGBoost':
-                click.echo("Info: Enable number of transitions & precursor / product charge scores for XGBoost-based classifier")
-                table = table.rename(index=str, columns={'precursor_charge': 'var_precursor_charge', 'product_charge': 'var_product_charge', 'transition_count': 'var_transition_count'})
 
-            con.close()
-            return(table)
+class PyProphetRunnerBase(object):
 
-        # Main function
-        if is_sqlite_file(infile):
-            self.mode = 'osw'
-            self.table = read_osw(infile, level, ipf_max_peakgroup_rank, ipf_max_peakgroup_pep, ipf_max_transition_isotope_overlap, ipf_min_transition_sn)
-        else:
-            self.mode = 'tsv'
-            self.table = read_tsv(infile)
+    """Options, input and score tables shared by the workflows of command line tool
+    """
 
+    def __init__(self, infile, outfile, classifier, xgb_hyperparams, xgb_params, xgb_params_space, xeval_fraction, xeval_num_iter, ss_initial_fdr, ss_iteration_fdr, ss_num_iter, ss_main_score, group_id, parametric, pfdr, pi0_lambda, pi0_method, pi0_smooth_df, pi0_smooth_log_pi0, lfdr_truncate, lfdr_monotone, lfdr_transformation, lfdr_adj, lfdr_eps, lfdr_density, level, ipf_max_peakgroup_rank, ipf_max_peakgroup_pep, ipf_max_transition_isotope_overlap, ipf_min_transition_sn, tric_chromprob, lookup_interpolate, save_error_model, threads, fold_threads, classifier_threads, test, con=None, ms2_scores=None):
         self.infile = infile
         self.outfile = outfile
         self.classifier = classifier
@@ -226,13 +239,65 @@ ORDER BY RUN_ID,
         self.lfdr_transformation = lfdr_transformation
         self.lfdr_adj = lfdr_adj
         self.lfdr_eps = lfdr_eps
+        self.lfdr_density = lfdr_density
         self.level = level
+        self.ipf_max_peakgroup_rank = ipf_max_peakgroup_rank
+        self.ipf_max_peakgroup_pep = ipf_max_peakgroup_pep
+        self.ipf_max_transition_isotope_overlap = ipf_max_transition_isotope_overlap
+        self.ipf_min_transition_sn = ipf_min_transition_sn
         self.tric_chromprob = tric_chromprob
+        self.lookup_interpolate = lookup_interpolate
+        self.save_error_model = save_error_model
         self.threads = threads
+        self.fold_threads = fold_threads
+        self.classifier_threads = classifier_threads
         self.test = test
+        self.con = con
+        self.ms2_scores = ms2_scores
 
         self.prefix = os.path.splitext(outfile)[0]
 
+        self.read_input()
+
+    def read_input(self):
+        if is_sqlite_file(self.infile):
+            self.mode = 'osw'
+            self.table = self.read_osw()
+        else:
+            self.mode = 'tsv'
+            self.table = read_tsv(self.infile)
+
+    def read_osw(self, run_id=None):
+        return read_osw(self.infile, self.level, self.ipf_max_peakgroup_rank, self.ipf_max_peakgroup_pep, self.ipf_max_transition_isotope_overlap, self.ipf_min_transition_sn, self.classifier, self.ss_main_score, run_id, self.con, self.ms2_scores)
+
+    def score_table(self):
+        if self.level == "ms2" or self.level == "ms1ms2":
+            return "SCORE_MS2"
+        elif self.level == "ms1":
+            return "SCORE_MS1"
+        elif self.level == "transition":
+            return "SCORE_TRANSITION"
+
+    def osw_scores(self, df):
+        if self.level == "transition":
+            df = df[['feature_id','transition_id','d_score','peak_group_rank','p_value','q_value','pep']]
+            df.columns = ['FEATURE_ID','TRANSITION_ID','SCORE','RANK','PVALUE','QVALUE','PEP']
+        elif 'h_score' in df.columns:
+            df = df[['feature_id','d_score','h_score','h0_score','peak_group_rank','p_value','q_value','pep']]
+            df.columns = ['FEATURE_ID','SCORE','HSCORE','H0SCORE','RANK','PVALUE','QVALUE','PEP']
+        else:
+            df = df[['feature_id','d_score','peak_group_rank','p_value','q_value','pep']]
+            df.columns = ['FEATURE_ID','SCORE','RANK','PVALUE','QVALUE','PEP']
+        return df
+
+
+class PyProphetRunner(PyProphetRunnerBase):
+
+    __metaclass__ = abc.ABCMeta
+
+    """Base class for workflow of command line tool
+    """
+
     @abc.abstractmethod
     def run_algo(self):
         pass
@@ -243,16 +308,28 @@ ORDER BY RUN_ID,
 
     def run(self):
 
-        extra_writes = dict(self.extra_writes())
+        start_at = time.time()
+        (result, scorer, weights) = self.learn()
 
-        self.check_cols = [self.group_id, "run_id", "decoy"]
+        needed = time.time() - start_at
 
-        start_at = time.time()
+        self.save_results(result, scorer, weights)
+
+        seconds = int(needed)
+        msecs = int(1000 * (needed - seconds))
+
+        click.echo("Info: Total time: %d seconds and %d msecs wall time" % (seconds, msecs))
+
+    def learn(self):
         with warnings.catch_warnings():
             warnings.simplefilter("ignore")
-            (result, scorer, weights) = self.run_algo()
+            return self.run_algo()
 
-        needed = time.time() - start_at
+    def save_results(self, result, scorer, weights):
+
+        extra_writes = dict(self.extra_writes())
+
+        self.check_cols = [self.group_id, "run_id", "decoy"]
 
         self.print_summary(result)
 
@@ -265,12 +342,12 @@ ORDER BY RUN_ID,
 
         elif self.mode == 'osw':
             self.save_osw_results(result, extra_writes, scorer.pi0)
-            self.save_osw_weights(weights)
-
-        seconds = int(needed)
-        msecs = int(1000 * (needed - seconds))
-
-        click.echo("Info: Total time: %d seconds and %d msecs wall time" % (seconds, msecs))
+            con = sqlite3.connect(self.outfile)
+            self.save_osw_weights(con, weights)
+            if self.save_error_model:
+                self.save_osw_error_model(con, scorer)
+            con.commit()
+            con.close()
 
     def print_summary(self, result):
         if result.summary_statistics is not None:
@@ -315,54 +392,13 @@ ORDER BY RUN_ID,
 
     def save_osw_results(self, result, extra_writes, pi0):
         if self.infile != self.outfile:
-            copyfile(self.infile, self.outfile)
+            copy_osw(self.infile, self.outfile)
 
-        con = sqlite3.connect(self.outfile)
+        write_table(self.outfile, self.score_table(), self.osw_scores(result.scored_tables))
 
-        if self.level == "ms2" or self.level == "ms1ms2":
-            c = con.cursor()
-            c.execute('DROP TABLE IF EXISTS SCORE_MS2;')
-            con.commit()
-            c.fetchall()
-
-            df = result.scored_tables
-            if 'h_score' in df.columns:
-                df = df[['feature_id','d_score','h_score','h0_score','peak_group_rank','p_value','q_value','pep']]
-                df.columns = ['FEATURE_ID','SCORE','HSCORE','H0SCORE','RANK','PVALUE','QVALUE','PEP']
-            else:
-                df = df[['feature_id','d_score','peak_group_rank','p_value','q_value','pep']]
-                df.columns = ['FEATURE_ID','SCORE','RANK','PVALUE','QVALUE','PEP']
-            table = "SCORE_MS2"
-            df.to_sql(table, con, index=False)
-        elif self.level == "ms1":
-            c = con.cursor()
-            c.execute('DROP TABLE IF EXISTS SCORE_MS1;')
-            con.commit()
-            c.fetchall()
-
-            df = result.scored_tables
-            if 'h_score' in df.columns:
-                df = df[['feature_id','d_score','h_score','h0_score','peak_group_rank','p_value','q_value','pep']]
-                df.columns = ['FEATURE_ID','SCORE','HSCORE','H0SCORE','RANK','PVALUE','QVALUE','PEP']
-            else:
-                df = df[['feature_id','d_score','peak_group_rank','p_value','q_value','pep']]
-                df.columns = ['FEATURE_ID','SCORE','RANK','PVALUE','QVALUE','PEP']
-            table = "SCORE_MS1"
-            df.to_sql(table, con, index=False)
-        elif self.level == "transition":
-            c = con.cursor()
-            c.execute('DROP TABLE IF EXISTS SCORE_TRANSITION;')
-            con.commit()
-            c.fetchall()
-
-            df = result.scored_tables[['feature_id','transition_id','d_score','peak_group_rank','p_value','q_value','pep']]
-            df.columns = ['FEATURE_ID','TRANSITION_ID','SCORE','RANK','PVALUE','QVALUE','PEP']
-            table = "SCORE_TRANSITION"
-            df.to_sql(table, con, index=False)
-
-        con.close()
-        click.echo("Info: %s written." % self.outfile)
+        self.save_osw_report(result, pi0)
 
+    def save_osw_report(self, result, pi0):
         if result.final_statistics is not None:
             cutoffs = result.final_statistics["cutoff"].values
             svalues = result.final_statistics["svalue"].values
@@ -375,23 +411,19 @@ ORDER BY RUN_ID,
             save_report(os.path.join(self.prefix + "_" + self.level + "_report.pdf"), self.outfile, top_decoys, top_targets, cutoffs, svalues, qvalues, pvalues, pi0)
             click.echo("Info: %s written." %  os.path.join(self.prefix + "_" + self.level + "_report.pdf"))
 
-    def save_osw_weights(self, weights):
+    def save_osw_weights(self, con, weights):
+        # the caller commits the transaction of 'con'
+        c = con.cursor()
         if self.classifier == "LDA":
             weights['level'] = self.level
-            con = sqlite3.connect(self.outfile)
 
-            c = con.cursor()
             c.execute('SELECT count(name) FROM sqlite_master WHERE type="table" AND name="PYPROPHET_WEIGHTS";')
             if c.fetchone()[0] == 1:
                 c.execute('DELETE FROM PYPROPHET_WEIGHTS WHERE LEVEL =="%s"' % self.level)
-            c.close()
 
-            weights.to_sql("PYPROPHET_WEIGHTS", con, index=False, if_exists='append')
+            insert_table(con, "PYPROPHET_WEIGHTS", weights)
 
         elif self.classifier == "XGBoost":
-            con = sqlite3.connect(self.outfile)
-
-            c = con.cursor()
             c.execute('SELECT count(name) FROM sqlite_master WHERE type="table" AND name="PYPROPHET_XGB";')
             if c.fetchone()[0] == 1:
                 c.execute('DELETE FROM PYPROPHET_XGB WHERE LEVEL =="%s"' % self.level)
@@ -399,8 +431,21 @@ ORDER BY RUN_ID,
                 c.execute('CREATE TABLE PYPROPHET_XGB (level TEXT, xgb BLOB)')
 
             c.execute('INSERT INTO PYPROPHET_XGB VALUES(?, ?)', [self.level, pickle.dumps(weights)])
-            con.commit()
-            c.close()
+        c.close()
+
+    def save_osw_error_model(self, con, scorer):
+        c = con.cursor()
+        c.execute('SELECT count(name) FROM sqlite_master WHERE type="table" AND name="PYPROPHET_ERROR_MODEL";')
+        if c.fetchone()[0] == 1:
+            c.execute('DELETE FROM PYPROPHET_ERROR_MODEL WHERE LEVEL =="%s"' % self.level)
+        else:
+            c.execute('CREATE TABLE PYPROPHET_ERROR_MODEL (level TEXT, model BLOB)')
+
+        # the scorer holds the final classifier, the d-score normalization and
+        # the error table of the cutoffs
+        c.execute('INSERT INTO PYPROPHET_ERROR_MODEL VALUES(?, ?)', [self.level, pickle.dumps(scorer)])
+        c.close()
+        click.echo("Info: Error model of level %s stored in %s." % (self.level, self.outfile))
 
     def save_bin_weights(self, weights, extra_writes):
         trained_weights_path = extra_writes.get("trained_model_path_" + self.level)
@@ -412,7 +457,7 @@ ORDER BY RUN_ID,
 class PyProphetLearner(PyProphetRunner):
 
     def run_algo(self):
-        (result, scorer, weights) = PyProphet(self.classifier, self.xgb_hyperparams, self.xgb_params, self.xgb_params_space, self.xeval_fraction, self.xeval_num_iter, self.ss_initial_fdr, self.ss_iteration_fdr, self.ss_num_iter, self.group_id, self.parametric, self.pfdr, self.pi0_lambda, self.pi0_method, self.pi0_smooth_df, self.pi0_smooth_log_pi0, self.lfdr_truncate, self.lfdr_monotone, self.lfdr_transformation, self.lfdr_adj, self.lfdr_eps, self.tric_chromprob, self.threads, self.test).learn_and_apply(self.table)
+        (result, scorer, weights) = PyProphet(self.classifier, self.xgb_hyperparams, self.xgb_params, self.xgb_params_space, self.xeval_fraction, self.xeval_num_iter, self.ss_initial_fdr, self.ss_iteration_fdr, self.ss_num_iter, self.group_id, self.parametric, self.pfdr, self.pi0_lambda, self.pi0_method, self.pi0_smooth_df, self.pi0_smooth_log_pi0, self.lfdr_truncate, self.lfdr_monotone, self.lfdr_transformation, self.lfdr_adj, self.lfdr_eps, self.lfdr_density, self.tric_chromprob, self.lookup_interpolate, self.threads, self.fold_threads, self.classifier_threads, self.test).learn_and_apply(self.table)
         return (result, scorer, weights)
 
     def extra_writes(self):
@@ -429,8 +474,8 @@ class PyProphetLearner(PyProphetRunner):
 
 class PyProphetWeightApplier(PyProphetRunner):
 
-    def __init__(self, infile, outfile, classifier, xgb_hyperparams, xgb_params, xgb_params_space, xeval_fraction, xeval_num_iter, ss_initial_fdr, ss_iteration_fdr, ss_num_iter, ss_main_score, group_id, parametric, pfdr, pi0_lambda, pi0_method, pi0_smooth_df, pi0_smooth_log_pi0, lfdr_truncate, lfdr_monotone, lfdr_transformation, lfdr_adj, lfdr_eps, level, ipf_max_peakgroup_rank, ipf_max_peakgroup_pep, ipf_max_transition_isotope_overlap, ipf_min_transition_sn, tric_chromprob, threads, test, apply_weights):
-        super(PyProphetWeightApplier, self).__init__(infile, outfile, classifier, xgb_hyperparams, xgb_params, xgb_params_space, xeval_fraction, xeval_num_iter, ss_initial_fdr, ss_iteration_fdr, ss_num_iter, ss_main_score, group_id, parametric, pfdr, pi0_lambda, pi0_method, pi0_smooth_df, pi0_smooth_log_pi0, lfdr_truncate, lfdr_monotone, lfdr_transformation, lfdr_adj, lfdr_eps, level, ipf_max_peakgroup_rank, ipf_max_peakgroup_pep, ipf_max_transition_isotope_overlap, ipf_min_transition_sn, tric_chromprob, threads, test)
+    def __init__(self, infile, outfile, classifier, xgb_hyperparams, xgb_params, xgb_params_space, xeval_fraction, xeval_num_iter, ss_initial_fdr, ss_iteration_fdr, ss_num_iter, ss_main_score, group_id, parametric, pfdr, pi0_lambda, pi0_method, pi0_smooth_df, pi0_smooth_log_pi0, lfdr_truncate, lfdr_monotone, lfdr_transformation, lfdr_adj, lfdr_eps, lfdr_density, level, ipf_max_peakgroup_rank, ipf_max_peakgroup_pep, ipf_max_transition_isotope_overlap, ipf_min_transition_sn, tric_chromprob, lookup_interpolate, save_error_model, threads, fold_threads, classifier_threads, test, apply_weights):
+        super(PyProphetWeightApplier, self).__init__(infile, outfile, classifier, xgb_hyperparams, xgb_params, xgb_params_space, xeval_fraction, xeval_num_iter, ss_initial_fdr, ss_iteration_fdr, ss_num_iter, ss_main_score, group_id, parametric, pfdr, pi0_lambda, pi0_method, pi0_smooth_df, pi0_smooth_log_pi0, lfdr_truncate, lfdr_monotone, lfdr_transformation, lfdr_adj, lfdr_eps, lfdr_density, level, ipf_max_peakgroup_rank, ipf_max_peakgroup_pep, ipf_max_transition_isotope_overlap, ipf_min_transition_sn, tric_chromprob, lookup_interpolate, save_error_model, threads, fold_threads, classifier_threads, test)
         if not os.path.exists(apply_weights):
             raise click.ClickException("Weights file %s does not exist." % apply_weights)
         if self.mode == "tsv":
@@ -474,7 +519,7 @@ class PyProphetWeightApplier(PyProphetRunner):
                     raise
                 
     def run_algo(self):
-        (result, scorer, weights) = PyProphet(self.classifier, self.xgb_hyperparams, self.xgb_params, self.xgb_params_space, self.xeval_fraction, self.xeval_num_iter, self.ss_initial_fdr, self.ss_iteration_fdr, self.ss_num_iter, self.group_id, self.parametric, self.pfdr, self.pi0_lambda, self.pi0_method, self.pi0_smooth_df, self.pi0_smooth_log_pi0, self.lfdr_truncate, self.lfdr_monotone, self.lfdr_transformation, self.lfdr_adj, self.lfdr_eps, self.tric_chromprob, self.threads, self.test).apply_weights(self.table, self.persisted_weights)
+        (result, scorer, weights) = PyProphet(self.classifier, self.xgb_hyperparams, self.xgb_params, self.xgb_params_space, self.xeval_fraction, self.xeval_num_iter, self.ss_initial_fdr, self.ss_iteration_fdr, self.ss_num_iter, self.group_id, self.parametric, self.pfdr, self.pi0_lambda, self.pi0_method, self.pi0_smooth_df, self.pi0_smooth_log_pi0, self.lfdr_truncate, self.lfdr_monotone, self.lfdr_transformation, self.lfdr_adj, self.lfdr_eps, self.lfdr_density, self.tric_chromprob, self.lookup_interpolate, self.threads, self.fold_threads, self.classifier_threads, self.test).apply_weights(self.table, self.persisted_weights)
         return (result, scorer, weights)
 
     def extra_writes(self):
@@ -482,3 +527,151 @@ class PyProphetWeightApplier(PyProphetRunner):
         yield "summ_stat_path", os.path.join(self.prefix + "_summary_stat.csv")
         yield "full_stat_path", os.path.join(self.prefix + "_full_stat.csv")
         yield "report_path", os.path.join(self.prefix + "_report.pdf")
+
+
+class PyProphetErrorModelApplier(PyProphetRunnerBase):
+
+    """Applies the classifier and error model stored with --save_error_model
+    run by run, without estimating error statistics on the input data
+    """
+
+    def __init__(self, infile, outfile, classifier, xgb_hyperparams, xgb_params, xgb_params_space, xeval_fraction, xeval_num_iter, ss_initial_fdr, ss_iteration_fdr, ss_num_iter, ss_main_score, group_id, parametric, pfdr, pi0_lambda, pi0_method, pi0_smooth_df, pi0_smooth_log_pi0, lfdr_truncate, lfdr_monotone, lfdr_transformation, lfdr_adj, lfdr_eps, lfdr_density, level, ipf_max_peakgroup_rank, ipf_max_peakgroup_pep, ipf_max_transition_isotope_overlap, ipf_min_transition_sn, tric_chromprob, lookup_interpolate, save_error_model, threads, fold_threads, classifier_threads, test, apply_weights):
+        super(PyProphetErrorModelApplier, self).__init__(infile, outfile, classifier, xgb_hyperparams, xgb_params, xgb_params_space, xeval_fraction, xeval_num_iter, ss_initial_fdr, ss_iteration_fdr, ss_num_iter, ss_main_score, group_id, parametric, pfdr, pi0_lambda, pi0_method, pi0_smooth_df, pi0_smooth_log_pi0, lfdr_truncate, lfdr_monotone, lfdr_transformation, lfdr_adj, lfdr_eps, lfdr_density, level, ipf_max_peakgroup_rank, ipf_max_peakgroup_pep, ipf_max_transition_isotope_overlap, ipf_min_transition_sn, tric_chromprob, lookup_interpolate, save_error_model, threads, fold_threads, classifier_threads, test)
+        if not is_sqlite_file(apply_weights):
+            raise click.ClickException("Error model file %s is not an OSW file." % apply_weights)
+
+        con = sqlite3.connect(apply_weights)
+        if not check_sqlite_table(con, "PYPROPHET_ERROR_MODEL"):
+            raise click.ClickException("No error model present in %s. Please run 'pyprophet score --save_error_model' first." % apply_weights)
+        data = con.execute("SELECT model FROM PYPROPHET_ERROR_MODEL WHERE LEVEL=='%s'" % self.level).fetchone()
+        con.close()
+        if data is None:
+            raise click.ClickException("No error model for level %s present in %s." % (self.level, apply_weights))
+
+        self.scorer = pickle.loads(data[0])
+        self.scorer.tric_chromprob = self.tric_chromprob
+        self.scorer.lookup_interpolate = self.lookup_interpolate
+        self.scorer.threads = self.threads
+
+    def read_input(self):
+        # the peak groups are read run by run in run()
+        if not is_sqlite_file(self.infile):
+            raise click.ClickException("Application of a stored error model requires an OSW input file.")
+        self.mode = 'osw'
+        self.table = None
+
+    def run(self):
+        start_at = time.time()
+
+        set_num_threads(self.threads)
+
+        # the scores are appended run by run to the file on disk
+        flush_artifacts()
+        if self.infile != self.outfile:
+            copyfile(self.infile, self.outfile)
+
+        con = sqlite3.connect(self.outfile)
+        run_ids = [r[0] for r in con.execute('SELECT DISTINCT RUN_ID FROM FEATURE ORDER BY RUN_ID;')]
+        con.execute('DROP TABLE IF EXISTS %s;' % self.score_table())
+        con.commit()
+        con.close()
+
+        top_targets, top_decoys, pvalues = [], [], []
+        for run_id in run_ids:
+            table = self.read_osw(run_id)
+            if table.empty:
+                continue
+            click.echo("Info: Applying error model to run %s with %s peak groups." % (run_id, len(table)))
+
+            scored_table = self.scorer.score(table)
+
+            con = sqlite3.connect(self.outfile)
+            self.osw_scores(scored_table).to_sql(self.score_table(), con, index=False, if_exists='append')
+            con.close()
+
+            top_peaks = scored_table.loc[scored_table.peak_group_rank == 1]
+            top_targets.append(top_peaks.loc[top_peaks.decoy == 0, "d_score"].values)
+            top_decoys.append(top_peaks.loc[top_peaks.decoy == 1, "d_score"].values)
+            pvalues.append(top_peaks.loc[top_peaks.decoy == 0, "p_value"].values)
+
+        if len(top_targets) == 0:
+            raise click.ClickException("No %s-level peak groups present in %s." % (self.level, self.infile))
+
+        click.echo("Info: %s written." % self.outfile)
+
+        error_stat = self.scorer.error_stat
+        report_path = os.path.join(self.prefix + "_" + self.level + "_report.pdf")
+        save_report(report_path, self.outfile, np.concatenate(top_decoys), np.concatenate(top_targets), error_stat["cutoff"].values, error_stat["svalue"].values, error_stat["qvalue"].values, np.concatenate(pvalues), self.scorer.pi0)
+        click.echo("Info: %s written." % report_path)
+
+        needed = time.time() - start_at
+        seconds = int(needed)
+        msecs = int(1000 * (needed - seconds))
+
+        click.echo("Info: Total time: %d seconds and %d msecs wall time" % (seconds, msecs))
+
+
+class PyProphetMultiLevelLearner(object):
+
+    """Learns and applies the MS1, MS2 and transition-level classifiers of an
+    OSW file in one invocation. The levels are learned one after another on a
+    single connection: FEATURE and PRECURSOR are read from disk once, the
+    transition-level peak groups are selected by the MS2 scores in memory and
+    the results of all levels are written in one transaction.
+    """
+
+    def __init__(self, infile, outfile, learner):
+        if not is_sqlite_file(infile):
+            raise click.ClickException("Scoring of all levels requires an OSW input file.")
+
+        self.infile = infile
+        self.outfile = outfile
+        # learner(level, con, ms2_scores) creates the PyProphetLearner of a level
+        self.learner = learner
+
+    def run(self):
+        start_at = time.time()
+
+        if self.infile != self.outfile:
+            copy_osw(self.infile, self.outfile)
+        # the score tables of all levels are written directly to the file
+        flush_artifacts(self.outfile)
+
+        con = sqlite3.connect(self.outfile)
+        con.executescript('''
+PRAGMA temp_store = MEMORY;
+CREATE TEMP TABLE FEATURE AS SELECT RUN_ID, ID, PRECURSOR_ID, EXP_RT FROM main.FEATURE;
+CREATE TEMP TABLE PRECURSOR AS SELECT ID, CHARGE, DECOY FROM main.PRECURSOR;
+''')
+
+        learned = []
+        ms2_scores = None
+        for level in ["ms1", "ms2", "transition"]:
+            learner = self.learner(level, con, ms2_scores)
+            (result, scorer, weights) = learner.learn()
+            learner.print_summary(result)
+
+            scores = learner.osw_scores(result.scored_tables)
+            if level == "ms2":
+                ms2_scores = scores
+            learned.append((learner, result, scores, scorer, weights))
+
+        con.execute('BEGIN;')
+        for learner, result, scores, scorer, weights in learned:
+            con.execute('DROP TABLE IF EXISTS main.%s;' % learner.score_table())
+            insert_table(con, learner.score_table(), scores)
+            learner.save_osw_weights(con, weights)
+            if learner.save_error_model:
+                learner.save_osw_error_model(con, scorer)
+        con.commit()
+        con.close()
+        click.echo("Info: %s written." % self.outfile)
+
+        for learner, result, scores, scorer, weights in learned:
+            learner.save_osw_report(result, scorer.pi0)
+
+        needed = time.time() - start_at
+        seconds = int(needed)
+        msecs = int(1000 * (needed - seconds))
+
+        click.echo("Info: Total time: %d seconds and %d msecs wall time" % (seconds, msecs))
@@ -31,12 +31,12 @@ class AbstractSemiSupervisedLearner(object):
         raise NotImplementedError()
 
     @profile
-    def learn_randomized(self, experiment):
+    def learn_randomized(self, experiment, seed=None):
         assert isinstance(experiment, Experiment)
 
         click.echo("Info: Learning on cross-validation fold.")
 
-        experiment.split_for_xval(self.xeval_fraction, self.test)
+        experiment.split_for_xval(self.xeval_fraction, self.test, seed)
         train = experiment.get_train_peaks()
 
         train.rank_by("main_score")
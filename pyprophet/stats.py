@@ -9,10 +9,10 @@ import scipy.special
 import multiprocessing
 import click
 
-from .optimized import (find_nearest_matches as _find_nearest_matches,
-                       count_num_positives, single_chromatogram_hypothesis_fast)
+from .optimized import (count_num_positives, chromatogram_hypotheses)
 from statsmodels.nonparametric.kde import KDEUnivariate
 from collections import namedtuple
+from multiprocessing.pool import ThreadPool
 # from .config import CONFIG
 
 try:
@@ -21,21 +21,112 @@ except NameError:
     profile = lambda x: x
 
 
-def _ff(a):
-    return _find_nearest_matches(*a)
+# number of sample points per chunk for parallel nearest match lookup
+NEAREST_MATCH_CHUNK_SIZE = 1000000
 
 
-def find_nearest_matches(x, y):
-    # num_processes = CONFIG.get("num_processes")
-    # if num_processes > 1:
-    #     pool = multiprocessing.Pool(processes=num_processes)
-    #     batch_size = int(math.ceil(len(y) / num_processes))
-    #     parts = [(x, y[i:i + batch_size]) for i in range(0, len(y),
-    #                                                      batch_size)]
-    #     res = pool.map(_ff, parts)
-    #     res_par = np.hstack(res)
-    #     return res_par
-    return _find_nearest_matches(x, y)
+def _sort_order(basis):
+    """ 1: ascending, -1: descending, 0: unsorted (as find_sort_order in _optimized.pyx) """
+    if len(basis) <= 1:
+        return 0
+    diff = np.diff(basis)
+    if np.all(diff >= 0):
+        return 1
+    if np.all(diff <= 0):
+        return -1
+    return 0
+
+
+def _run_starts(sorted_basis):
+    """ Index of the first element of the run of equal values for each position """
+    starts = np.ones(len(sorted_basis), dtype=bool)
+    starts[1:] = sorted_basis[1:] != sorted_basis[:-1]
+    return np.maximum.accumulate(np.where(starts, np.arange(len(sorted_basis)), 0))
+
+
+def _nearest_in_sorted(sorted_basis, first, sample_points, tie_index):
+    """ Nearest neighbours of sample_points in ascending sorted_basis
+
+    For each sample point, the left and right neighbours are found by binary
+    search and mapped to the first occurrence of their value by 'first'. On
+    equal distance, the neighbour with the smaller 'tie_index' is chosen.
+    """
+    n = len(sorted_basis)
+    high = np.searchsorted(sorted_basis, sample_points, side="left")
+    low = np.maximum(high - 1, 0)
+    high = np.minimum(high, n - 1)
+
+    dist_low = np.abs(sorted_basis[low] - sample_points)
+    dist_high = np.abs(sorted_basis[high] - sample_points)
+
+    low = first[low]
+    high = first[high]
+
+    take_low = (dist_low < dist_high) | ((dist_low == dist_high) & (tie_index[low] < tie_index[high]))
+    return np.where(take_low, low, high)
+
+
+def _find_nearest_matches_chunk(args):
+    (sorted_basis, first, sample_points, tie_index, perm) = args
+    ix = _nearest_in_sorted(sorted_basis, first, sample_points, tie_index)
+    if perm is not None:
+        ix = perm[ix]
+    return ix
+
+
+@profile
+def find_nearest_matches(basis, sample_points, use_sort_order=1, threads=1, chunk_size=NEAREST_MATCH_CHUNK_SIZE):
+    """ Finds the index of the nearest value in 'basis' for each value in 'sample_points'
+
+    The results are identical to find_nearest_matches in _optimized.pyx: for
+    an ascending or descending 'basis', exact matches and equally distant
+    neighbours resolve to the first occurrence of the value with the higher
+    index; for an unsorted 'basis' (or use_sort_order=0), the smallest index
+    with minimal distance is returned. Instead of walking back over tied
+    values per sample point, the first occurrences are precomputed once.
+    Large 'sample_points' are processed in chunks of 'chunk_size' by 'threads'
+    threads, as numpy releases the GIL for the binary search.
+    """
+    basis = np.asarray(basis, dtype=np.float32)
+    sample_points = np.asarray(sample_points, dtype=np.float32)
+    n = len(basis)
+
+    sort_order = _sort_order(basis) if use_sort_order else 0
+
+    perm = None
+    if sort_order == 1:
+        sorted_basis = basis
+        # ties resolve to the higher index
+        tie_index = -np.arange(n)
+    elif sort_order == -1:
+        # negation is exact, descending basis becomes ascending
+        sorted_basis = -basis
+        sample_points = -sample_points
+        tie_index = -np.arange(n)
+    else:
+        # stable sort: the first element of each run of equal values has the
+        # smallest index in 'basis'
+        perm = np.argsort(basis, kind="mergesort")
+        sorted_basis = basis[perm]
+        tie_index = perm
+
+    first = _run_starts(sorted_basis)
+
+    chunks = [(sorted_basis, first, sample_points[i:i + chunk_size], tie_index, perm) for i in range(0, len(sample_points), chunk_size)]
+
+    if threads > 1 and len(chunks) > 1:
+        pool = ThreadPool(processes=threads)
+        try:
+            res = pool.map(_find_nearest_matches_chunk, chunks)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        res = [_find_nearest_matches_chunk(chunk) for chunk in chunks]
+
+    if not res:
+        return np.zeros((0,), dtype=np.int64)
+    return np.concatenate(res).astype(np.int64)
 
 
 def to_one_dim_array(values, as_type=None):
@@ -53,9 +144,24 @@ def to_one_dim_array(values, as_type=None):
 
 
 @profile
-def lookup_values_from_error_table(scores, err_df):
-    """ Find matching q-value for each score in 'scores' """
-    ix = find_nearest_matches(np.float32(err_df.cutoff.values), np.float32(scores))
+def lookup_values_from_error_table(scores, err_df, interpolate=False, threads=1):
+    """ Find matching q-value for each score in 'scores'
+
+    By default, the values of the nearest cutoff in 'err_df' are returned. If
+    'interpolate' is set, the values are linearly interpolated between the
+    neighbouring cutoffs and kept constant outside of the cutoff range.
+    """
+    if interpolate:
+        cutoffs = np.float32(err_df.cutoff.values)
+        order = np.argsort(cutoffs, kind="mergesort")
+        # use the first occurrence of tied cutoffs, as the nearest match does
+        __, first = np.unique(cutoffs[order], return_index=True)
+        ix = order[first]
+        xp = cutoffs[ix]
+        x = np.float32(scores)
+        return tuple(np.interp(x, xp, err_df[column].values[ix]) for column in ("pvalue", "svalue", "pep", "qvalue"))
+
+    ix = find_nearest_matches(np.float32(err_df.cutoff.values), np.float32(scores), threads=threads)
     return err_df.pvalue.iloc[ix].values, err_df.svalue.iloc[ix].values, err_df.pep.iloc[ix].values, err_df.qvalue.iloc[ix].values
 
 
@@ -81,38 +187,10 @@ def posterior_chromatogram_hypotheses_fast(experiment, prior_chrom_null):
             peak is correct and the probability for the h0
     """
 
-    tg_ids = experiment.df.tg_num_id.values
+    tg_ids = experiment.df.tg_num_id.values.astype(np.int64)
     pp_values = 1-experiment.df["pep"].values
 
-    current_tg_id = tg_ids[0]
-    scores = []
-    final_result = []
-    final_result_h0 = []
-    for i in range(tg_ids.shape[0]):
-
-        id_ = tg_ids[i]
-        if id_ != current_tg_id:
-
-            # Actual computation for a single transition group (chromatogram)
-            prior_pg_true = (1.0 - prior_chrom_null) / len(scores)
-            rr = single_chromatogram_hypothesis_fast(
-                np.array(scores), prior_chrom_null, prior_pg_true)
-            final_result.extend(rr[1:])
-            final_result_h0.extend(rr[0] for i in range(len(scores)))
-
-            # Reset for next cycle
-            scores = []
-            current_tg_id = id_
-
-        scores.append(1.0 - pp_values[i])
-
-    # Last cycle
-    prior_pg_true = (1.0 - prior_chrom_null) / len(scores)
-    rr = single_chromatogram_hypothesis_fast(np.array(scores), prior_chrom_null, prior_pg_true)
-    final_result.extend(rr[1:])
-    final_result_h0.extend([rr[0]] * len(scores))
-
-    return final_result, final_result_h0
+    return chromatogram_hypotheses(tg_ids, 1.0 - pp_values, prior_chrom_null)
 
 
 def mean_and_std_dev(values):
@@ -142,18 +220,10 @@ def pemp(stat, stat0):
     m = len(stat)
     m0 = len(stat0)
 
-    statc = np.concatenate((stat, stat0))
-    v = np.array([True] * m + [False] * m0)
-    perm = np.argsort(-statc, kind="mergesort")  # reversed sort, mergesort is stable
-    v = v[perm]
-
-    u = np.where(v)[0]
-    p = (u - np.arange(m)) / float(m0)
-
-    # ranks can be fractional, we round down to the next integer, ranking returns values starting
-    # with 1, not 0:
-    ranks = np.floor(scipy.stats.rankdata(-stat)).astype(int) - 1
-    p = p[ranks]
+    # number of decoy statistics strictly larger than each target statistic,
+    # error_statistics passes sorted decoys, for which np.sort is cheap
+    stat0 = np.sort(stat0)
+    p = (m0 - np.searchsorted(stat0, stat, side="right")) / float(m0)
     p[p <= 1.0 / m0] = 1.0 / m0
 
     return p
@@ -189,15 +259,17 @@ def pi0est(p_values, lambda_ = np.arange(0.05,1.0,0.05), pi0_method = "smoother"
     elif (np.min(lambda_) < 0 or np.max(lambda_) >= 1):
         raise click.ClickException("Lambda must be within [0,1)")
 
+    # number of p-values >= lambda for all lambdas at once
+    p_sorted = np.sort(p)
+    W = m - np.searchsorted(p_sorted, lambda_, side="left")
+
     if (ll == 1):
-        pi0 = np.mean(p >= lambda_)/(1 - lambda_)
+        pi0 = (W / m)/(1 - lambda_)
         pi0_lambda = pi0
         pi0 = np.minimum(pi0, 1)
         pi0Smooth = False
     else:
-        pi0 = []
-        for l in lambda_:
-            pi0.append(np.mean(p >= l)/(1 - l))
+        pi0 = (W / m)/(1 - lambda_)
         pi0_lambda = pi0
 
         if (pi0_method == "smoother"):
@@ -215,10 +287,7 @@ def pi0est(p_values, lambda_ = np.arange(0.05,1.0,0.05), pi0_method = "smoother"
             pi0 = np.minimum(pi0Smooth[ll-1],1)
         elif (pi0_method == "bootstrap"):
             minpi0 = np.percentile(pi0,0.1)
-            W = []
-            for l in lambda_:
-                W.append(np.sum(p >= l))
-            mse = (np.array(W) / (np.power(m,2) * np.power((1 - lambda_),2))) * (1 - np.array(W) / m) + np.power((pi0 - minpi0),2)
+            mse = (W / (np.power(m,2) * np.power((1 - lambda_),2))) * (1 - W / m) + np.power((pi0 - minpi0),2)
             pi0 = np.minimum(pi0[np.argmin(mse)],1)
             pi0Smooth = False
         else:
@@ -250,9 +319,13 @@ def qvalue(p_values, pi0, pfdr = False):
     else:
         qvals = (pi0 * m * p) / v
     
-    qvals[u[m-1]] = np.minimum(qvals[u[m-1]], 1)
-    for i in list(reversed(range(0,m-2,1))):
-        qvals[u[i]] = np.minimum(qvals[u[i]], qvals[u[i + 1]])
+    # enforce monotonicity by a reversed cumulative minimum in sorted order;
+    # as in previous versions, the largest q-value is only capped at 1 and
+    # not propagated to the second largest one
+    qvals_sorted = qvals[u]
+    qvals_sorted[m-1] = np.minimum(qvals_sorted[m-1], 1)
+    qvals_sorted[:m-1] = np.minimum.accumulate(qvals_sorted[:m-1][::-1])[::-1]
+    qvals[u] = qvals_sorted
 
     qvals_out[rm_na] = qvals
     return qvals_out
@@ -272,8 +345,49 @@ def bw_nrd0(x):
 
 
 @profile
-def lfdr(p_values, pi0, trunc = True, monotone = True, transf = "probit", adj = 1.5, eps = np.power(10.0,-8)):
-    """ Estimate local FDR / posterior error probability from p-values according to bioconductor/qvalue """
+def binned_density(x, bw, gridsize = 512, cut = 3):
+    """ Gaussian kernel density estimate of x on an equidistant grid
+
+    The data is linearly binned onto the grid and convolved with the kernel
+    by FFT, as R density() does. Apart from a single pass over the data to
+    bin it, the cost depends only on the grid size.
+    """
+    x = np.asarray(x, dtype=np.float64)
+    n = len(x)
+
+    lo = np.min(x) - cut * bw
+    hi = np.max(x) + cut * bw
+    support = np.linspace(lo, hi, gridsize)
+    delta = support[1] - support[0]
+
+    # linear binning: distribute each point onto its two neighbouring grid points
+    pos = (x - lo) / delta
+    left = np.minimum(np.floor(pos).astype(np.int64), gridsize - 2)
+    frac = pos - left
+    counts = np.bincount(left, weights=1.0 - frac, minlength=gridsize) + np.bincount(left + 1, weights=frac, minlength=gridsize)
+
+    # kernel evaluated at all grid distances, zero-padded to avoid wrap-around
+    kords = np.arange(2 * gridsize) * delta
+    kords[gridsize + 1:] = -kords[gridsize - 1:0:-1]
+    kernel = scipy.stats.norm.pdf(kords, scale=bw)
+
+    density = np.fft.irfft(np.fft.rfft(counts, 2 * gridsize) * np.fft.rfft(kernel), 2 * gridsize)[:gridsize] / n
+
+    return support, np.maximum(density, 0)
+
+
+def lfdr(p_values, pi0, trunc = True, monotone = True, transf = "probit", adj = 1.5, eps = np.power(10.0,-8), density = "spline"):
+    """ Estimate local FDR / posterior error probability from p-values according to bioconductor/qvalue
+
+    The density of the transformed p-values is either estimated by a kernel
+    density that is smoothed by a spline (density = "spline", as in
+    bioconductor/qvalue) or by a linearly binned FFT kernel density that is
+    linearly interpolated (density = "binned"). The binned estimator avoids
+    evaluating the spline for every p-value. Both use the same kernel density
+    on the grid; the PEP differ only by the interpolation between grid points.
+    This typically amounts to less than 1e-3, but without monotonicity the
+    curvature in the sparse tails (p close to 0 or 1) can deviate by more.
+    """
     p = np.array(p_values)
 
     # Compare to bioconductor/qvalue reference implementation
@@ -295,50 +409,42 @@ def lfdr(p_values, pi0, trunc = True, monotone = True, transf = "probit", adj =
         raise click.ClickException("p-values not in valid range [0,1].")
     elif (pi0 < 0 or pi0 > 1):
         raise click.ClickException("pi0 not in valid range [0,1].")
+    elif density not in ("spline", "binned"):
+        raise click.ClickException("Invalid local FDR density estimation method.")
 
-    # Local FDR method for both probit and logit transformations
+    # Local FDR method for both probit and logit transformations; the null
+    # density is the density of the transformed uniform p-values
     if (transf == "probit"):
         p = np.maximum(p, eps)
         p = np.minimum(p, 1-eps)
         x = scipy.stats.norm.ppf(p, loc=0, scale=1)
-
-        # R-like implementation
-        bw = bw_nrd0(x)
-        myd = KDEUnivariate(x)
-        myd.fit(bw=adj*bw, gridsize = 512)
-        splinefit = sp.interpolate.splrep(myd.support, myd.density)
-        y = sp.interpolate.splev(x, splinefit)
-        # myd = density(x, adjust = 1.5) # R reference function
-        # mys = smoothspline(x = myd.rx2('x'), y = myd.rx2('y')) # R reference function
-        # y = predict(mys, x).rx2('y') # R reference function
-
-        lfdr = pi0 * scipy.stats.norm.pdf(x) / y
+        null_density = scipy.stats.norm.pdf(x)
     elif (transf == "logit"):
         x = np.log((p + eps) / (1 - p + eps))
+        null_density = np.exp(x) / np.power((1 + np.exp(x)),2)
+    else:
+        raise click.ClickException("Invalid local FDR method.")
 
-        # R-like implementation
-        bw = bw_nrd0(x)
+    # R-like implementation
+    bw = bw_nrd0(x)
+    if (density == "spline"):
         myd = KDEUnivariate(x)
         myd.fit(bw=adj*bw, gridsize = 512)
-
         splinefit = sp.interpolate.splrep(myd.support, myd.density)
         y = sp.interpolate.splev(x, splinefit)
-        # myd = density(x, adjust = 1.5) # R reference function
-        # mys = smoothspline(x = myd.rx2('x'), y = myd.rx2('y')) # R reference function
-        # y = predict(mys, x).rx2('y') # R reference function
-
-        dx = np.exp(x) / np.power((1 + np.exp(x)),2)
-        lfdr = (pi0 * dx) / y
     else:
-        raise click.ClickException("Invalid local FDR method.")
+        support, binned = binned_density(x, adj*bw, gridsize = 512)
+        y = np.interp(x, support, binned)
+    # myd = density(x, adjust = 1.5) # R reference function
+    # mys = smoothspline(x = myd.rx2('x'), y = myd.rx2('y')) # R reference function
+    # y = predict(mys, x).rx2('y') # R reference function
+
+    lfdr = (pi0 * null_density) / y
 
     if (trunc):
         lfdr[lfdr > 1] = 1
     if (monotone):
-        lfdr = lfdr[p.ravel().argsort()]
-        for i in range(1,len(x)):
-            if (lfdr[i] < lfdr[i - 1]):
-                lfdr[i] = lfdr[i - 1]
+        lfdr = np.maximum.accumulate(lfdr[p.ravel().argsort()])
         lfdr = lfdr[scipy.stats.rankdata(p,"min")-1]
 
     lfdr_out[rm_na] = lfdr
@@ -384,7 +490,9 @@ def stat_metrics(p_values, pi0, pfdr):
     fnr[fnr > 1.0] = 1.0
     fnr[num_positives == 0] = 0.0
 
-    svalues = pd.Series(sens)[::-1].cummax()[::-1]
+    # reversed cumulative maximum, missing values are skipped but kept
+    svalues = np.fmax.accumulate(sens[::-1])[::-1]
+    svalues[np.isnan(sens)] = np.nan
 
     return pd.DataFrame({'tp': tp, 'fp': fp, 'tn': tn, 'fn': fn, 'fpr': fpr, 'fdr': fdr, 'fnr': fnr, 'svalue': svalues})
 
@@ -434,7 +542,7 @@ def summary_err_table(df, qvalues=[0, 0.01, 0.02, 0.05, 0.1, 0.2, 0.3, 0.4, 0.5]
 
 
 @profile
-def error_statistics(target_scores, decoy_scores, parametric, pfdr, pi0_lambda, pi0_method = "smoother", pi0_smooth_df = 3, pi0_smooth_log_pi0 = False, compute_lfdr = False, lfdr_trunc = True, lfdr_monotone = True, lfdr_transf = "probit", lfdr_adj = 1.5, lfdr_eps = np.power(10.0,-8)):
+def error_statistics(target_scores, decoy_scores, parametric, pfdr, pi0_lambda, pi0_method = "smoother", pi0_smooth_df = 3, pi0_smooth_log_pi0 = False, compute_lfdr = False, lfdr_trunc = True, lfdr_monotone = True, lfdr_transf = "probit", lfdr_adj = 1.5, lfdr_eps = np.power(10.0,-8), lfdr_density = "spline"):
     """ Takes list of decoy and target scores and creates error statistics for target values """
 
     target_scores = to_one_dim_array(target_scores)
@@ -465,7 +573,7 @@ def error_statistics(target_scores, decoy_scores, parametric, pfdr, pi0_lambda,
 
     # compute lfdr / PEP
     if compute_lfdr:
-        error_stat['pep'] = lfdr(target_pvalues, pi0['pi0'], lfdr_trunc, lfdr_monotone, lfdr_transf, lfdr_adj, lfdr_eps)
+        error_stat['pep'] = lfdr(target_pvalues, pi0['pi0'], lfdr_trunc, lfdr_monotone, lfdr_transf, lfdr_adj, lfdr_eps, lfdr_density)
 
     return error_stat, pi0
 
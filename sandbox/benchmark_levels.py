@@ -0,0 +1,157 @@
+# encoding: utf-8
+from __future__ import print_function
+
+import os
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+"""
+Benchmark of the score queries of peptide- and protein-level inference.
+
+    python sandbox/benchmark_levels.py [runs] [precursors] [peak_groups]
+
+writes a synthetic multi-run OSW file (default: 20 runs, 20000 precursors, 5 peak groups per precursor and run) and
+compares the queries aggregating all peak groups (as used before) with the queries aggregating the top-ranking peak
+groups only (pyprophet.levels_contexts). Index creation is included in the reported run times.
+"""
+
+from pyprophet.levels_contexts import read_peptide_scores, read_protein_scores
+
+
+def create_osw(path, runs, precursors, peak_groups):
+    np.random.seed(42)
+    con = sqlite3.connect(path)
+
+    peptides = precursors // 2
+    proteins = peptides // 4
+    pd.DataFrame({'ID': np.arange(proteins), 'DECOY': np.arange(proteins) % 2}).to_sql("PROTEIN", con, index=False)
+    pd.DataFrame({'ID': np.arange(peptides), 'DECOY': (np.arange(peptides) // 4) % 2}).to_sql("PEPTIDE", con, index=False)
+
+    # every tenth peptide is shared with a second protein
+    mapping = pd.DataFrame({'PEPTIDE_ID': np.arange(peptides), 'PROTEIN_ID': np.arange(peptides) // 4})
+    shared = mapping.iloc[::10].assign(PROTEIN_ID=lambda x: (x['PROTEIN_ID'] + 2) % proteins)
+    pd.concat([mapping, shared]).to_sql("PEPTIDE_PROTEIN_MAPPING", con, index=False)
+
+    pd.DataFrame({'ID': np.arange(precursors), 'DECOY': (np.arange(precursors) // 8) % 2}).to_sql("PRECURSOR", con, index=False)
+    pd.DataFrame({'PRECURSOR_ID': np.arange(precursors), 'PEPTIDE_ID': np.arange(precursors) // 2}).to_sql("PRECURSOR_PEPTIDE_MAPPING", con, index=False)
+
+    num_features = runs * precursors * peak_groups
+    run_id = np.repeat(np.arange(runs), precursors * peak_groups)
+    precursor_id = np.tile(np.repeat(np.arange(precursors), peak_groups), runs)
+    con.execute("CREATE TABLE FEATURE (ID INT PRIMARY KEY NOT NULL, RUN_ID INT NOT NULL, PRECURSOR_ID INT NOT NULL)")
+    con.executemany("INSERT INTO FEATURE VALUES (?,?,?)", zip(range(num_features), run_id.tolist(), precursor_id.tolist()))
+
+    scores = pd.DataFrame({'FEATURE_ID': np.arange(num_features), 'SCORE': np.random.normal(size=num_features) + (precursor_id // 8 % 2 == 0)})
+    scores['RANK'] = scores.groupby(run_id * precursors + precursor_id)['SCORE'].rank(ascending=False, method='first').astype(int)
+    scores.to_sql("SCORE_MS2", con, index=False)
+
+    con.commit()
+    con.close()
+
+
+def read_peptide_scores_all_peakgroups(con):
+    con.executescript('''
+CREATE INDEX IF NOT EXISTS idx_peptide_peptide_id ON PEPTIDE (ID);
+CREATE INDEX IF NOT EXISTS idx_precursor_peptide_mapping_peptide_id ON PRECURSOR_PEPTIDE_MAPPING (PEPTIDE_ID);
+CREATE INDEX IF NOT EXISTS idx_precursor_peptide_mapping_precursor_id ON PRECURSOR_PEPTIDE_MAPPING (PRECURSOR_ID);
+CREATE INDEX IF NOT EXISTS idx_precursor_precursor_id ON PRECURSOR (ID);
+CREATE INDEX IF NOT EXISTS idx_feature_precursor_id ON FEATURE (PRECURSOR_ID);
+CREATE INDEX IF NOT EXISTS idx_feature_feature_id ON FEATURE (ID);
+CREATE INDEX IF NOT EXISTS idx_score_ms2_feature_id ON SCORE_MS2 (FEATURE_ID);
+''')
+
+    return pd.read_sql_query('''
+SELECT RUN_ID,
+       PEPTIDE.ID AS PEPTIDE_ID,
+       PRECURSOR.DECOY,
+       MAX(SCORE) AS SCORE
+FROM PEPTIDE
+INNER JOIN PRECURSOR_PEPTIDE_MAPPING ON PEPTIDE.ID = PRECURSOR_PEPTIDE_MAPPING.PEPTIDE_ID
+INNER JOIN PRECURSOR ON PRECURSOR_PEPTIDE_MAPPING.PRECURSOR_ID = PRECURSOR.ID
+INNER JOIN FEATURE ON PRECURSOR.ID = FEATURE.PRECURSOR_ID
+INNER JOIN SCORE_MS2 ON FEATURE.ID = SCORE_MS2.FEATURE_ID
+GROUP BY RUN_ID, PEPTIDE.ID
+''', con)
+
+
+def read_protein_scores_all_peakgroups(con):
+    con.executescript('''
+CREATE INDEX IF NOT EXISTS idx_peptide_protein_mapping_protein_id ON PEPTIDE_PROTEIN_MAPPING (PROTEIN_ID);
+CREATE INDEX IF NOT EXISTS idx_peptide_protein_mapping_peptide_id ON PEPTIDE_PROTEIN_MAPPING (PEPTIDE_ID);
+CREATE INDEX IF NOT EXISTS idx_peptide_peptide_id ON PEPTIDE (ID);
+CREATE INDEX IF NOT EXISTS idx_precursor_peptide_mapping_peptide_id ON PRECURSOR_PEPTIDE_MAPPING (PEPTIDE_ID);
+CREATE INDEX IF NOT EXISTS idx_precursor_peptide_mapping_precursor_id ON PRECURSOR_PEPTIDE_MAPPING (PRECURSOR_ID);
+CREATE INDEX IF NOT EXISTS idx_precursor_precursor_id ON PRECURSOR (ID);
+CREATE INDEX IF NOT EXISTS idx_feature_precursor_id ON FEATURE (PRECURSOR_ID);
+CREATE INDEX IF NOT EXISTS idx_feature_feature_id ON FEATURE (ID);
+CREATE INDEX IF NOT EXISTS idx_score_ms2_feature_id ON SCORE_MS2 (FEATURE_ID);
+''')
+
+    return pd.read_sql_query('''
+SELECT RUN_ID,
+       PROTEIN.ID AS PROTEIN_ID,
+       PRECURSOR.DECOY AS DECOY,
+       MAX(SCORE) AS SCORE
+FROM PROTEIN
+INNER JOIN
+  (SELECT PEPTIDE_PROTEIN_MAPPING.PEPTIDE_ID AS PEPTIDE_ID,
+          PROTEIN_ID
+   FROM
+     (SELECT PEPTIDE_ID,
+             COUNT(*) AS NUM_PROTEINS
+      FROM PEPTIDE_PROTEIN_MAPPING
+      GROUP BY PEPTIDE_ID) AS PROTEINS_PER_PEPTIDE
+   INNER JOIN PEPTIDE_PROTEIN_MAPPING ON PROTEINS_PER_PEPTIDE.PEPTIDE_ID = PEPTIDE_PROTEIN_MAPPING.PEPTIDE_ID
+   WHERE NUM_PROTEINS == 1) AS PEPTIDE_PROTEIN_MAPPING ON PROTEIN.ID = PEPTIDE_PROTEIN_MAPPING.PROTEIN_ID
+INNER JOIN PEPTIDE ON PEPTIDE_PROTEIN_MAPPING.PEPTIDE_ID = PEPTIDE.ID
+INNER JOIN PRECURSOR_PEPTIDE_MAPPING ON PEPTIDE.ID = PRECURSOR_PEPTIDE_MAPPING.PEPTIDE_ID
+INNER JOIN PRECURSOR ON PRECURSOR_PEPTIDE_MAPPING.PRECURSOR_ID = PRECURSOR.ID
+INNER JOIN FEATURE ON PRECURSOR.ID = FEATURE.PRECURSOR_ID
+INNER JOIN SCORE_MS2 ON FEATURE.ID = SCORE_MS2.FEATURE_ID
+GROUP BY RUN_ID, PROTEIN.ID
+''', con)
+
+
+def timed(fun, template, path):
+    # every query starts from a copy of the file without indices
+    shutil.copyfile(template, path)
+    con = sqlite3.connect(path)
+    start = time.time()
+    data = fun(con)
+    elapsed = time.time() - start
+    con.close()
+    data.columns = [col.lower() for col in data.columns]
+    return elapsed, data.sort_values(list(data.columns[:2])).reset_index(drop=True)
+
+
+if __name__ == "__main__":
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    precursors = int(sys.argv[2]) if len(sys.argv) > 2 else 20000
+    peak_groups = int(sys.argv[3]) if len(sys.argv) > 3 else 5
+
+    tmpdir = tempfile.mkdtemp()
+    template = os.path.join(tmpdir, "template.osw")
+    path = os.path.join(tmpdir, "benchmark.osw")
+    try:
+        create_osw(template, runs, precursors, peak_groups)
+
+        con = sqlite3.connect(template)
+        all_rows = con.execute("SELECT COUNT(*) FROM SCORE_MS2").fetchone()[0]
+        top_rows = con.execute("SELECT COUNT(*) FROM SCORE_MS2 WHERE RANK = 1").fetchone()[0]
+        con.close()
+        print("SCORE_MS2 rows aggregated: %d (all peak groups), %d (top-ranking peak groups)" % (all_rows, top_rows))
+
+        print("%12s %12s %12s %12s %12s" % ("level", "rows", "all [s]", "top [s]", "speedup"))
+        for level, previous, current in [("peptide", read_peptide_scores_all_peakgroups, read_peptide_scores), ("protein", read_protein_scores_all_peakgroups, read_protein_scores)]:
+            previous_time, previous_data = timed(previous, template, path)
+            current_time, current_data = timed(current, template, path)
+            assert previous_data.equals(current_data)
+            print("%12s %12d %12.3f %12.3f %12.2f" % (level, len(current_data), previous_time, current_time, previous_time / current_time))
+    finally:
+        shutil.rmtree(tmpdir)
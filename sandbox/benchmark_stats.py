@@ -0,0 +1,36 @@
+# encoding: utf-8
+from __future__ import print_function
+
+import sys
+import time
+
+import numpy as np
+
+"""
+Scaling benchmark for the statistics kernels in pyprophet.stats.
+
+    python sandbox/benchmark_stats.py [max_exponent]
+
+runs pemp, pi0est, qvalue, stat_metrics and lfdr (spline and binned density) on 10^3 .. 10^max_exponent uniformly distributed
+p-values and reports the run time of each call.
+"""
+
+from pyprophet.stats import pemp, pi0est, qvalue, stat_metrics, lfdr
+
+
+def timed(fun, *args, **kwargs):
+    start = time.time()
+    fun(*args, **kwargs)
+    return time.time() - start
+
+
+if __name__ == "__main__":
+    max_exponent = int(sys.argv[1]) if len(sys.argv) > 1 else 7
+
+    np.random.seed(42)
+    print("%12s %12s %12s %12s %12s %12s %12s" % ("m", "pemp [s]", "pi0est [s]", "qvalue [s]", "metrics [s]", "lfdr [s]", "binned [s]"))
+    for exponent in range(3, max_exponent + 1):
+        target = np.sort(np.random.normal(1, 1, 10 ** exponent))
+        decoy = np.sort(np.random.normal(0, 1, 10 ** exponent))
+        p = pemp(target, decoy)
+        print("%12d %12.3f %12.3f %12.3f %12.3f %12.3f %12.3f" % (len(p), timed(pemp, target, decoy), timed(pi0est, p), timed(qvalue, p, 0.7), timed(stat_metrics, p, 0.7, False), timed(lfdr, p, 0.7), timed(lfdr, p, 0.7, density="binned")))
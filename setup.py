@@ -3,7 +3,38 @@ import numpy
 from setuptools import setup, find_packages
 from distutils.extension import Extension
 
-ext_modules = [Extension("pyprophet._optimized", ["pyprophet/_optimized.c"])]
+
+def openmp_flags():
+    """ Compiler flags for OpenMP if the compiler supports it, the parallel
+    kernels in pyprophet/_optimized.c run serially otherwise """
+    import os
+    import shutil
+    import tempfile
+    from distutils.ccompiler import new_compiler
+    from distutils.sysconfig import customize_compiler
+    from distutils.errors import CompileError, LinkError
+
+    if os.environ.get("PYPROPHET_NO_OPENMP"):
+        return []
+
+    compiler = new_compiler()
+    customize_compiler(compiler)
+    tmpdir = tempfile.mkdtemp()
+    try:
+        source = os.path.join(tmpdir, "test_openmp.c")
+        with open(source, "w") as f:
+            f.write("#include <omp.h>\nint main(void) { return omp_get_max_threads() > 0 ? 0 : 1; }\n")
+        objects = compiler.compile([source], output_dir=tmpdir, extra_postargs=["-fopenmp"])
+        compiler.link_executable(objects, os.path.join(tmpdir, "test_openmp"), extra_postargs=["-fopenmp"])
+        return ["-fopenmp"]
+    except (CompileError, LinkError):
+        return []
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+openmp = openmp_flags()
+ext_modules = [Extension("pyprophet._optimized", ["pyprophet/_optimized.c"], extra_compile_args=openmp, extra_link_args=openmp)]
 
 # read the contents of README for PyPI
 from os import path
@@ -34,7 +65,7 @@ setup(name='pyprophet',
       ],
       zip_safe=False,
       install_requires=[
-          "Click",
+          "Click >= 8.0",
           "numpy >= 1.9.0",
           "scipy == 1.2.1",
           "pandas >= 0.17",
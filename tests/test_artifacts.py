@@ -0,0 +1,98 @@
+# encoding: utf-8
+from __future__ import print_function
+
+import os
+import sqlite3
+
+import click
+import pandas as pd
+
+from pyprophet.artifacts import ArtifactStore, connect, connect_pending, pending_table, write_table
+from pyprophet.data_handling import check_sqlite_table
+
+
+def test_pending_tables(tmpdir):
+    path = os.path.join(str(tmpdir), "test.osw")
+    con = sqlite3.connect(path)
+    con.execute("CREATE TABLE SCORE_MS2 (FEATURE_ID INTEGER, SCORE REAL)")
+    con.execute("INSERT INTO SCORE_MS2 VALUES (1, 0.5)")
+    con.commit()
+    con.close()
+
+    scores = pd.DataFrame({'FEATURE_ID': [1, 2], 'SCORE': [1.5, None]})
+    peptides = pd.DataFrame({'CONTEXT': ['global'], 'RUN_ID': [None], 'PEPTIDE_ID': [3]})
+
+    store = ArtifactStore()
+    with click.Context(click.Command("score"), obj=store):
+        write_table(path, "SCORE_MS2", scores)
+        write_table(path, "SCORE_PEPTIDE", peptides, dtype={"RUN_ID": "INTEGER"})
+
+        # the file on disk is unchanged until the store is flushed
+        con = sqlite3.connect(path)
+        assert not check_sqlite_table(con, "SCORE_PEPTIDE")
+        assert con.execute("SELECT * FROM SCORE_MS2").fetchall() == [(1, 0.5)]
+        con.close()
+
+        # pending tables are handed over as data frames
+        pd.testing.assert_frame_equal(pending_table(path, "SCORE_MS2"), scores)
+        assert pending_table(path, "SCORE_MS1") is None
+
+        # queried tables are written to disk once and leave the store
+        con = connect(path, ["SCORE_MS2"])
+        assert not check_sqlite_table(con, "SCORE_PEPTIDE")
+        assert con.execute("SELECT * FROM SCORE_MS2").fetchall() == [(1, 1.5), (2, None)]
+        con.close()
+        assert pending_table(path, "SCORE_MS2") is None
+        assert pending_table(path, "SCORE_PEPTIDE") is not None
+
+        con = connect(path)
+        assert check_sqlite_table(con, "SCORE_PEPTIDE")
+        assert con.execute("SELECT * FROM SCORE_PEPTIDE").fetchall() == [('global', None, 3)]
+        con.close()
+        assert len(store.tables) == 0
+
+    con = sqlite3.connect(path)
+    assert con.execute("SELECT * FROM SCORE_MS2").fetchall() == [(1, 1.5), (2, None)]
+    assert con.execute("SELECT * FROM SCORE_PEPTIDE").fetchall() == [('global', None, 3)]
+    con.close()
+
+
+def test_connect_pending(tmpdir):
+    path = os.path.join(str(tmpdir), "test.osw")
+    con = sqlite3.connect(path)
+    con.execute("CREATE TABLE SCORE_MS2 (FEATURE_ID INTEGER, SCORE REAL)")
+    con.execute("INSERT INTO SCORE_MS2 VALUES (1, 0.5)")
+    con.commit()
+    con.close()
+
+    store = ArtifactStore()
+    with click.Context(click.Command("score"), obj=store):
+        write_table(path, "SCORE_MS2", pd.DataFrame({'FEATURE_ID': [1, 2], 'SCORE': [1.5, None]}))
+        write_table(path, "SCORE_MS1", pd.DataFrame({'FEATURE_ID': [3], 'SCORE': [2.5]}))
+
+        # pending tables shadow the tables on disk without being written
+        con = connect_pending(path, ["SCORE_MS2"])
+        assert con.execute("SELECT * FROM SCORE_MS2").fetchall() == [(1, 1.5), (2, None)]
+        assert not check_sqlite_table(con, "SCORE_MS1")
+        con.close()
+
+        con = connect_pending(path)
+        assert check_sqlite_table(con, "SCORE_MS1")
+        con.close()
+
+        con = sqlite3.connect(path)
+        assert not check_sqlite_table(con, "SCORE_MS1")
+        assert con.execute("SELECT * FROM SCORE_MS2").fetchall() == [(1, 0.5)]
+        con.close()
+        assert len(store.tables) == 2
+
+
+def test_write_table_without_store(tmpdir):
+    path = os.path.join(str(tmpdir), "test.osw")
+
+    write_table(path, "SCORE_MS2", pd.DataFrame({'FEATURE_ID': [1], 'SCORE': [0.5]}))
+    write_table(path, "SCORE_MS2", pd.DataFrame({'FEATURE_ID': [2], 'SCORE': [1.5]}))
+
+    con = sqlite3.connect(path)
+    assert con.execute("SELECT * FROM SCORE_MS2").fetchall() == [(2, 1.5)]
+    con.close()
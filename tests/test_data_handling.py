@@ -1,7 +1,10 @@
 # encoding: utf-8
 from __future__ import print_function
 
-from pyprophet.data_handling import check_for_unique_blocks
+from pyprophet.data_handling import check_for_unique_blocks, prepare_data_table, Experiment
+
+import numpy as np
+import pandas as pd
 
 
 def test_ok():
@@ -48,3 +51,53 @@ def test_not_ok():
     assert check_for_unique_blocks(map(str, [1, 2, 2, 2, 1])) is False
     assert check_for_unique_blocks(map(str, [1, 1, 2, 2, 3, 3, 4, 4, 3])) is False
     assert check_for_unique_blocks(map(str, [1, 1, 2, 2, 3, 3, 4, 4, 5, 4])) is False
+
+
+def test_cached_top_peaks():
+    np.random.seed(42)
+    table = pd.DataFrame(dict(transition_group_id=np.repeat(np.arange(24), 2),
+                              decoy=np.repeat(np.arange(24) >= 12, 2).astype(int),
+                              main_var_score=np.random.random(48),
+                              var_other=np.random.random(48)))
+    experiment = Experiment(prepare_data_table(table)[0])
+    experiment.rank_by("main_score")
+
+    top_targets = experiment.get_top_target_peaks()
+    assert top_targets is experiment.get_top_target_peaks()
+    assert len(top_targets.df) == 12
+    assert (top_targets["main_score"].values == table.main_var_score[:24].values.reshape(-1, 2).max(axis=1)).all()
+
+    scores = -experiment["main_score"].values
+    experiment.set_and_rerank("classifier_score", scores)
+    top_decoys = experiment.get_top_decoy_peaks()
+    assert (top_decoys["main_score"].values == table.main_var_score[24:].values.reshape(-1, 2).min(axis=1)).all()
+
+    experiment["classifier_score"] = 2 * scores
+    assert (experiment.get_top_decoy_peaks()["classifier_score"].values == 2 * top_decoys["classifier_score"].values).all()
+
+    # reranking peak groups invalidates the cached views
+    experiment["d_score"] = scores.astype(np.float32)
+    experiment.get_top_decoy_peaks()
+    experiment.add_peak_group_rank()
+    assert (experiment.get_top_decoy_peaks()["peak_group_rank"].values == 1).all()
+
+
+def test_split_for_xval():
+    np.random.seed(42)
+    table = pd.DataFrame(dict(transition_group_id=np.repeat(["g%02d" % i for i in range(40)], 3),
+                              decoy=np.repeat(np.arange(40) % 2, 3),
+                              main_var_score=np.random.random(120),
+                              var_other=np.random.random(120)))
+    experiment = Experiment(prepare_data_table(table)[0])
+
+    for is_test in (True, False):
+        experiment.split_for_xval(0.5, is_test)
+        df = experiment.df
+        assert df.is_train.dtype == bool
+        assert (df.groupby("tg_id").is_train.nunique() == 1).all()
+        train = df[df.is_train].drop_duplicates("tg_id")
+        assert (train.is_decoy.value_counts() == 11).all()
+
+    experiment.split_for_xval(0.5, True)
+    df = experiment.df
+    assert list(df.tg_id[df.is_train & ~df.is_decoy].unique()) == ["g%02d" % i for i in range(0, 22, 2)]
@@ -1,7 +1,10 @@
 # encoding: utf-8
 from __future__ import print_function
 
-from pyprophet.ipf import prepare_precursor_bm, prepare_transition_bm, apply_bm, compute_model_fdr
+from pyprophet.ipf import precursor_inference, posterior_probabilities, transition_log_likelihoods, compute_model_fdr, read_pyp_transition, peptidoform_classes, prune_hypotheses
+
+import os
+import sqlite3
 
 import pandas as pd
 import numpy as np
@@ -15,11 +18,12 @@ pd.options.display.max_columns = None
 
 def test_0():
     test_in = pd.DataFrame({'feature_id': [0], 'ms1_precursor_pep': [0.4], 'ms2_peakgroup_pep': [0.2], 'ms2_precursor_pep': [0.5]})
-    test_ref = pd.DataFrame(data={'evidence': [0.6, 0.4, 0.5, 0.5], 'feature_id': [0, 0, 0, 0], 'hypothesis': [True, False, True, False], 'prior': [0.8, 0.2, 0.8, 0.2]}, index=None)
+    # posterior of the true hypothesis: 0.8 * 0.6 * 0.5 / (0.8 * 0.6 * 0.5 + 0.2 * 0.4 * 0.5)
+    test_ref = pd.DataFrame({'feature_id': [0], 'precursor_peakgroup_pep': [1 - 0.24 / 0.28]})
 
-    test_out = prepare_precursor_bm(test_in)
+    test_out = precursor_inference(test_in, True, True, 0.7, 0.4)
 
-    assert_frame_equal(test_out[['feature_id', 'prior', 'evidence', 'hypothesis']].reset_index(drop=True),test_ref[['feature_id', 'prior', 'evidence', 'hypothesis']].reset_index(drop=True))
+    assert_frame_equal(test_out.reset_index(drop=True), test_ref)
 
 def test_1():
     tin = np.array([0.5, 0.4, 0.2, 0.1, 0.001, 0.9, 0.7])
@@ -38,14 +42,69 @@ def test_2():
     assert_almost_equal(tout,tref)
 
 def test_3():
-    test_in = {'feature_id': 'id0','evidence': [0.1, 0.1, 0.9, 0.9, 0.2, 0.8, 0.8, 0.2, 0.4, 0.4, 0.6, 0.4], 'hypothesis': [1, 2, 3, -1, 1, 2, 3, -1, 1, 2, 3, -1], 'prior': [0.2, 0.2, 0.2, 0.4, 0.2, 0.2, 0.2, 0.4, 0.2, 0.2, 0.2, 0.4]}
-    tin = pd.DataFrame(data=test_in, index=None)
+    # products of the transition evidence of each hypothesis
+    log_likelihood = np.log([0.9 * 0.2 * 0.4, 0.1 * 0.2 * 0.4, 0.1 * 0.8 * 0.4, 0.9 * 0.8 * 0.6])
     test_ref = {'feature_id': ['id0','id0','id0','id0'], 'hypothesis': [-1, 1, 2, 3,],'likelihood_prior': [0.0288, 0.0016, 0.0064, 0.0864],'likelihood_sum': [0.1232, 0.1232, 0.1232, 0.1232],'posterior': [0.233766, 0.012987, 0.051948, 0.701299]}
     tref= pd.DataFrame(data=test_ref, index=None)
 
-    tout = apply_bm(tin)
+    tout = posterior_probabilities(np.array(['id0','id0','id0','id0']), np.array([-1, 1, 2, 3]), log_likelihood, np.array([0.4, 0.2, 0.2, 0.2]))
 
     print(tref)
     print(tout)
 
     assert_frame_equal(tout[['feature_id','hypothesis','likelihood_prior','likelihood_sum','posterior']],tref[['feature_id','hypothesis','likelihood_prior','likelihood_sum','posterior']])
+
+def test_4():
+    # the evidence of many transitions underflows as a product but not as a sum of logs
+    log_likelihood = 400 * np.log([0.1, 0.05])
+
+    tout = posterior_probabilities(np.array([0, 0]), np.array([1, 2]), log_likelihood, np.array([0.5, 0.5]))
+
+    assert_almost_equal(tout['posterior'].values, [1.0, 0.5 ** 400])
+
+def test_5():
+    # feature 0: transition 10 maps to peptidoform 1, transition 11 to peptidoforms 1 and 2
+    # feature 1: no transition-level evidence
+    evidence = pd.DataFrame({'feature_id': [0, 0], 'transition_id': [10, 11], 'pep': [0.1, 0.2]})
+    bitmask = pd.DataFrame({'transition_id': [10, 11, 11, 12], 'peptide_id': [1, 1, 2, 3]})
+    peptidoforms = pd.DataFrame({'feature_id': [0, 0, 0, 1, 1], 'peptide_id': [-1, 1, 2, -1, 3]})
+
+    tout = transition_log_likelihoods(evidence, bitmask, peptidoforms)
+
+    assert_almost_equal(tout, np.r_[np.log([0.1 * 0.2, 0.9 * 0.8, 0.1 * 0.8]), -np.inf, -np.inf])
+
+def test_6(tmpdir):
+    # feature 2 did not pass precursor-level inference, transition 12 has no peptidoform mapping
+    path = os.path.join(str(tmpdir), "test.osw")
+    con = sqlite3.connect(path)
+    pd.DataFrame({'ID': [10, 11, 12, 13], 'TYPE': ['y', 'y', 'y', ''], 'DECOY': 0}).to_sql("TRANSITION", con, index=False)
+    pd.DataFrame({'TRANSITION_ID': [10, 11, 11, 13], 'PEPTIDE_ID': [1, 1, 2, 1]}).to_sql("TRANSITION_PEPTIDE_MAPPING", con, index=False)
+    pd.DataFrame({'FEATURE_ID': [0, 0, 0, 0, 2], 'TRANSITION_ID': [10, 11, 12, 13, 10], 'PEP': [0.1, 0.7, 0.2, 0.1, 0.1]}).to_sql("SCORE_TRANSITION", con, index=False)
+    con.close()
+
+    evidence, bitmask, peptidoforms = read_pyp_transition(path, 0.6, True, [0, 1])
+
+    assert_frame_equal(evidence.sort_values('transition_id').reset_index(drop=True), pd.DataFrame({'feature_id': [0, 0], 'transition_id': [10, 12], 'pep': [0.1, 0.2]}))
+    assert sorted(bitmask[['transition_id', 'peptide_id']].itertuples(index=False, name=None)) == [(10, 1), (11, 1), (11, 2)]
+    assert sorted(peptidoforms[['feature_id', 'peptide_id', 'num_peptidoforms']].itertuples(index=False, name=None)) == [(0, -1, 2), (0, 1, 2), (0, 2, 2)]
+
+def test_7():
+    # peptidoforms 1 and 2 share their transitions, peptidoform 3 has its own
+    bitmask = pd.DataFrame({'transition_id': [10, 10, 11, 11, 12], 'peptide_id': [1, 2, 1, 2, 3]})
+    classes = peptidoform_classes(bitmask)
+
+    assert classes[1] == classes[2] and classes[1] != classes[3]
+
+    # the classes are pruned together while their total posterior stays below the bound
+    data = pd.DataFrame({'feature_id': 0, 'hypothesis': [-1, 1, 2, 3], 'posterior': [0.1, 0.02, 0.02, 0.86]})
+    class_ids = np.array([-1, classes[1], classes[2], classes[3]])
+
+    tout, num_pruned, num_candidates, max_change = prune_hypotheses(data, class_ids, 0.05)
+    assert_almost_equal(tout['posterior'].values, [0.1 / 0.96, 0.86 / 0.96])
+    assert list(tout['hypothesis']) == [-1, 3]
+    assert (num_pruned, num_candidates) == (2, 3)
+    assert_almost_equal(max_change, 0.86 / 0.96 - 0.86)
+
+    tout, num_pruned, num_candidates, max_change = prune_hypotheses(data, class_ids, 0.04)
+    assert len(tout.index) == 4
+    assert (num_pruned, max_change) == (0, 0)
@@ -47,6 +47,23 @@ def test_rank32():
     assert list(o.rank32(groups, values)) == []
 
 
+def test_rank_large_groups():
+
+    np.random.seed(42)
+    groups = np.repeat(np.arange(3, dtype=np.int64), 5000)
+    values = np.random.random(15000).astype(np.float32)
+    values[:1000] = 0.5  # ties are ranked in input order
+
+    ranks = o.rank(groups, values)
+    for g in range(3):
+        ix = np.where(groups == g)[0]
+        expected = np.zeros(len(ix), dtype=np.uint32)
+        expected[np.argsort(-values[ix], kind="mergesort")] = np.arange(1, len(ix) + 1)
+        assert np.all(ranks[ix] == expected)
+
+    assert np.all(o.rank32(groups.astype(np.uint32), values) == ranks)
+
+
 def test_single_chromatogram_hypothesis_fast():
 
     prior_chrom_null = 0.2
@@ -71,6 +88,31 @@ def test_single_chromatogram_hypothesis_fast():
     np.testing.assert_array_almost_equal([result_h0], [0.0179487179487])
 
 
+def test_chromatogram_hypotheses():
+
+    prior_chrom_null = 0.2
+
+    groups = np.array([3, 3, 3, 3, 1, 7, 7], dtype=np.int64)
+    probabilities = array64([0.5, 0.7, 0.1, 0.01, 0.7, 0.3, 0.9])
+
+    result, result_h0 = o.chromatogram_hypotheses(groups, probabilities, prior_chrom_null)
+
+    for (imin, imax) in ((0, 4), (4, 5), (5, 7)):
+        expected = o.single_chromatogram_hypothesis_fast(probabilities[imin:imax], prior_chrom_null, (1.0 - prior_chrom_null) / (imax - imin))
+        np.testing.assert_array_almost_equal(result[imin:imax], expected[1:])
+        np.testing.assert_array_almost_equal(result_h0[imin:imax], [expected[0]] * (imax - imin))
+
+    # no limit on group size, hypotheses sum up to 1
+    np.random.seed(1)
+    probabilities = np.random.random(20000)
+    result, result_h0 = o.chromatogram_hypotheses(np.zeros(20000, dtype=np.int64), probabilities, prior_chrom_null)
+    np.testing.assert_almost_equal(np.sum(result) + result_h0[0], 1.0)
+
+    # corner case:
+    result, result_h0 = o.chromatogram_hypotheses(np.array([], dtype=np.int64), array64([]), prior_chrom_null)
+    assert list(result) == [] and list(result_h0) == []
+
+
 def _test_match(values):
     values = array32(values)
     ix = list(o.find_nearest_matches(values, values))
@@ -213,4 +255,21 @@ def _test_find_neared_matches_fuzzy():
             assert np.all(tobe == optim)
 
 
+def test_parallel_kernels():
+
+    np.random.seed(42)
+    n = 100000
+    groups = np.sort(np.random.randint(0, 20000, n)).astype(np.int64)
+    values = np.random.random(n).astype(np.float32)
+    probabilities = np.random.random(n)
+    positives = np.sort(np.round(np.random.random(n), 3))[::-1].copy()
+
+    results = []
+    for threads in (1, 4):
+        o.set_num_threads(threads)
+        results.append((o.rank(groups, values), o.find_top_ranked(groups, values), o.count_num_positives(positives))
+                       + o.chromatogram_hypotheses(groups, probabilities, 0.2))
+    o.set_num_threads(1)
 
+    for serial, parallel in zip(*results):
+        assert np.array_equal(serial, parallel)
@@ -0,0 +1,66 @@
+# encoding: utf-8
+from __future__ import print_function
+
+import multiprocessing
+
+import numpy as np
+import pandas as pd
+
+from pyprophet.data_handling import prepare_data_table, Experiment
+from pyprophet.parallel import split_core_budget, init_fold_worker
+from pyprophet.pyprophet import fold_arguments, unwrap_self_for_multiprocessing
+
+
+def test_budget_never_oversubscribes():
+
+    for classifier in ("LDA", "XGBoost"):
+        for threads in (1, 2, 3, 8, 32):
+            for num_rows in (100, 10**6, 10**7):
+                budget = split_core_budget(threads, classifier, num_rows, 10)
+                assert budget.fold_processes >= 1
+                assert budget.classifier_threads >= 1
+                assert budget.fold_processes <= 10
+                assert budget.fold_processes * budget.classifier_threads <= threads
+
+
+def test_budget_automatic():
+
+    # LDA: parallelize the folds
+    assert split_core_budget(4, "LDA", 10**6, 10) == (4, 1)
+    assert split_core_budget(32, "LDA", 10**6, 10) == (10, 3)
+
+    # XGBoost: large data sets are learned with many threads per fold
+    assert split_core_budget(32, "XGBoost", 10**7, 10) == (1, 32)
+    assert split_core_budget(32, "XGBoost", 10**5, 10) == (10, 3)
+
+
+def test_budget_override():
+
+    assert split_core_budget(8, "LDA", 100, 10, fold_threads=2) == (2, 4)
+    assert split_core_budget(8, "XGBoost", 100, 10, classifier_threads=8) == (1, 8)
+    assert split_core_budget(8, "XGBoost", 100, 10, fold_threads=3, classifier_threads=5) == (3, 5)
+
+
+class _SplitLearner(object):
+    def learn_randomized(self, experiment, seed=None):
+        experiment.split_for_xval(0.5, False, seed)
+        return tuple(experiment.df.tg_id[experiment.df.is_train].unique())
+
+
+def test_parallel_fold_splits():
+    np.random.seed(42)
+    table = pd.DataFrame(dict(transition_group_id=np.repeat(["g%02d" % i for i in range(40)], 2),
+                              decoy=np.repeat(np.arange(40) % 2, 2),
+                              main_var_score=np.random.random(80),
+                              var_other=np.random.random(80)))
+    experiment = Experiment(prepare_data_table(table)[0])
+
+    # forked workers inherit the random state, the folds must still differ
+    pool = multiprocessing.Pool(processes=4, initializer=init_fold_worker, initargs=(1, ))
+    try:
+        splits = pool.map(unwrap_self_for_multiprocessing, fold_arguments(_SplitLearner(), experiment, 4))
+    finally:
+        pool.close()
+        pool.join()
+
+    assert len(set(splits)) == 4
@@ -0,0 +1,36 @@
+# encoding: utf-8
+from __future__ import print_function
+
+import pandas as pd
+
+from pyprophet.protein_groups import protein_groups
+
+
+# proteins 10 and 11 share peptide 2, proteins 12 and 13 are identified by the same peptides
+MAPPING = pd.DataFrame({'peptide_id': [1, 2, 2, 3, 4, 4, 5, 5, 6],
+                        'protein_id': [10, 10, 11, 11, 12, 13, 12, 13, 14]})
+
+
+def test_indistinguishable():
+    peptides, members = protein_groups(MAPPING, 'indistinguishable')
+
+    assert peptides.to_dict('list') == {'peptide_id': [1, 3, 4, 5, 6], 'group_id': [10, 11, 12, 12, 14]}
+    assert members.to_dict('list') == {'group_id': [10, 11, 12, 12, 14], 'protein_id': [10, 11, 12, 13, 14]}
+
+
+def test_components():
+    peptides, members = protein_groups(MAPPING, 'components')
+
+    assert peptides.to_dict('list') == {'peptide_id': [1, 2, 3, 4, 5, 6], 'group_id': [10, 10, 10, 12, 12, 14]}
+    assert members.to_dict('list') == {'group_id': [10, 10, 12, 12, 14], 'protein_id': [10, 11, 12, 13, 14]}
+
+
+def test_duplicate_mappings():
+    mapping = pd.concat([MAPPING, MAPPING.iloc[[0, 1]]], ignore_index=True)
+
+    for grouping in ['indistinguishable', 'components']:
+        peptides, members = protein_groups(mapping, grouping)
+        expected_peptides, expected_members = protein_groups(MAPPING, grouping)
+
+        pd.testing.assert_frame_equal(peptides, expected_peptides)
+        pd.testing.assert_frame_equal(members, expected_members)
@@ -94,3 +94,50 @@ def test_ipf_3(tmpdir, regtest):
 
 def test_ipf_4(tmpdir, regtest):
     _run_ipf(regtest, tmpdir.strpath, True, True, True, False)
+
+
+def test_ipf_partitioned(tmpdir):
+    os.chdir(tmpdir.strpath)
+    data_path = os.path.join(DATA_FOLDER, "test_data.osw")
+    shutil.copy(data_path, tmpdir.strpath)
+
+    cmdline = "pyprophet score --in=test_data.osw --level=ms1 --test --pi0_lambda=0.1 0 0 --ss_iteration_fdr=0.02"
+    cmdline += " score --in=test_data.osw --level=ms2 --test --pi0_lambda=0.001 0 0 --ss_iteration_fdr=0.02"
+    cmdline += " score --in=test_data.osw --level=transition --test --pi0_lambda=0.1 0 0 --ss_iteration_fdr=0.02"
+    _run_cmdline(cmdline)
+
+    # partitions are inferred independently, the FDR is computed over all partitions
+    _run_cmdline("pyprophet ipf --in=test_data.osw --out=full.osw")
+    _run_cmdline("pyprophet ipf --in=test_data.osw --out=partitioned.osw --partition_size=100 --threads=2")
+
+    query = "SELECT * FROM SCORE_IPF ORDER BY FEATURE_ID, PEPTIDE_ID;"
+    full = pd.read_sql_query(query, sqlite3.connect("full.osw"))
+    partitioned = pd.read_sql_query(query, sqlite3.connect("partitioned.osw"))
+
+    pd.testing.assert_frame_equal(full, partitioned)
+
+
+def test_ipf_max_pruned_posterior_range(tmpdir):
+    from click.testing import CliRunner
+    from pyprophet.main import cli
+
+    infile = os.path.join(tmpdir.strpath, "test_data.osw")
+    open(infile, "w").close()
+
+    # pruning the whole posterior mass leaves no hypotheses
+    for value in ["-0.1", "1", "1.5"]:
+        result = CliRunner().invoke(cli, ["ipf", "--in", infile, "--ipf_max_pruned_posterior", value])
+        assert result.exit_code == 2
+        assert "--ipf_max_pruned_posterior" in result.output
+
+
+def test_ipf_partition_size_range(tmpdir):
+    from click.testing import CliRunner
+    from pyprophet.main import cli
+
+    infile = os.path.join(tmpdir.strpath, "test_data.osw")
+    open(infile, "w").close()
+
+    result = CliRunner().invoke(cli, ["ipf", "--in", infile, "--partition_size", "-1"])
+    assert result.exit_code == 2
+    assert "--partition_size" in result.output
@@ -82,3 +82,125 @@ def test_levels_contexts_0(tmpdir, regtest):
 
 def test_ipf_1(tmpdir, regtest):
     _run_protein(regtest, tmpdir.strpath)
+
+def test_levels_contexts_parallel(tmpdir):
+    os.chdir(tmpdir.strpath)
+    data_path = os.path.join(DATA_FOLDER, "test_data.osw")
+    shutil.copy(data_path, tmpdir.strpath)
+
+    cmdline = "pyprophet score --in=test_data.osw --level=ms2 --test --pi0_lambda=0.001 0 0 --ss_iteration_fdr=0.02"
+    cmdline += " peptide --pi0_lambda=0.001 0 0 --in=test_data.osw --context=run-specific"
+    _run_cmdline(cmdline)
+
+    con = sqlite3.connect("test_data.osw")
+    serial = pd.read_sql_query("SELECT * FROM SCORE_PEPTIDE;", con)
+    con.close()
+
+    # the runs are processed in parallel without writing their reports
+    _run_cmdline("pyprophet peptide --pi0_lambda=0.001 0 0 --in=test_data.osw --out=parallel.osw --context=run-specific --threads=2 --no-run_reports")
+
+    con = sqlite3.connect("parallel.osw")
+    parallel = pd.read_sql_query("SELECT * FROM SCORE_PEPTIDE;", con)
+    con.close()
+
+    pd.testing.assert_frame_equal(serial, parallel)
+    assert not [f for f in os.listdir(tmpdir.strpath) if f.startswith("parallel.osw_")]
+
+def test_levels_contexts_all(tmpdir):
+    os.chdir(tmpdir.strpath)
+    data_path = os.path.join(DATA_FOLDER, "test_data.osw")
+    shutil.copy(data_path, tmpdir.strpath)
+
+    _run_cmdline("pyprophet score --in=test_data.osw --level=ms2 --test --pi0_lambda=0.001 0 0 --ss_iteration_fdr=0.02")
+    shutil.copy("test_data.osw", "separate.osw")
+    shutil.copy("test_data.osw", "all.osw")
+
+    cmdline = "pyprophet"
+    for context in ["run-specific", "experiment-wide", "global"]:
+        cmdline += " peptide --pi0_lambda=0.001 0 0 --in=separate.osw --context=%s" % context
+        cmdline += " protein --pi0_lambda=0 0 0 --in=separate.osw --context=%s" % context
+    _run_cmdline(cmdline)
+
+    cmdline = "pyprophet peptide --pi0_lambda=0.001 0 0 --in=all.osw --context=all"
+    cmdline += " protein --pi0_lambda=0 0 0 --in=all.osw --context=all"
+    _run_cmdline(cmdline)
+
+    for table, key in [("SCORE_PEPTIDE", "PEPTIDE_ID"), ("SCORE_PROTEIN", "PROTEIN_ID")]:
+        con = sqlite3.connect("separate.osw")
+        separate = pd.read_sql_query("SELECT * FROM %s ORDER BY CONTEXT, RUN_ID, %s;" % (table, key), con)
+        con.close()
+
+        con = sqlite3.connect("all.osw")
+        all_contexts = pd.read_sql_query("SELECT * FROM %s ORDER BY CONTEXT, RUN_ID, %s;" % (table, key), con)
+        con.close()
+
+        pd.testing.assert_frame_equal(separate, all_contexts)
+
+def test_levels_contexts_reduced(tmpdir):
+    os.chdir(tmpdir.strpath)
+    data_path = os.path.join(DATA_FOLDER, "test_data.osw")
+    shutil.copy(data_path, tmpdir.strpath)
+
+    _run_cmdline("pyprophet score --in=test_data.osw --level=ms2 --test --pi0_lambda=0.001 0 0 --ss_iteration_fdr=0.02")
+    _run_cmdline("pyprophet reduce --in=test_data.osw --out=test_data.oswr")
+    _run_cmdline("pyprophet merge --template=test_data.osw --out=merged.osw test_data.oswr")
+
+    # only the top-ranking peak groups are kept by reduce and contribute to the peptide and protein scores
+    for osw in ["test_data.osw", "merged.osw"]:
+        _run_cmdline("pyprophet peptide --pi0_lambda=0.001 0 0 --in=%s --context=global protein --pi0_lambda=0 0 0 --in=%s --context=global" % (osw, osw))
+
+    for table in ["SCORE_PEPTIDE", "SCORE_PROTEIN"]:
+        con = sqlite3.connect("test_data.osw")
+        full = pd.read_sql_query("SELECT * FROM %s;" % table, con)
+        con.close()
+
+        con = sqlite3.connect("merged.osw")
+        reduced = pd.read_sql_query("SELECT * FROM %s;" % table, con)
+        con.close()
+
+        pd.testing.assert_frame_equal(full, reduced)
+
+def test_proteotypic_cache(tmpdir):
+    from pyprophet.levels_contexts import cache_proteotypic_peptides
+
+    con = sqlite3.connect(os.path.join(tmpdir.strpath, "test.osw"))
+    con.execute("CREATE TABLE PEPTIDE_PROTEIN_MAPPING (PEPTIDE_ID INT, PROTEIN_ID INT)")
+    con.executemany("INSERT INTO PEPTIDE_PROTEIN_MAPPING VALUES (?,?)", [(1, 10), (2, 10), (2, 11), (3, 11)])
+
+    cache_proteotypic_peptides(con)
+    assert con.execute("SELECT * FROM PYPROPHET_PROTEOTYPIC ORDER BY PEPTIDE_ID").fetchall() == [(1, 10), (3, 11)]
+
+    # the cached table is kept while the library is unchanged
+    con.execute("DELETE FROM PYPROPHET_PROTEOTYPIC WHERE PEPTIDE_ID = 1")
+    cache_proteotypic_peptides(con)
+    assert con.execute("SELECT * FROM PYPROPHET_PROTEOTYPIC ORDER BY PEPTIDE_ID").fetchall() == [(3, 11)]
+
+    # and rebuilt after the library changed
+    con.execute("DELETE FROM PEPTIDE_PROTEIN_MAPPING WHERE PEPTIDE_ID = 2 AND PROTEIN_ID = 11")
+    cache_proteotypic_peptides(con)
+    assert con.execute("SELECT * FROM PYPROPHET_PROTEOTYPIC ORDER BY PEPTIDE_ID").fetchall() == [(1, 10), (2, 10), (3, 11)]
+    con.close()
+
+def test_peptide_protein_cli(tmpdir):
+    from click.testing import CliRunner
+    from pyprophet.main import cli
+
+    os.chdir(tmpdir.strpath)
+    data_path = os.path.join(DATA_FOLDER, "test_data.osw")
+    shutil.copy(data_path, tmpdir.strpath)
+
+    runner = CliRunner()
+    result = runner.invoke(cli, ["score", "--in=test_data.osw", "--level=ms2", "--test", "--pi0_lambda", "0.001", "0", "0", "--ss_iteration_fdr=0.02",
+                                 "peptide", "--in=test_data.osw", "--context=global", "--pi0_lambda", "0.001", "0", "0",
+                                 "protein", "--in=test_data.osw", "--context=global", "--pi0_lambda", "0", "0", "0", "--grouping=indistinguishable"])
+    assert result.exit_code == 0, result.output
+
+    con = sqlite3.connect("test_data.osw")
+    assert con.execute("SELECT COUNT(*) FROM SCORE_PEPTIDE WHERE CONTEXT = 'global'").fetchone()[0] > 0
+    assert con.execute("SELECT COUNT(*) FROM SCORE_PROTEIN WHERE CONTEXT = 'global'").fetchone()[0] > 0
+    con.close()
+
+    # protein grouping is an option of protein inference only
+    result = runner.invoke(cli, ["peptide", "--in=test_data.osw", "--grouping=indistinguishable"])
+    assert result.exit_code == 2
+    assert "--grouping" in result.output
@@ -138,6 +138,66 @@ def test_osw_4(tmpdir, regtest):
 def test_osw_5(tmpdir, regtest):
     _run_pyprophet_osw_to_learn_model(regtest, tmpdir.strpath, True, False, True, pi0_lambda="0 0 0", ms1ms2=True, xgboost=True, xgboost_tune=True)
 
+def test_osw_rescore(tmpdir):
+    os.chdir(tmpdir.strpath)
+    data_path = os.path.join(DATA_FOLDER, "test_data.osw")
+    shutil.copy(data_path, tmpdir.strpath)
+    _run_cmdline("pyprophet score --in=test_data.osw --level=ms2 --test --pi0_lambda 0.4 0 0 --ss_iteration_fdr=0.02")
+    scored = pd.read_sql_query("SELECT * FROM SCORE_MS2", sqlite3.connect("test_data.osw"))
+
+    # stored discriminant scores with the same statistics options reproduce the results
+    _run_cmdline("pyprophet score --in=test_data.osw --level=ms2 --rescore --pi0_lambda 0.4 0 0")
+    rescored = pd.read_sql_query("SELECT * FROM SCORE_MS2", sqlite3.connect("test_data.osw"))
+    pd.testing.assert_frame_equal(scored, rescored)
+
+    _run_cmdline("pyprophet score --in=test_data.osw --level=ms2 --rescore --pi0_lambda 0.1 0.5 0.05 --pi0_method=smoother")
+    rescored = pd.read_sql_query("SELECT * FROM SCORE_MS2", sqlite3.connect("test_data.osw"))
+    pd.testing.assert_series_equal(scored.SCORE, rescored.SCORE)
+    pd.testing.assert_series_equal(scored.RANK, rescored.RANK)
+    assert not scored.QVALUE.equals(rescored.QVALUE)
+
+
+def test_osw_apply_error_model(tmpdir):
+    os.chdir(tmpdir.strpath)
+    data_path = os.path.join(DATA_FOLDER, "test_data.osw")
+    shutil.copy(data_path, tmpdir.strpath)
+    shutil.copy(data_path, os.path.join(tmpdir.strpath, "test_data_apply.osw"))
+    _run_cmdline("pyprophet score --in=test_data.osw --level=ms2 --test --pi0_lambda 0.4 0 0 --ss_iteration_fdr=0.02 --save_error_model")
+
+    # the stored classifier and error model reproduce the scores of the learning run
+    _run_cmdline("pyprophet score --in=test_data_apply.osw --level=ms2 --apply_error_model --apply_weights=test_data.osw")
+    scored = pd.read_sql_query("SELECT * FROM SCORE_MS2", sqlite3.connect("test_data.osw"))
+    applied = pd.read_sql_query("SELECT * FROM SCORE_MS2", sqlite3.connect("test_data_apply.osw"))
+    pd.testing.assert_frame_equal(scored, applied)
+
+    # a file without peak groups is rejected
+    con = sqlite3.connect("test_data_apply.osw")
+    con.execute("DELETE FROM FEATURE")
+    con.commit()
+    con.close()
+    cmdline = "pyprophet score --in=test_data_apply.osw --level=ms2 --apply_error_model --apply_weights=test_data.osw"
+
+    with pytest.raises(subprocess.CalledProcessError) as exc_info:
+        subprocess.check_output(cmdline, shell=True, stderr=subprocess.STDOUT)
+
+    assert "Error: No ms2-level peak groups present in test_data_apply.osw." in str(exc_info.value.output)
+
+
+def test_osw_level_all(tmpdir):
+    os.chdir(tmpdir.strpath)
+    data_path = os.path.join(DATA_FOLDER, "test_data.osw")
+    shutil.copy(data_path, tmpdir.strpath)
+    _run_cmdline("pyprophet score --in=test_data.osw --level=ms1 --test --ss_iteration_fdr=0.02 "
+                 "score --in=test_data.osw --level=ms2 --test --ss_iteration_fdr=0.02 "
+                 "score --in=test_data.osw --level=transition --test --ss_iteration_fdr=0.02")
+    _run_cmdline("pyprophet score --in=%s --out=test_data_all.osw --level=all --test --ss_iteration_fdr=0.02 --threads=2" % data_path)
+
+    for table in ["SCORE_MS1", "SCORE_MS2", "SCORE_TRANSITION"]:
+        single = pd.read_sql_query("SELECT * FROM %s" % table, sqlite3.connect("test_data.osw"))
+        combined = pd.read_sql_query("SELECT * FROM %s" % table, sqlite3.connect("test_data_all.osw"))
+        pd.testing.assert_frame_equal(single, combined)
+
+
 def test_not_unique_tg_id_blocks(tmpdir):
 
     os.chdir(tmpdir.strpath)
@@ -1,7 +1,8 @@
 # encoding: utf-8
 from __future__ import print_function
 
-from pyprophet.stats import to_one_dim_array, pnorm, pemp, pi0est, qvalue, bw_nrd0, lfdr, stat_metrics
+from pyprophet.stats import to_one_dim_array, pnorm, pemp, pi0est, qvalue, bw_nrd0, lfdr, stat_metrics, find_nearest_matches, lookup_values_from_error_table
+import pyprophet.optimized as o
 
 import pandas as pd
 pd.options.display.expand_frame_repr = False
@@ -9,6 +10,7 @@ pd.options.display.precision = 4
 pd.options.display.max_columns = None
 
 import numpy as np
+import scipy.stats
 import os
 import shutil
 
@@ -86,6 +88,20 @@ def test_lfdr(tmpdir, regtest):
     print(lfdr(stat['p'], 0.669926026474838, eps=np.power(10.0,-2)), file=regtest)
 
 
+def test_lfdr_binned(tmpdir):
+    os.chdir(tmpdir.strpath)
+    data_path = os.path.join(DATA_FOLDER, "test_lfdr_ref_data.csv")
+    shutil.copy(data_path, tmpdir.strpath)
+
+    stat = pd.read_csv('test_lfdr_ref_data.csv', delimiter=',').sort_index(axis=1).sort_values("p")
+
+    # For comparison with R/bioconductor reference implementation
+    np.testing.assert_almost_equal(lfdr(stat['p'], 0.669926026474838, density="binned"), stat['lfdr_default'].values, decimal=3)
+    np.testing.assert_almost_equal(lfdr(stat['p'], 0.669926026474838, monotone = False, density="binned"), stat['lfdr_monotone_false'].values, decimal=2)
+    np.testing.assert_almost_equal(lfdr(stat['p'], 0.669926026474838, transf="logit", density="binned"), stat['lfdr_transf_logit'].values, decimal=3)
+    np.testing.assert_almost_equal(lfdr(stat['p'], 0.669926026474838, eps=np.power(10.0,-2), density="binned"), stat['lfdr_eps'].values, decimal=3)
+
+
 def test_stat_metrics(tmpdir, regtest):
     os.chdir(tmpdir.strpath)
     data_path = os.path.join(DATA_FOLDER, "test_lfdr_ref_data.csv")
@@ -105,3 +121,86 @@ def test_random(regtest):
             stat0 = np.random.random((j,))
             print(i, j, file=regtest)
             print(pemp(stat, stat0), file=regtest)
+
+
+def _qvalue_loop(p_values, pi0):
+    # reference implementation of the monotonicity loop of previous versions
+    p = np.array(p_values, dtype=np.float64)
+    m = len(p)
+    u = np.argsort(p)
+    v = scipy.stats.rankdata(p, "max")
+    qvals = (pi0 * m * p) / v
+    qvals[u[m-1]] = np.minimum(qvals[u[m-1]], 1)
+    for i in list(reversed(range(0, m-2, 1))):
+        qvals[u[i]] = np.minimum(qvals[u[i]], qvals[u[i + 1]])
+    return qvals
+
+
+def _monotone_loop(lfdr_values, p):
+    # reference implementation of the monotonicity loop of previous versions
+    lfdr_values = lfdr_values[p.argsort()]
+    for i in range(1, len(lfdr_values)):
+        if (lfdr_values[i] < lfdr_values[i - 1]):
+            lfdr_values[i] = lfdr_values[i - 1]
+    return lfdr_values[scipy.stats.rankdata(p, "min")-1]
+
+
+def test_monotone_kernels(tmpdir):
+    os.chdir(tmpdir.strpath)
+    data_path = os.path.join(DATA_FOLDER, "test_lfdr_ref_data.csv")
+    shutil.copy(data_path, tmpdir.strpath)
+
+    stat = pd.read_csv('test_lfdr_ref_data.csv', delimiter=',')
+
+    np.random.seed(1)
+    samples = [stat['p'].values, np.random.random(1000), np.round(np.random.random(1000), 2), np.random.random(2), np.random.random(1)]
+
+    for p in samples:
+        assert np.array_equal(qvalue(p, 0.669926026474838), _qvalue_loop(p, 0.669926026474838))
+
+        if len(p) > 1:
+            assert np.array_equal(lfdr(p, 0.669926026474838), _monotone_loop(lfdr(p, 0.669926026474838, monotone=False), p))
+
+
+def test_find_nearest_matches():
+    np.random.seed(1)
+    for i in range(500):
+        n = np.random.randint(1, 30)
+        if i % 2:
+            # heavily tied values
+            basis = np.random.randint(0, 8, n).astype(np.float32) / 2
+        else:
+            basis = np.random.random(n).astype(np.float32)
+        search = np.hstack((np.random.randint(-2, 10, 20).astype(np.float32) / 4, basis))
+
+        for b in (basis, np.sort(basis), np.sort(basis)[::-1].copy()):
+            for use_sort_order in (1, 0):
+                assert np.array_equal(find_nearest_matches(b, search, use_sort_order), o.find_nearest_matches(b, search, use_sort_order))
+                assert np.array_equal(find_nearest_matches(b, search, use_sort_order, threads=2), o.find_nearest_matches(b, search, use_sort_order))
+
+    assert list(find_nearest_matches(np.float32([0, 1, 1, 1, 2]), np.float32([1, 0.5, 1.5, 3]))) == [1, 1, 4, 4]
+    assert list(find_nearest_matches(np.float32([2, 1, 1, 1, 0]), np.float32([1, 0.5, 1.5, 3]))) == [1, 4, 1, 0]
+
+
+def test_find_nearest_matches_chunks():
+    # small chunks run the threaded path on several chunks
+    np.random.seed(2)
+    basis = np.random.randint(0, 50, 200).astype(np.float32) / 4
+    search = np.random.random(1000).astype(np.float32) * 14 - 1
+
+    for b in (basis, np.sort(basis), np.sort(basis)[::-1].copy()):
+        for use_sort_order in (1, 0):
+            serial = find_nearest_matches(b, search, use_sort_order)
+            for chunk_size in (1, 7, 128, 1000):
+                assert np.array_equal(find_nearest_matches(b, search, use_sort_order, threads=3, chunk_size=chunk_size), serial)
+
+
+def test_lookup_interpolate():
+    err_df = pd.DataFrame({'cutoff': [0.0, 1.0, 1.0, 2.0], 'pvalue': [1.0, 0.5, 0.4, 0.0], 'svalue': [1.0, 0.5, 0.4, 0.0], 'pep': [1.0, 0.5, 0.4, 0.0], 'qvalue': [0.4, 0.2, 0.1, 0.0]})
+
+    p_values, s_values, peps, q_values = lookup_values_from_error_table(np.array([-1.0, 0.0, 0.5, 1.0, 1.5, 3.0]), err_df, True)
+    np.testing.assert_almost_equal(q_values, [0.4, 0.4, 0.3, 0.2, 0.1, 0.0])
+    np.testing.assert_almost_equal(peps, [1.0, 1.0, 0.75, 0.5, 0.25, 0.0])
+
+    p_values, s_values, peps, q_values = lookup_values_from_error_table(np.array([-1.0, 0.0, 0.4, 1.0, 1.6, 3.0]), err_df)
+    np.testing.assert_almost_equal(q_values, [0.4, 0.4, 0.4, 0.2, 0.0, 0.0])